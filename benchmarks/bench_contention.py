@@ -0,0 +1,115 @@
+"""Бенчмарк конкуренции читателей и писателей за историю.
+
+R потоков-читателей забирают окно истории (как /get-messages без since и страница /)
+и склеивают ответ, W потоков-писателей добавляют сообщения. Для каждого числа читателей
+меряется задержка append() у писателей. Для сравнения тот же прогон повторяется
+с читателями, которые держат history_lock на время чтения, — так было до снимков HistoryLog.
+
+    python benchmarks/bench_contention.py [--readers 0,50,100,500] [--writers 50]
+        [--history 1000] [--duration 3] [--reader-pause 0.1] [--writer-pause 0.005]
+"""
+import argparse
+import threading
+import time
+
+from common import import_wapp
+
+wapp = import_wapp()
+
+
+def make_store(history):
+    store = wapp.MemoryStore('bench_history.json', 'bench_history.jsonl', max_size=history)
+    for i in range(history):
+        store.append(make_message(f"сообщение {i}"))
+    return store
+
+
+def make_message(text):
+    return {'datetime': '01.01.2025 00:00', 'method': 'POST', 'message': text, 'ip': '10.0.0.1',
+            'admin': False, 'ts': 1735689600}
+
+
+def run(store, readers, writers, args, locked):
+    start = threading.Event()
+    stop = threading.Event()
+    latencies = []
+    reads = [0]
+    lock = threading.Lock()
+
+    def reader():
+        count = 0
+        start.wait()
+        while not stop.is_set():
+            if locked:
+                with store.history_lock:
+                    history, last_id = store.messages_since(None)
+                    body = wapp.history_body(history, last_id)
+            else:
+                history, last_id = store.messages_since(None)
+                body = wapp.history_body(history, last_id)
+            count += bool(body)
+            time.sleep(args.reader_pause)
+        with lock:
+            reads[0] += count
+
+    def writer(number):
+        own = []
+        sent = 0
+        start.wait()
+        while not stop.is_set():
+            sent += 1
+            message = make_message(f"писатель {number} {sent}")
+            started = time.perf_counter()
+            store.append(message)
+            own.append(time.perf_counter() - started)
+            time.sleep(args.writer_pause)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(number,)) for number in range(writers)]
+    for thread in threads:
+        thread.start()
+    # Все потоки уже запущены — только теперь начинаем отсчет
+    start.set()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6 if latencies else 0.0
+
+    return len(latencies) / args.duration, percentile(0.5), percentile(0.99), reads[0] / args.duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', default='0,50,100,500', help='числа читателей через запятую')
+    parser.add_argument('--writers', type=int, default=50)
+    parser.add_argument('--history', type=int, default=1000, help='размер окна истории')
+    parser.add_argument('--duration', type=float, default=3, help='секунд на каждый прогон')
+    parser.add_argument('--reader-pause', type=float, default=0.1, help='пауза читателя между запросами, с')
+    parser.add_argument('--writer-pause', type=float, default=0.005, help='пауза писателя между сообщениями, с')
+    args = parser.parse_args()
+
+    # Без фонового писателя журнала: меряем только блокировку истории
+    wapp.persist_queue.put(wapp._STOP_PERSISTENCE)
+    wapp.persist_thread.join()
+
+    print(f"{'читателей':>10} {'режим':>14} {'записей/с':>10} {'p50, мкс':>10} {'p99, мкс':>10} {'чтений/с':>10}")
+    for readers in (int(value) for value in args.readers.split(',')):
+        for locked in (False, True):
+            store = make_store(args.history)
+            writes, p50, p99, reads = run(store, readers, args.writers, args, locked)
+            mode = 'с блокировкой' if locked else 'снимки'
+            print(f"{readers:>10} {mode:>14} {writes:>10.0f} {p50:>10.1f} {p99:>10.1f} {reads:>10.0f}")
+            # Очередь журнала никто не читает — не копим ее между прогонами
+            while not wapp.persist_queue.empty():
+                wapp.persist_queue.get_nowait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Микробенчмарк фильтра запрещенных слов.
+
+Сравнивает время проверки одного сообщения автоматом Ахо — Корасик (ContentFilter)
+и наивной проверкой `term in message` для списков разного размера.
+
+    python benchmarks/bench_filter.py [--sizes 10,100,1000,10000,50000] [--messages 2000]
+"""
+import argparse
+import random
+import string
+import time
+
+from common import import_wapp
+
+wapp = import_wapp()
+
+
+def random_word(rnd, alphabet, low, high):
+    return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(low, high)))
+
+
+def make_messages(rnd, count):
+    # Каждое слово из букв одного алфавита, как в обычном тексте: слова со смесью алфавитов фильтр проверяет дважды
+    alphabets = (string.ascii_lowercase, 'абвгдежзиклмнопрстуфхцчшщыэюя')
+    return [' '.join(random_word(rnd, rnd.choice(alphabets), 2, 9) for _ in range(rnd.randint(3, 25)))
+            for _ in range(count)]
+
+
+def per_message_us(check, messages):
+    start = time.perf_counter()
+    for message in messages:
+        check(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,10000,50000', help='размеры списка через запятую')
+    parser.add_argument('--messages', type=int, default=2000, help='сколько сообщений проверять')
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    messages = make_messages(rnd, args.messages)
+    print(f"{'слов':>8} {'сборка, мс':>12} {'автомат, мкс':>14} {'наивно, мкс':>13}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        terms = [random_word(rnd, string.ascii_lowercase, 4, 10) for _ in range(size)]
+
+        start = time.perf_counter()
+        content_filter = wapp.ContentFilter(terms)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        automaton_us = per_message_us(content_filter.search, messages)
+        folded = [variant for term in terms for variant in wapp.normalize_for_filter(term)]
+
+        def naive(message):
+            return any(term in variant for variant in wapp.normalize_for_filter(message) for term in folded)
+
+        # Наивный вариант на большом списке очень медленный — меряем его на части сообщений
+        naive_us = per_message_us(naive, messages[:max(20, len(messages) * 100 // max(size, 100))])
+        print(f"{size:>8} {build_ms:>12.1f} {automaton_us:>14.1f} {naive_us:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
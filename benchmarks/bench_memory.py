@@ -0,0 +1,88 @@
+"""Бенчмарк памяти окна истории.
+
+Заполняет окно MemoryStore сообщениями и меряет, сколько памяти оно занимает
+(tracemalloc и прирост RSS), сколько объектов отслеживает сборщик мусора и сколько
+длится полная сборка gc.collect(). Для сравнения строится окно в прежнем виде —
+записи (id, JSON, словарь сообщения). Прирост RSS приблизительный: второй прогон
+переиспользует память, которую освободил первый.
+
+    python benchmarks/bench_memory.py [--history 100000] [--senders 500]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from common import import_wapp
+
+wapp = import_wapp()
+
+
+def rss_kb():
+    """Текущий RSS процесса (только Linux), 0 если узнать нельзя"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def make_message(number, senders):
+    # Как в log_message: каждый раз новые строки, а не общие литералы
+    return {'datetime': '01.01.2025 00:00', 'method': 'POST', 'message': f"сообщение номер {number}",
+            'ip': f"10.0.{number % senders // 256}.{number % senders % 256} (host-{number % senders}.example.org)",
+            'admin': number % 100 == 0, 'ts': 1735689600 + number, 'id': number + 1}
+
+
+def legacy_window(count, senders):
+    window = wapp.HistoryLog(count)
+    for number in range(count):
+        message = make_message(number, senders)
+        window.append((message['id'], wapp.encode_message(message), message))
+    return window
+
+
+def compact_window(count, senders):
+    window = wapp.HistoryLog(count)
+    for number in range(count):
+        message = make_message(number, senders)
+        window.append(wapp.history_entry(message, wapp.encode_message(message)))
+    return window
+
+
+def measure(build, count, senders):
+    gc.collect()
+    tracked_before = len(gc.get_objects())
+    rss_before = rss_kb()
+    tracemalloc.start()
+    window = build(count, senders)
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss = rss_kb() - rss_before
+    tracked = len(gc.get_objects()) - tracked_before
+    started = time.perf_counter()
+    gc.collect()
+    collect_ms = (time.perf_counter() - started) * 1000
+    del window
+    gc.collect()
+    return traced, rss, tracked, collect_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, default=100000, help='размер окна истории')
+    parser.add_argument('--senders', type=int, default=500, help='сколько разных отправителей')
+    args = parser.parse_args()
+
+    print(f"{'окно':>10} {'МБ':>8} {'Б/сообщ.':>9} {'RSS, МБ':>8} {'объектов GC':>12} {'gc.collect, мс':>15}")
+    for name, build in (('словари', legacy_window), ('компактное', compact_window)):
+        traced, rss, tracked, collect_ms = measure(build, args.history, args.senders)
+        print(f"{name:>10} {traced / 2**20:>8.1f} {traced / args.history:>9.0f} {rss / 1024:>8.1f}"
+              f" {tracked:>12} {collect_ms:>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""Нагрузочный бенчмарк мессенджера.
+
+N клиентов опрашивают /get-messages, M клиентов пишут в /message, K клиентов открывают /.
+Для каждого размера заранее загруженной истории считаются пропускная способность,
+p50/p99 задержки по маршрутам и память процесса сервера. Результат сохраняется в JSON,
+чтобы сравнивать прогоны на разных коммитах.
+
+    python benchmarks/bench_messenger.py [--mode client|server] [--history 1000,10000,100000]
+        [--pollers 20] [--posters 4] [--pages 2] [--duration 5] [--storage memory|sqlite]
+        [--output results.json] [--compare old.json]
+
+client — приложение Flask через test_client() в отдельном процессе, без сети;
+server — настоящий сервер (uvicorn, а без него — встроенный сервер Flask) на 127.0.0.1.
+Каждый размер истории запускается в новом процессе в пустой временной папке.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Выполняется в процессе, где работает приложение: без ограничителей частоты и DNS,
+# чтобы мерить само приложение, а не паузы 429 и сеть
+PREPARE_APP = f"""
+import sys
+sys.path.insert(0, {ROOT!r})
+import wapp
+wapp.post_limiter.rate = wapp.poll_limiter.rate = 0
+wapp.RESOLVE_HOSTNAMES = False
+"""
+
+
+def make_history(size):
+    rnd = random.Random(size)
+    words = ['привет', 'как', 'дела', 'hello', 'world', 'сообщение', 'тест', 'мессенджер', 'ok', 'да', 'нет']
+    start = int(time.time()) - size
+    for message_id in range(1, size + 1):
+        ts = start + message_id
+        yield {
+            'datetime': datetime.fromtimestamp(ts).strftime("%d.%m.%Y %H:%M"),
+            'method': 'POST',
+            'message': ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 12))),
+            'ip': f"10.0.{message_id % 256}.{message_id // 256 % 256}",
+            'admin': False,
+            'ts': ts,
+            'id': message_id,
+        }
+
+
+def preload(directory, size, storage):
+    """Кладет в папку историю из size сообщений в формате выбранного хранилища"""
+    if storage == 'sqlite':
+        # Через само хранилище, чтобы схема базы и индексы были как у сервера
+        code = PREPARE_APP + f"""
+sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})
+from bench_messenger import make_history
+store = wapp.SQLiteStore('messages.db')
+store.import_messages(make_history({size}))
+store.close()
+"""
+        subprocess.run([sys.executable, '-c', code], cwd=directory, env=dict(os.environ, MESSENGER_STORAGE='sqlite'),
+                       check=True)
+    else:
+        # Снимок в формате MemoryStore: по сообщению в строке
+        with open(os.path.join(directory, 'message_history2.json'), 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(message, ensure_ascii=False) + '\n' for message in make_history(size))
+
+
+def read_memory(pid):
+    """(текущий RSS, пиковый RSS) процесса в МБ"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError):
+        # Не Linux: только пик своего процесса (на macOS ru_maxrss в байтах)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        return None, peak
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, data=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+    """Свое постоянное соединение на каждый поток"""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+
+    def request(self, method, path, body, headers):
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+
+def run_load(make_transport, args):
+    """Гоняет нагрузку args.duration секунд; возвращает задержки и ошибки по маршрутам"""
+    latencies = {'get-messages': [], 'message': [], 'page': []}
+    errors = {name: 0 for name in latencies}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    start_barrier = threading.Barrier(args.pollers + args.posters + args.pages)
+
+    def client(name, number):
+        transport = make_transport()
+        # Свой адрес у каждого клиента, как у настоящих пользователей
+        headers = {'Accept-Encoding': 'gzip', 'X-Forwarded-For': f"10.1.{number // 256}.{number % 256}"}
+        since = None
+        sent = 0
+        own, failed = [], 0
+        start_barrier.wait()
+        while time.perf_counter() < deadline:
+            if name == 'get-messages':
+                method, path, body = 'GET', '/get-messages' if since is None else f'/get-messages?since={since}', None
+            elif name == 'message':
+                sent += 1
+                method, path, body = 'POST', '/message', json.dumps({'message': f"нагрузка {number} {sent}"})
+            else:
+                method, path, body = 'GET', '/', None
+            request_headers = dict(headers, **({'Content-Type': 'application/json'} if body else {}))
+            started = time.perf_counter()
+            try:
+                status, data = transport.request(method, path, body, request_headers)
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                transport = make_transport()
+                continue
+            own.append(time.perf_counter() - started)
+            if status != 200:
+                failed += 1
+            elif name == 'get-messages':
+                if data[:2] == b'\x1f\x8b':
+                    data = gzip.decompress(data)
+                since = json.loads(data)['last_id']
+        with lock:
+            latencies[name].extend(own)
+            errors[name] += failed
+
+    threads = [threading.Thread(target=client, args=(name, number))
+               for number, name in enumerate(['get-messages'] * args.pollers + ['message'] * args.posters
+                                             + ['page'] * args.pages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def summarize(latencies, errors, duration):
+    def percentile(values, q):
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else None
+
+    endpoints = {}
+    for name, values in latencies.items():
+        values.sort()
+        endpoints[name] = {
+            'requests': len(values),
+            'throughput': round(len(values) / duration, 1),
+            'p50_ms': percentile(values, 0.50),
+            'p99_ms': percentile(values, 0.99),
+            'errors': errors[name],
+        }
+    return endpoints
+
+
+def run_client_mode(directory, args):
+    """Выполняется в отдельном процессе (--worker): приложение и нагрузка в одном процессе"""
+    os.chdir(directory)
+    started = time.perf_counter()
+    namespace = {}
+    exec(PREPARE_APP, namespace)
+    startup = time.perf_counter() - started
+    app = namespace['wapp'].app
+    latencies, errors = run_load(lambda: TestClientTransport(app), args)
+    rss, peak_rss = read_memory(os.getpid())
+    namespace['wapp'].stop_persistence()
+    return {'startup_s': startup, 'endpoints': summarize(latencies, errors, args.duration),
+            'rss_mb': rss, 'peak_rss_mb': peak_rss}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_server_mode(directory, args):
+    port = free_port()
+    code = PREPARE_APP + f"""
+if wapp.uvicorn is not None:
+    wapp.serve('127.0.0.1', {port}, 1)
+else:
+    wapp.app.run(host='127.0.0.1', port={port}, threaded=True)
+"""
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=directory, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, env=dict(os.environ, MESSENGER_STORAGE=args.storage))
+    try:
+        # Время запуска — пока сервер не начнет отвечать
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("Сервер завершился при запуске")
+            try:
+                HttpTransport('127.0.0.1', port).request('GET', '/stats', None, {})
+                break
+            except OSError:
+                time.sleep(0.02)
+        startup = time.perf_counter() - started
+        latencies, errors = run_load(lambda: HttpTransport('127.0.0.1', port), args)
+        rss, peak_rss = read_memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return {'startup_s': startup, 'endpoints': summarize(latencies, errors, args.duration),
+            'rss_mb': rss, 'peak_rss_mb': peak_rss}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, baseline=None):
+    print(f"история {result['history']}: запуск {result['startup_s']:.2f} с, "
+          f"RSS {result['rss_mb'] or 0:.0f} МБ (пик {result['peak_rss_mb'] or 0:.0f} МБ)")
+    for name, stats in result['endpoints'].items():
+        line = (f"  {name:<13} {stats['throughput']:>9.1f} зап/с  p50 {stats['p50_ms'] or 0:>8.2f} мс  "
+                f"p99 {stats['p99_ms'] or 0:>8.2f} мс  ошибок {stats['errors']}")
+        old = baseline and baseline['endpoints'].get(name)
+        if old and old['throughput'] and old['p99_ms']:
+            line += (f"  (пропускная {stats['throughput'] / old['throughput']:.2f}x, "
+                     f"p99 {(stats['p99_ms'] or 0) / old['p99_ms']:.2f}x)")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('client', 'server'), default='client')
+    parser.add_argument('--history', default='1000,10000,100000', help='размеры истории через запятую')
+    parser.add_argument('--pollers', type=int, default=20, help='клиентов, опрашивающих /get-messages')
+    parser.add_argument('--posters', type=int, default=4, help='клиентов, пишущих в /message')
+    parser.add_argument('--pages', type=int, default=2, help='клиентов, открывающих страницу /')
+    parser.add_argument('--duration', type=float, default=5, help='секунд нагрузки на каждый размер')
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default=os.environ.get('MESSENGER_STORAGE', 'memory'))
+    parser.add_argument('--output', help='куда сохранить JSON (по умолчанию benchmarks/results/<коммит>-<режим>.json)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_client_mode(args.worker, args)))
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = {result['history']: result for result in json.load(f)['results']}
+
+    results = []
+    for size in (int(value) for value in args.history.split(',')):
+        with tempfile.TemporaryDirectory() as directory:
+            preload(directory, size, args.storage)
+            if args.mode == 'server':
+                result = run_server_mode(directory, args)
+            else:
+                worker = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--worker', directory],
+                                        capture_output=True, text=True, env=dict(os.environ, MESSENGER_STORAGE=args.storage))
+                if worker.returncode != 0:
+                    sys.exit(worker.stderr)
+                result = json.loads(worker.stdout.strip().splitlines()[-1])
+        result['history'] = size
+        results.append(result)
+        print_result(result, baseline.get(size))
+
+    commit = git_commit()
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{commit or 'local'}-{args.mode}-{args.storage}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'mode': args.mode,
+            'storage': args.storage,
+            'pollers': args.pollers,
+            'posters': args.posters,
+            'pages': args.pages,
+            'duration': args.duration,
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+if __name__ == '__main__':
+    main()
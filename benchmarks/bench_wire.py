@@ -0,0 +1,80 @@
+"""Бенчмарк форматов ответа /get-messages.
+
+Для истории разного размера сравнивает байты на проводе (как есть и после gzip), время
+сборки ответа на сервере и время разбора на клиенте:
+
+- jsonify(history=history) — сериализация словарей при каждом запросе, как было раньше;
+- JSON — склейка готовых JSON сообщений (history_body);
+- компактный — строки с именами полей один раз (history_body(..., compact=True));
+- msgpack — те же строки в MessagePack, если установлен пакет msgpack.
+
+    python benchmarks/bench_wire.py [--sizes 100,1000,10000] [--repeat 20]
+"""
+import argparse
+import gzip
+import time
+
+from common import import_wapp
+
+wapp = import_wapp()
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def make_messages(count):
+    return [{'datetime': '01.01.2025 00:00', 'method': 'POST', 'message': f"сообщение номер {number}",
+             'ip': f"10.0.0.{number % 50} (host-{number % 50}.example.org)", 'admin': number % 100 == 0,
+             'ts': 1735689600 + number, 'id': number + 1} for number in range(count)]
+
+
+def best_us(function, repeat):
+    """Лучшее из repeat замеров, мкс"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000', help='размеры истории через запятую')
+    parser.add_argument('--repeat', type=int, default=20, help='сколько раз повторять каждый замер')
+    args = parser.parse_args()
+
+    print(f"{'сообщений':>10} {'формат':>12} {'байт':>10} {'gzip':>9} {'сборка, мкс':>12} {'разбор, мкс':>12}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        messages = make_messages(size)
+        # Готовые кодировки — то, что хранилище держит в окне истории
+        pairs = [(msg['id'], wapp.encode_message(msg)) for msg in messages]
+        rows = [(msg['id'], wapp.encode_row(msg)) for msg in messages]
+        last_id = messages[-1]['id']
+
+        def build_jsonify():
+            with wapp.app.app_context():
+                return wapp.jsonify(history=messages, last_id=last_id).get_data()
+
+        formats = [
+            ('jsonify', build_jsonify, wapp.json.loads),
+            ('JSON', lambda: wapp.history_body(pairs, last_id), wapp.json.loads),
+            ('компактный', lambda: wapp.history_body(rows, last_id, compact=True), wapp.json.loads),
+        ]
+        if msgpack is not None:
+            table = [[msg[column] for column in wapp.COMPACT_COLUMNS] for msg in messages]
+            formats.append(('msgpack', lambda: msgpack.packb({'columns': wapp.COMPACT_COLUMNS, 'rows': table,
+                                                              'last_id': last_id}), msgpack.unpackb))
+
+        for name, build, parse in formats:
+            body = build()
+            compressed = gzip.compress(body, wapp.COMPRESS_LEVEL)
+            build_us = best_us(build, args.repeat)
+            parse_us = best_us(lambda: parse(body), args.repeat)
+            print(f"{size:>10} {name:>12} {len(body):>10} {len(compressed):>9} {build_us:>12.0f} {parse_us:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""Общее для микробенчмарков: импорт приложения во временной папке."""
+import atexit
+import importlib
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_wapp():
+    """Модуль wapp. При импорте он открывает хранилище в текущей папке, поэтому настоящую историю
+    не трогаем: импортируем во временной папке, которая удаляется при выходе"""
+    directory = tempfile.TemporaryDirectory(prefix='messenger-bench-')
+    # Обработчики atexit вызываются в обратном порядке: папка удалится после того,
+    # как stop_persistence() из wapp допишет и закроет файлы
+    atexit.register(directory.cleanup)
+    os.chdir(directory.name)
+    sys.path.insert(0, ROOT)
+    return importlib.import_module('wapp')
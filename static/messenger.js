@@ -0,0 +1,422 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const input = document.getElementById('message-input');
+    const button = document.getElementById('send-button');
+    const messagesContainer = document.getElementById('messages-container');
+    const scrollDownBtn = document.getElementById('scroll-down');
+
+    // Больше сообщений в DOM не держим: остальные выгружаются и подгружаются при прокрутке
+    const MAX_RENDERED_MESSAGES = 200;
+    const PAGE_SIZE = 50;
+
+    let isAtBottom = true;
+    let lastMessageId = Number(messagesContainer.dataset.lastId);  // Курсор синхронизации
+    let oldestMessageId = Number(messagesContainer.dataset.oldestId);  // С какого id подгружать старые
+    let newestRenderedId = lastMessageId;  // Последнее показанное сообщение
+    let hasOlderMessages = oldestMessageId > 1;
+    let bottomTrimmed = false;  // Самые новые сообщения выгружены — пользователь читает старую историю
+    let loadingPage = false;
+    let socket = null;
+    let eventSource = null;
+    let polling = false;
+    let currentIP = messagesContainer.dataset.currentIp;  // IP текущего пользователя
+    const room = messagesContainer.dataset.room;  // Пусто — общая комната
+
+    // Добавляет комнату к адресу запроса
+    function withRoom(url) {
+        if (!room) return url;
+        return url + (url.includes('?') ? '&' : '?') + 'room=' + encodeURIComponent(room);
+    }
+
+    // Прокрутить вниз при загрузке
+    scrollToBottom();
+
+    // Проверка положения скролла
+    messagesContainer.addEventListener('scroll', function() {
+        const isBottom = messagesContainer.scrollTop + messagesContainer.clientHeight >= messagesContainer.scrollHeight - 50;
+        scrollDownBtn.classList.toggle('visible', !isBottom);
+        isAtBottom = isBottom;
+
+        // Дошли до верха — подгружаем более старые сообщения, до низа — выгруженные более новые
+        if (messagesContainer.scrollTop < 100) {
+            loadOlderMessages();
+        } else if (bottomTrimmed && isBottom) {
+            loadNewerMessages();
+        }
+    });
+
+    // Кнопка прокрутки вниз
+    scrollDownBtn.addEventListener('click', () => {
+        if (bottomTrimmed) {
+            jumpToLatest();
+        } else {
+            scrollToBottom();
+        }
+    });
+
+    function scrollToBottom() {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        scrollDownBtn.classList.remove('visible');
+        isAtBottom = true;
+    }
+
+    // Функция для отправки сообщения
+    async function sendMessage() {
+        const message = input.value.trim();
+        if (!message) return;
+
+        // По WebSocket сообщение уходит без отдельного HTTP-запроса, ответ придет кадром ack
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({ message }));
+            input.value = '';
+            input.focus();
+            return;
+        }
+
+        button.disabled = true;
+        input.disabled = true;
+
+        try {
+            const response = await fetch(withRoom('/message'), {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ message })
+            });
+
+            const data = await response.json();
+
+            if (data.status === 'success') {
+                input.value = '';
+                // Новое сообщение придет по потоку (или long-poll) сразу после записи
+            } else {
+                console.error("Ошибка отправки:", data.message);
+            }
+        } catch (error) {
+            console.error("Ошибка сети:", error);
+        } finally {
+            button.disabled = false;
+            input.disabled = false;
+            input.focus();
+        }
+    }
+
+    // Создает элемент сообщения
+    function createMessageElement(msg) {
+        const messageElement = document.createElement('div');
+
+        // "Свое" сообщение определяем по IP (до имени хоста в скобках)
+        const isOwn = msg.ip.split(' ')[0] === currentIP;
+
+        // Определяем класс сообщения
+        let msgClass = 'other';
+        if (isOwn) msgClass = 'own';
+        else if (msg.admin) msgClass = 'admin';
+
+        messageElement.className = `message ${msgClass}`;
+        messageElement.dataset.id = msg.id;
+
+        // Определяем отправителя
+        let sender = msg.ip;
+        if (isOwn) sender = 'Вы';
+        else if (msg.admin) sender = 'Админ';
+
+        // Формируем содержимое сообщения
+        let contentHTML = `
+            <div class="sender">${sender}</div>
+            <div class="content">${msg.message}</div>
+        `;
+
+        // Добавляем IP только для чужих сообщений
+        if (!isOwn && !msg.admin) {
+            contentHTML += `<div class="ip-display">IP: ${msg.ip}</div>`;
+        }
+
+        contentHTML += `
+            <div class="message-footer">
+                <div class="datetime">${msg.datetime}</div>
+            </div>
+        `;
+
+        messageElement.innerHTML = contentHTML;
+        return messageElement;
+    }
+
+    // Показанные сообщения по порядку
+    function renderedMessages() {
+        return messagesContainer.querySelectorAll('.message');
+    }
+
+    // Вставляет сообщения в конец чата
+    function renderAtBottom(messages) {
+        const noMessages = document.querySelector('.no-messages');
+        if (noMessages) {
+            noMessages.remove();
+        }
+
+        const fragment = document.createDocumentFragment();
+        for (const msg of messages) {
+            fragment.appendChild(createMessageElement(msg));
+        }
+        messagesContainer.appendChild(fragment);
+        newestRenderedId = messages[messages.length - 1].id;
+        if (!oldestMessageId) {
+            oldestMessageId = messages[0].id;
+        }
+    }
+
+    // Выгружает самые старые показанные сообщения сверх MAX_RENDERED_MESSAGES, не сдвигая видимый текст
+    function trimTop() {
+        const rendered = renderedMessages();
+        const extra = rendered.length - MAX_RENDERED_MESSAGES;
+        if (extra <= 0) return;
+
+        const previousHeight = messagesContainer.scrollHeight;
+        for (let i = 0; i < extra; i++) {
+            rendered[i].remove();
+        }
+        messagesContainer.scrollTop -= previousHeight - messagesContainer.scrollHeight;
+        oldestMessageId = Number(rendered[extra].dataset.id);
+        hasOlderMessages = true;
+    }
+
+    // Выгружает самые новые показанные сообщения сверх MAX_RENDERED_MESSAGES
+    function trimBottom() {
+        const rendered = renderedMessages();
+        const keep = MAX_RENDERED_MESSAGES;
+        if (rendered.length <= keep) return;
+
+        for (let i = keep; i < rendered.length; i++) {
+            rendered[i].remove();
+        }
+        newestRenderedId = Number(rendered[keep - 1].dataset.id);
+        bottomTrimmed = true;
+    }
+
+    // Добавляет новые сообщения в конец чата
+    function appendMessages(newMessages) {
+        // Пропускаем то, что уже показано (например, пришло и по потоку, и по опросу)
+        newMessages = newMessages.filter(msg => msg.id > lastMessageId);
+        if (newMessages.length === 0) return;
+
+        lastMessageId = newMessages[newMessages.length - 1].id;
+
+        // Пользователь читает старую историю — новые покажем, когда он вернется вниз
+        if (bottomTrimmed) {
+            scrollDownBtn.classList.add('visible');
+            return;
+        }
+
+        renderAtBottom(newMessages);
+
+        // Прокрутка к новому сообщению, если пользователь внизу
+        if (isAtBottom) {
+            trimTop();
+            scrollToBottom();
+        }
+    }
+
+    // Подгружает страницу более старых сообщений и вставляет ее в начало чата
+    async function loadOlderMessages() {
+        if (loadingPage || !hasOlderMessages) return;
+        loadingPage = true;
+        try {
+            const response = await fetch(withRoom(`/get-messages?before=${oldestMessageId}&limit=${PAGE_SIZE}`));
+            const data = await response.json();
+            hasOlderMessages = data.has_more;
+            if (data.history.length === 0) return;
+
+            // Сохраняем позицию прокрутки, чтобы текст не прыгал
+            const previousHeight = messagesContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            for (const msg of data.history) {
+                fragment.appendChild(createMessageElement(msg));
+            }
+            messagesContainer.insertBefore(fragment, messagesContainer.firstChild);
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+            oldestMessageId = data.history[0].id;
+            trimBottom();
+        } catch (error) {
+            console.error("Ошибка загрузки старых сообщений:", error);
+        } finally {
+            loadingPage = false;
+        }
+    }
+
+    // Подгружает выгруженные ранее более новые сообщения при прокрутке вниз
+    async function loadNewerMessages() {
+        if (loadingPage) return;
+        loadingPage = true;
+        try {
+            const response = await fetch(withRoom(`/get-messages?since=${newestRenderedId}&limit=${PAGE_SIZE}`));
+            const data = await response.json();
+            if (data.history.length > 0) {
+                renderAtBottom(data.history);
+                trimTop();
+            }
+            if (!data.has_more) {
+                // Догнали живой чат
+                bottomTrimmed = false;
+                lastMessageId = Math.max(lastMessageId, newestRenderedId);
+            }
+        } catch (error) {
+            console.error("Ошибка загрузки сообщений:", error);
+        } finally {
+            loadingPage = false;
+        }
+    }
+
+    // Возвращает к последним сообщениям, выбросив прочитанную старую историю
+    async function jumpToLatest() {
+        if (loadingPage) return;
+        loadingPage = true;
+        try {
+            const response = await fetch(withRoom(`/get-messages?before=${lastMessageId + 1}&limit=${PAGE_SIZE}`));
+            const data = await response.json();
+            for (const element of renderedMessages()) {
+                element.remove();
+            }
+            bottomTrimmed = false;
+            hasOlderMessages = data.has_more;
+            oldestMessageId = 0;
+            if (data.history.length > 0) {
+                renderAtBottom(data.history);
+            }
+            scrollToBottom();
+        } catch (error) {
+            console.error("Ошибка загрузки сообщений:", error);
+        } finally {
+            loadingPage = false;
+        }
+    }
+
+    // Функция для проверки новых сообщений (wait — сколько секунд сервер может ждать новых)
+    async function checkForNewMessages(wait = 0) {
+        const response = await fetch(withRoom(`/get-messages?since=${lastMessageId}&wait=${wait}`));
+        if (response.status === 429) {
+            // Превышен лимит запросов — ждем, сколько попросил сервер
+            const retryAfter = Number(response.headers.get('Retry-After')) || 1;
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            return;
+        }
+        const data = await response.json();
+
+        if (data.history && data.history.length > 0) {
+            // Сервер возвращает только сообщения новее курсора
+            appendMessages(data.history);
+        }
+
+        // Сдвигаем курсор (в том числе назад, если история на сервере была сброшена)
+        if (typeof data.last_id === 'number') {
+            lastMessageId = data.last_id;
+        }
+    }
+
+    // Запасной вариант: long-polling, если поток недоступен
+    async function startPolling() {
+        if (polling) return;
+        polling = true;
+        while (polling) {
+            try {
+                await checkForNewMessages(25);
+            } catch (error) {
+                console.error("Ошибка при проверке новых сообщений:", error);
+                // Не долбим сервер, если он недоступен
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+    }
+
+    // Если WebSocket недоступен: Server-Sent Events
+    function startStream() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+
+        eventSource = new EventSource(withRoom(`/stream?since=${lastMessageId}`));
+
+        eventSource.onmessage = (event) => {
+            appendMessages([JSON.parse(event.data)]);
+        };
+
+        // История на сервере была сброшена — переносим курсор назад
+        eventSource.addEventListener('reset', (event) => {
+            lastMessageId = JSON.parse(event.data).last_id;
+        });
+
+        eventSource.onerror = () => {
+            // Временные обрывы EventSource переподключает сам; если браузер сдался — переходим на опрос
+            if (eventSource.readyState === EventSource.CLOSED) {
+                eventSource = null;
+                startPolling();
+            }
+        };
+    }
+
+    // Основной канал: WebSocket — и отправка, и получение по одному соединению
+    function startSocket() {
+        if (!window.WebSocket) {
+            startStream();
+            return;
+        }
+
+        const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const ws = new WebSocket(withRoom(`${protocol}//${location.host}/ws?since=${lastMessageId}`));
+        let opened = false;
+
+        ws.onopen = () => {
+            opened = true;
+            socket = ws;
+        };
+
+        ws.onmessage = (event) => {
+            const frame = JSON.parse(event.data);
+            if (frame.type === 'message') {
+                appendMessages([frame.message]);
+            } else if (frame.type === 'reset') {
+                // История на сервере была сброшена — переносим курсор назад
+                lastMessageId = frame.last_id;
+            } else if (frame.type === 'ack' && frame.status !== 'success') {
+                console.error("Ошибка отправки:", frame.message);
+            }
+        };
+
+        ws.onclose = () => {
+            socket = null;
+            if (!opened) {
+                // Сервер не поддерживает WebSocket (или его режет прокси) — переходим на поток
+                startStream();
+                return;
+            }
+            // Обрыв — переподключаемся, курсор сервер получит в адресе
+            setTimeout(startSocket, 1000);
+        };
+    }
+
+    startSocket();
+
+    // Обработчики событий
+    button.addEventListener('click', sendMessage);
+
+    input.addEventListener('keypress', (e) => {
+        if (e.key === 'Enter') {
+            sendMessage();
+        }
+    });
+
+    // Автофокус на поле ввода
+    input.focus();
+
+    // Закрываем соединения при закрытии страницы
+    window.addEventListener('beforeunload', () => {
+        polling = false;
+        if (socket) {
+            socket.onclose = null;
+            socket.close();
+        }
+        if (eventSource) {
+            eventSource.close();
+        }
+    });
+});
@@ -0,0 +1,59 @@
+import asyncio
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def wapp(tmp_path_factory):
+    """Модуль приложения. При импорте он открывает хранилище в текущей папке — импортируем во временной"""
+    os.chdir(tmp_path_factory.mktemp('messenger'))
+    sys.path.insert(0, ROOT)
+    module = importlib.import_module('wapp')
+    yield module
+    # Дописываем очередь на диск, пока текущая папка еще временная
+    module.stop_persistence()
+
+
+@pytest.fixture
+def client(wapp, monkeypatch):
+    """Тестовый клиент Flask; имена хостов не ищем, чтобы тесты не ходили в DNS"""
+    monkeypatch.setattr(wapp, 'RESOLVE_HOSTNAMES', False)
+    return wapp.app.test_client()
+
+
+def make_message(number, **fields):
+    """Сообщение с id number в том виде, в каком его сохраняет log_message()"""
+    message = {'datetime': '01.01.2025 00:00', 'method': 'POST', 'message': f"сообщение номер {number}",
+               'ip': '10.0.0.1', 'admin': False, 'ts': 1735689600 + number, 'id': number}
+    message.update(fields)
+    return message
+
+
+def parse_ndjson(chunks):
+    """Сообщения из кусков NDJSON, которые отдают archived() и export()"""
+    return [json.loads(line) for line in b''.join(chunks).splitlines()]
+
+
+def asgi_request(wapp, method, path, query=b'', body=b'', client='10.2.0.4', headers=()):
+    """Запрос к asgi_app: (статус, тело)"""
+    async def run():
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(event):
+            sent.append(event)
+
+        await wapp.asgi_app({'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': list(headers),
+                             'client': (client, 1)}, receive, send)
+        return sent[0]['status'], b''.join(event.get('body', b'') for event in sent[1:])
+
+    return asyncio.run(run())
@@ -0,0 +1,115 @@
+import json
+import os
+
+import pytest
+
+from conftest import make_message, parse_ndjson
+
+
+@pytest.fixture
+def archive(wapp, tmp_path, monkeypatch):
+    monkeypatch.setattr(wapp, 'ARCHIVE_SEGMENT_SIZE', 10)
+    archive = wapp.Archive(str(tmp_path / 'archive'))
+    messages = [make_message(number) for number in range(1, 36)]
+    # Пачки разного размера: первая пересекает границу сегмента, вторая больше целого сегмента
+    for start, stop in ((0, 13), (13, 35)):
+        archive.add([wapp.history_entry(msg, wapp.encode_message(msg)) for msg in messages[start:stop]])
+    yield archive
+    archive.close()
+
+
+def ids(chunks):
+    return [msg['id'] for msg in parse_ndjson(chunks)]
+
+
+def test_sealed_segments(archive):
+    # Три сжатых сегмента по 10 сообщений и открытый с остальными пятью
+    assert [(index['first_id'], index['last_id'], index['count']) for index in archive.segments] == \
+        [(1, 10, 10), (11, 20, 10), (21, 30, 10)]
+    assert archive.open_index['count'] == 5
+    assert archive.last_id() == 35
+    files = sorted(os.listdir(archive.directory))
+    assert '000000000011-000000000020.jsonl.gz' in files
+    assert '000000000011-000000000020.idx.json' in files
+
+
+@pytest.mark.parametrize('low, high', [(1, 35), (5, 27), (11, 20), (10, 11), (28, 33), (33, 100), (0, 0), (36, 50)])
+def test_read_by_id(archive, low, high):
+    assert ids(archive.read(low, high)) == list(range(max(low, 1), min(high, 35) + 1))
+
+
+def test_read_by_time(archive):
+    first_ts = make_message(1)['ts']
+    assert ids(archive.read(first_ts + 6, first_ts + 24, by_time=True)) == list(range(7, 26))
+    assert ids(archive.read(0, first_ts - 1, by_time=True)) == []
+
+
+def test_reopen(wapp, archive):
+    archive.close()
+    reopened = wapp.Archive(archive.directory)
+    try:
+        assert reopened.last_id() == 35
+        assert ids(reopened.read(8, 32)) == list(range(8, 33))
+        # Уже заархивированные id второй раз не попадают
+        reopened.add([wapp.history_entry(msg, wapp.encode_message(msg)) for msg in map(make_message, range(30, 38))])
+        assert ids(reopened.read(0, 100)) == list(range(1, 38))
+    finally:
+        reopened.close()
+
+
+def test_reopen_after_crash_during_seal(wapp, archive, monkeypatch):
+    # Сервер упал после сжатия сегмента, но до удаления открытого: сообщения 31-35 уже в сегменте
+    archive.close()
+    monkeypatch.setattr(wapp, 'ARCHIVE_SEGMENT_SIZE', 5)
+    reopened = wapp.Archive(archive.directory)
+    reopened.add([wapp.history_entry(msg, wapp.encode_message(msg)) for msg in map(make_message, range(36, 41))])
+    reopened.close()
+    with open(os.path.join(archive.directory, wapp.Archive.OPEN_SEGMENT), 'wb') as f:
+        f.writelines(wapp.encode_message(make_message(number)) + b'\n' for number in range(31, 43))
+    recovered = wapp.Archive(archive.directory)
+    try:
+        assert recovered.open_index['first_id'] == 41
+        assert ids(recovered.read(0, 100)) == list(range(1, 43))
+    finally:
+        recovered.close()
+
+
+@pytest.mark.parametrize('sealed', [False, True])
+def test_read_by_time_with_unordered_timestamps(wapp, tmp_path, monkeypatch, sealed):
+    # Часы переводили назад: время внутри сегмента не растет вместе с id
+    monkeypatch.setattr(wapp, 'ARCHIVE_SEGMENT_SIZE', 5 if sealed else 10)
+    archive = wapp.Archive(str(tmp_path / 'archive'))
+    messages = [make_message(number, ts=ts) for number, ts in enumerate([100, 200, 50, 300, 400], 1)]
+    try:
+        archive.add([wapp.history_entry(msg, wapp.encode_message(msg)) for msg in messages])
+        assert bool(archive.segments) == sealed
+        assert ids(archive.read(40, 60, by_time=True)) == [3]
+        assert ids(archive.read(150, 350, by_time=True)) == [2, 4]
+        assert ids(archive.read(0, 1000, by_time=True)) == [1, 2, 3, 4, 5]
+    finally:
+        archive.close()
+    if sealed:
+        reopened = wapp.Archive(str(tmp_path / 'archive'))
+        try:
+            assert ids(reopened.read(40, 60, by_time=True)) == [3]
+        finally:
+            reopened.close()
+
+
+def test_read_by_time_with_old_index(wapp, archive):
+    # Индекс, записанный до появления min_ts/max_ts
+    archive.close()
+    for name in os.listdir(archive.directory):
+        if name.endswith('.idx.json'):
+            path = os.path.join(archive.directory, name)
+            with open(path) as f:
+                index = json.load(f)
+            index['first_ts'], index['last_ts'] = index.pop('min_ts'), index.pop('max_ts')
+            with open(path, 'w') as f:
+                json.dump(index, f)
+    reopened = wapp.Archive(archive.directory)
+    try:
+        first_ts = make_message(1)['ts']
+        assert ids(reopened.read(first_ts + 6, first_ts + 24, by_time=True)) == list(range(7, 26))
+    finally:
+        reopened.close()
@@ -0,0 +1,130 @@
+import os
+import random
+
+import pytest
+
+
+def write_blocklist(path, terms, mtime):
+    path.write_text(''.join(term + '\n' for term in terms), encoding='utf-8')
+    # Время изменения задаем явно: две записи подряд могут попасть в один тик часов файловой системы
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_blocklist_logs_only_state_changes(wapp, tmp_path, capsys):
+    path = tmp_path / 'blocklist.txt'
+    blocklist = wapp.Blocklist(str(path))
+    for _ in range(3):
+        blocklist.reload()
+    assert capsys.readouterr().out.count('Ошибка загрузки списка запрещенных слов') == 1
+
+    write_blocklist(path, ['spam'], 10 ** 18)
+    blocklist.reload()
+    blocklist.reload()
+    assert capsys.readouterr().out.count('снова загружен') == 1
+    assert blocklist.filter.search('no spam here')
+
+    # Файл пропал — автомат остается прежним, ошибка снова пишется один раз
+    path.unlink()
+    blocklist.reload()
+    blocklist.reload()
+    assert capsys.readouterr().out.count('Ошибка загрузки') == 1
+    assert blocklist.filter.search('spam')
+
+
+def test_rejected_message_is_not_remembered_as_duplicate(wapp, tmp_path, monkeypatch):
+    path = tmp_path / 'blocklist.txt'
+    write_blocklist(path, ['spam'], 10 ** 18)
+    blocklist = wapp.Blocklist(str(path))
+    monkeypatch.setattr(wapp, 'blocklist', blocklist)
+    monkeypatch.setattr(wapp, 'FILTER_ACTION', 'reject')
+    monkeypatch.setattr(wapp, 'duplicates', wapp.DuplicateDetector(60, 100))
+    monkeypatch.setattr(wapp, 'post_limiter', wapp.RateLimiter(0, 0))
+    monkeypatch.setattr(wapp, 'RESOLVE_HOSTNAMES', False)
+    store = wapp.MemoryStore(str(tmp_path / 'history.json'), str(tmp_path / 'history.jsonl'))
+    try:
+        with pytest.raises(wapp.MessageRejected):
+            wapp.submit_message(store, 'POST', 'Buy SPAM', '10.5.0.1')
+        # Слово убрали из списка: то же сообщение принимается, повтором его не считают
+        write_blocklist(path, ['scam'], 2 * 10 ** 18)
+        blocklist.reload()
+        assert wapp.submit_message(store, 'POST', 'buy spam', '10.5.0.1') == 'buy spam'
+        assert [msg.message for msg in store.recent(10)] == ['buy spam']
+        # А принятое сообщение в окне повторов есть
+        wapp.submit_message(store, 'POST', 'другое', '10.5.0.1')
+        with pytest.raises(wapp.RateLimited):
+            wapp.submit_message(store, 'POST', 'Buy spam', '10.5.0.1')
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('text, masked', [
+    # Слова одного алфавита не сводятся к другому: русское слово не находится внутри английских и наоборот
+    ('mexico city', 'mexico city'),
+    ('Мехико', '***ико'),
+    ('capital', '***ital'),
+    ('сарай', 'сарай'),
+    # Смесь алфавитов в слове — подмена букв: ловим и латинское, и русское слово
+    ('pоrn', '****'),
+    ('a pοrn b', 'a **** b'),
+    ('МЕx', '***'),
+    ('cаp и мех в mexico', '*** и *** в mexico'),
+])
+def test_homoglyphs_fold_only_mixed_script_words(wapp, text, masked):
+    content_filter = wapp.ContentFilter(['мех', 'cap', 'porn'])
+    assert content_filter.mask(text) == masked
+    assert content_filter.search(text) == (masked != text)
+
+
+def test_automaton_finds_every_occurrence(wapp):
+    # Слова-суффиксы и пересекающиеся слова находятся по ссылкам неудач
+    terms = ['he', 'she', 'his', 'hers', 'usher']
+    content_filter = wapp.ContentFilter(terms)
+    text = 'ushers and his shehers'
+    expected = sorted((start, start + len(term)) for term in terms
+                      for start in range(len(text)) if text.startswith(term, start))
+    assert sorted(content_filter.matches(text)) == expected
+    assert content_filter.size == 5
+
+
+def test_automaton_matches_naive_search(wapp):
+    rnd = random.Random(7)
+    terms = [''.join(rnd.choice('abc') for _ in range(rnd.randint(1, 4))) for _ in range(30)]
+    content_filter = wapp.ContentFilter(terms)
+    for _ in range(200):
+        text = ''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 30)))
+        expected = sorted({(start, start + len(term)) for term in terms
+                           for start in range(len(text)) if text.startswith(term, start)})
+        assert sorted(content_filter.matches(text)) == expected
+        assert content_filter.search(text) == bool(expected)
+
+
+def test_mask_keeps_length_and_case(wapp):
+    content_filter = wapp.ContentFilter(['Spam', 'am i', 'х'])
+    assert content_filter.mask('SPAM I AM') == '****** AM'
+    assert content_filter.mask('SPAM') == '****'
+    assert content_filter.mask('ok') == 'ok'
+    # Буква, у которой нижний регистр длиннее, не сдвигает позиции
+    assert content_filter.mask('İ spam') == 'İ ****'
+    assert wapp.ContentFilter(['']).size == 0
+
+
+def test_blocklist_hot_reload(wapp, tmp_path, monkeypatch):
+    monkeypatch.setattr(wapp, 'FILTER_RELOAD_INTERVAL', 0)
+    path = tmp_path / 'blocklist.txt'
+    write_blocklist(path, ['# комментарий', 'spam', '  scam  ', ''], 10 ** 18)
+    blocklist = wapp.Blocklist(str(path))
+    first = blocklist.current()
+    assert first.size == 2
+    assert first.search('SCAM') and not first.search('комментарий')
+    # Файл не менялся — автомат тот же
+    assert blocklist.current() is first
+
+    write_blocklist(path, ['eggs'], 2 * 10 ** 18)
+    second = blocklist.current()
+    assert second is not first
+    assert second.search('eggs') and not second.search('spam')
+
+    # Проверка не чаще FILTER_RELOAD_INTERVAL
+    monkeypatch.setattr(wapp, 'FILTER_RELOAD_INTERVAL', 3600)
+    write_blocklist(path, ['ham'], 3 * 10 ** 18)
+    assert blocklist.current() is second
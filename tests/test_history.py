@@ -0,0 +1,76 @@
+import threading
+
+from conftest import make_message
+
+
+def entry(wapp, number):
+    message = make_message(number)
+    return wapp.history_entry(message, wapp.encode_message(message))
+
+
+def test_window_keeps_last_entries(wapp):
+    log = wapp.HistoryLog(300)
+    evicted = log.extend(entry(wapp, number) for number in range(1, 1001))
+    view = log.view
+    assert len(view) == 300
+    assert [item[0] for item in view.slice()] == list(range(701, 1001))
+    assert [item[0] for item in evicted] == list(range(1, 701))
+    assert view.position(800) == 100
+    assert view.last_id() == 1000
+
+
+def test_snapshot_survives_eviction(wapp):
+    log = wapp.HistoryLog(300)
+    log.extend(entry(wapp, number) for number in range(1, 301))
+    snapshot = log.view
+    # Окно сдвигается на много кусков вперед — старый снимок читает свои записи как прежде
+    log.extend(entry(wapp, number) for number in range(301, 2001))
+    assert [item[0] for item in snapshot.slice()] == list(range(1, 301))
+    assert snapshot[-1][0] == 300
+    assert [item[0] for item in log.view.slice()] == list(range(1701, 2001))
+
+
+def test_readers_during_eviction(wapp):
+    log = wapp.HistoryLog(500)
+    total = 20000
+    entries = [entry(wapp, number) for number in range(1, total + 1)]
+    errors = []
+    done = threading.Event()
+
+    def reader():
+        while not done.is_set():
+            view = log.view
+            ids = [item[0] for item in view.slice()]
+            if not ids:
+                continue
+            # Снимок всегда целый: id подряд, не больше окна, индексы и поиск по id согласованы
+            if len(ids) > 500 or ids != list(range(ids[0], ids[0] + len(ids))) \
+                    or view[-1][0] != ids[-1] or view.position(ids[0]) != 1:
+                errors.append(ids)
+                return
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    for start in range(0, total, 7):
+        log.extend(entries[start:start + 7])
+    done.set()
+    for thread in readers:
+        thread.join()
+    assert not errors
+    assert [item[0] for item in log.view.slice()] == list(range(total - 499, total + 1))
+
+
+def test_replace_and_clear(wapp):
+    log = wapp.HistoryLog(1000)
+    log.extend(entry(wapp, number) for number in range(1, 301))
+    replacement = wapp.history_entry(make_message(5, ip='10.0.0.2'), b'{}')
+    log.replace(4, replacement)
+    assert log.view[4] is replacement
+    assert len(log.view) == 300
+
+    cleared = log.view
+    log.clear()
+    log.extend(entry(wapp, number) for number in range(301, 311))
+    assert len(cleared) == 300
+    assert [item[0] for item in log.view.slice()] == list(range(301, 311))
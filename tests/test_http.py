@@ -0,0 +1,112 @@
+import gzip
+import itertools
+
+import pytest
+from werkzeug.http import parse_accept_header
+
+from conftest import asgi_request, make_message
+
+room_numbers = itertools.count()
+
+
+@pytest.fixture
+def room(wapp, client, monkeypatch):
+    """Новая комната с 50 сообщениями (ответ с историей больше COMPRESS_MIN_SIZE)"""
+    monkeypatch.setattr(wapp, 'poll_limiter', wapp.RateLimiter(0, 0))
+    name = f"http{next(room_numbers)}"
+    body = b''.join(wapp.encode_message(make_message(number)) + b'\n' for number in range(1, 51))
+    # Импорт доступен только администратору — тестовый клиент приходит с 127.0.0.1
+    assert client.post(f"/import?room={name}", data=body).get_json()['imported'] == 50
+    return name
+
+
+def test_unchanged_history_answers_304(client, room):
+    url = f"/get-messages?room={room}&since=40"
+    first = client.get(url)
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and etag.startswith('W/"h50-')
+    assert first.headers['Cache-Control'] == 'no-cache'
+
+    cached = client.get(url, headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+    assert cached.headers['ETag'] == etag
+    # Компактный формат — другой ответ и другой ETag
+    assert client.get(url + '&format=compact', headers={'If-None-Match': etag}).status_code == 200
+
+    client.post(f"/message?room={room}", json={'message': 'новое'}, environ_base={'REMOTE_ADDR': '10.8.0.1'})
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.get_json()['history'][-1]['message'] == 'новое'
+
+
+def test_history_page_answers_304(client, room):
+    url = f"/get-messages?room={room}&before=30&limit=5"
+    etag = client.get(url).headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_gzip_negotiation(wapp, client, room):
+    url = f"/get-messages?room={room}"
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    assert len(plain.data) >= wapp.COMPRESS_MIN_SIZE
+
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
+    assert len(compressed.data) < len(plain.data)
+    # Строгий ETag сжатого ответа стал бы неверным — он слабый
+    assert compressed.headers['ETag'].startswith('W/')
+
+    # Маленький ответ не сжимается, отказ от gzip уважается
+    small = client.get(f"{url}&since=49", headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+    assert 'Content-Encoding' not in client.get(url, headers={'Accept-Encoding': 'gzip;q=0'}).headers
+
+
+def test_compressed_bodies_are_cached(wapp, client, room):
+    url = f"/get-messages?room={room}"
+    wapp.compressed_cache.clear()
+    first = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert len(wapp.compressed_cache) == 1
+    assert client.get(url, headers={'Accept-Encoding': 'gzip'}).data == first.data
+    assert len(wapp.compressed_cache) == 1
+
+
+@pytest.mark.parametrize('header, with_brotli, expected', [
+    ('gzip, deflate, br', False, 'gzip'),
+    ('gzip, deflate, br', True, 'br'),
+    ('br;q=0, gzip', True, 'gzip'),
+    ('gzip;q=0', True, None),
+    ('identity', True, None),
+    ('', True, None),
+])
+def test_choose_encoding(wapp, monkeypatch, header, with_brotli, expected):
+    # Выбор смотрит только на то, есть ли модуль brotli
+    monkeypatch.setattr(wapp, 'brotli', object() if with_brotli else None)
+    assert wapp.choose_encoding(parse_accept_header(header)) == expected
+
+
+def test_brotli_round_trip(wapp, client, room, monkeypatch):
+    brotli = pytest.importorskip('brotli')
+    monkeypatch.setattr(wapp, 'brotli', brotli)
+    url = f"/get-messages?room={room}"
+    response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == client.get(url).data
+
+
+def test_asgi_gzip_and_304(wapp, client, room):
+    query = f"room={room}".encode()
+    status, body = asgi_request(wapp, 'GET', '/get-messages', query, headers=[(b'accept-encoding', b'gzip')])
+    assert status == 200
+    assert body[:2] == b'\x1f\x8b'
+    plain = asgi_request(wapp, 'GET', '/get-messages', query)[1]
+    assert gzip.decompress(body) == plain
+    # ETag у обоих режимов один и тот же — версия истории
+    etag = client.get(f"/get-messages?room={room}").headers['ETag']
+    assert asgi_request(wapp, 'GET', '/get-messages', query, headers=[(b'if-none-match', etag.encode())]) == (304, b'')
+
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+
+class Clock:
+    """Подменяет модуль time в wapp: monotonic() идет, только когда его сдвигают"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(wapp, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(wapp, 'time', clock)
+    return clock
+
+
+def test_rate_limiter_burst_and_refill(wapp, clock):
+    limiter = wapp.RateLimiter(rate=2, burst=3)
+    assert [limiter.take('10.6.0.1') for _ in range(3)] == [0, 0, 0]
+    assert limiter.take('10.6.0.1') == pytest.approx(0.5)
+    # Другой клиент — своя корзина
+    assert limiter.take('10.6.0.2') == 0
+
+    clock.now += 0.5
+    assert limiter.take('10.6.0.1') == 0
+    assert limiter.take('10.6.0.1') == pytest.approx(0.5)
+
+    # Корзина наполняется не больше чем до burst
+    clock.now += 100
+    assert [limiter.take('10.6.0.1') for _ in range(4)][-1] == pytest.approx(0.5)
+
+
+def test_rate_limiter_cost_and_disabled(wapp, clock):
+    limiter = wapp.RateLimiter(rate=1, burst=2)
+    assert limiter.take('10.6.0.3', cost=2) == 0
+    assert limiter.take('10.6.0.3', cost=2) == pytest.approx(2)
+    assert all(wapp.RateLimiter(rate=0, burst=0).take('10.6.0.3') == 0 for _ in range(100))
+
+
+def test_rate_limiter_table_is_bounded(wapp, clock):
+    limiter = wapp.RateLimiter(rate=1, burst=1, max_clients=2)
+    for key in ('a', 'b', 'c'):
+        assert limiter.take(key) == 0
+    assert list(limiter.buckets) == ['b', 'c']
+    # Вытесненный клиент начинает с полной корзины
+    assert limiter.take('a') == 0
+    assert len(limiter.buckets) == 2
+
+    # Наполнившиеся корзины удаляются при следующем запросе
+    clock.now += 1
+    limiter.take('d')
+    assert list(limiter.buckets) == ['d']
+
+
+def test_duplicate_detector_window(wapp, clock):
+    detector = wapp.DuplicateDetector(window=10, max_entries=100)
+    assert detector.check('10.6.0.4', 'Привет') == 0
+    # Регистр и пробелы по краям не делают сообщение новым; повтор ловится и через другие сообщения
+    assert detector.check('10.6.0.4', 'другое') == 0
+    clock.now += 4
+    assert detector.check('10.6.0.4', '  привет ') == pytest.approx(6)
+    # У другого клиента свои сообщения
+    assert detector.check('10.6.0.5', 'Привет') == 0
+
+    clock.now += 6
+    assert detector.check('10.6.0.4', 'Привет') == 0
+    assert detector.check('10.6.0.4', 'Привет') == pytest.approx(10)
+
+
+def test_duplicate_detector_is_bounded(wapp, clock):
+    detector = wapp.DuplicateDetector(window=10, max_entries=3)
+    for number in range(5):
+        assert detector.check('10.6.0.6', f"сообщение {number}") == 0
+    assert len(detector.seen) <= 3
+    # Самые старые забыты, последние помнятся
+    assert detector.check('10.6.0.6', 'сообщение 0') == 0
+    assert detector.check('10.6.0.6', 'сообщение 4') > 0
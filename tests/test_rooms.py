@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+from conftest import asgi_request
+
+
+def room_files(wapp, name):
+    if not os.path.isdir(wapp.ROOMS_DIR):
+        return []
+    return [entry for entry in os.listdir(wapp.ROOMS_DIR) if entry.startswith(name + '.')]
+
+
+def test_reading_missing_room_creates_nothing(wapp, client):
+    assert client.get('/r/ghost').status_code == 200
+    response = client.get('/get-messages?room=ghost&since=0')
+    assert response.status_code == 200
+    assert response.get_json() == {'history': [], 'last_id': 0}
+    for url in ('/stream?room=ghost', '/search?room=ghost&q=x', '/archive?room=ghost', '/admin-message?room=ghost'):
+        assert client.get(url).status_code == 404, url
+    assert 'ghost' not in wapp.rooms.rooms
+    assert not wapp.rooms.exists('ghost')
+    assert room_files(wapp, 'ghost') == []
+
+
+def test_first_message_creates_room(wapp, client):
+    response = client.post('/message?room=fresh', json={'message': 'первое'}, environ_base={'REMOTE_ADDR': '10.2.0.1'})
+    assert response.status_code == 200
+    assert wapp.rooms.exists('fresh')
+    history = client.get('/get-messages?room=fresh').get_json()['history']
+    assert [msg['message'] for msg in history] == ['первое']
+
+
+def test_import_by_non_admin_does_not_create_room(wapp, client):
+    response = client.post('/import?room=stranger', data=b'{"id": 1, "message": "x"}\n',
+                           environ_base={'REMOTE_ADDR': '10.2.0.2'})
+    assert response.status_code == 403
+    assert not wapp.rooms.exists('stranger')
+
+
+def test_room_limit(wapp, client, monkeypatch):
+    monkeypatch.setattr(wapp, 'MAX_ROOMS', len(wapp.rooms.known))
+    response = client.post('/message?room=overflow', json={'message': 'x'}, environ_base={'REMOTE_ADDR': '10.2.0.3'})
+    assert response.status_code == 503
+    assert not wapp.rooms.exists('overflow')
+    # В уже существующие комнаты писать можно
+    response = client.post('/message', json={'message': 'в основную'}, environ_base={'REMOTE_ADDR': '10.2.0.3'})
+    assert response.status_code == 200
+
+
+def test_rooms_found_on_disk(wapp, tmp_path, monkeypatch):
+    monkeypatch.setattr(wapp, 'ROOMS_DIR', str(tmp_path / 'rooms'))
+    os.makedirs(os.path.join(wapp.ROOMS_DIR, 'old.archive'))
+    open(os.path.join(wapp.ROOMS_DIR, 'other.jsonl'), 'w').close()
+    open(os.path.join(wapp.ROOMS_DIR, 'bad name.jsonl'), 'w').close()
+    assert wapp.rooms_on_disk() == {'old', 'other'}
+    assert wapp.room_on_disk('old') and not wapp.room_on_disk('ghost')
+
+
+def test_asgi_missing_room(wapp):
+    assert asgi_request(wapp, 'GET', '/get-messages', b'room=asgi-ghost') == (200, b'{"history":[],"last_id":0}')
+    assert asgi_request(wapp, 'GET', '/stream', b'room=asgi-ghost')[0] == 404
+    assert asgi_request(wapp, 'GET', '/export', b'room=asgi-ghost', client='127.0.0.1')[0] == 404
+    assert asgi_request(wapp, 'POST', '/import', b'room=asgi-ghost', b'{"id": 1, "message": "x"}\n')[0] == 403
+    assert not wapp.rooms.exists('asgi-ghost')
+    status, _ = asgi_request(wapp, 'POST', '/message', b'room=asgi-ghost', b'{"message": "x"}')
+    assert status == 200
+    assert wapp.rooms.exists('asgi-ghost')
+
+
+def test_long_poll_waits_for_room_creation(wapp, monkeypatch):
+    monkeypatch.setattr(wapp, 'ROOM_WAIT_INTERVAL', 0.05)
+
+    def create_room():
+        wapp.rooms.release(wapp.rooms.acquire('late', create=True))
+
+    timer = threading.Timer(0.3, create_room)
+    timer.start()
+    started = time.monotonic()
+    status, body = asgi_request(wapp, 'GET', '/get-messages', b'room=late&since=0&wait=10')
+    timer.join()
+    assert status == 200
+    assert time.monotonic() - started < 5
+    assert wapp.rooms.exists('late')
+
+
+def test_slow_room_load_does_not_block_others(wapp, monkeypatch):
+    loaded = []
+    release_load = threading.Event()
+
+    class SlowRoom(wapp.Room):
+        def __init__(self, name):
+            loaded.append(name)
+            if name == 'slow':
+                release_load.wait(5)
+            super().__init__(name)
+
+    monkeypatch.setattr(wapp, 'Room', SlowRoom)
+    results = []
+    loaders = [threading.Thread(target=lambda: results.append(wapp.rooms.acquire('slow', create=True)))
+               for _ in range(3)]
+    for thread in loaders:
+        thread.start()
+    time.sleep(0.1)
+    # Пока 'slow' грузится, остальные комнаты открываются без ожидания
+    started = time.monotonic()
+    quick = wapp.rooms.acquire('quick', create=True)
+    default = wapp.rooms.acquire(wapp.DEFAULT_ROOM)
+    assert time.monotonic() - started < 1
+    release_load.set()
+    for thread in loaders:
+        thread.join()
+    assert loaded.count('slow') == 1
+    assert len(results) == 3 and all(room is results[0] for room in results)
+    assert results[0].clients == 3
+    for room in (*results, quick, default):
+        wapp.rooms.release(room)
@@ -0,0 +1,87 @@
+import pytest
+
+from conftest import asgi_request
+
+
+@pytest.mark.parametrize('body', [{}, {'message': None}, {'message': 5}, {'message': ['текст']}, ['текст'], 'текст'])
+def test_message_without_text_is_rejected(client, body):
+    response = client.post('/message', json=body, environ_base={'REMOTE_ADDR': '10.1.0.1'})
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
+
+
+def test_message_accepted(client):
+    response = client.post('/message', json={'message': 'привет'}, environ_base={'REMOTE_ADDR': '10.1.0.2'})
+    assert response.status_code == 200
+    assert response.get_json()['your_message'] == 'привет'
+
+
+def test_import_rejects_huge_ids(wapp, client):
+    body = b'{"id": 1, "message": "a"}\n{"id": 9223372036854775807, "message": "b"}\n{"id": 3, "message": "c"}\n'
+    response = client.post('/import?room=bigid', data=body)
+    assert response.status_code == 400
+    assert response.get_json()['imported'] == 0
+    # Пачка с таким id не записана, новые сообщения получают обычные id
+    response = client.post('/message?room=bigid', json={'message': 'после'}, environ_base={'REMOTE_ADDR': '10.1.0.3'})
+    assert response.status_code == 200
+    assert client.get('/get-messages?room=bigid').get_json()['last_id'] == 1
+
+
+@pytest.mark.parametrize('remote, forwarded, expected', [
+    ('10.4.0.1', None, '10.4.0.1'),
+    # Заголовок от клиента напрямую ничего не значит
+    ('10.4.0.1', '127.0.0.1', '10.4.0.1'),
+    # От доверенного прокси — клиент первый справа не из прокси
+    ('127.0.0.1', '10.4.0.2', '10.4.0.2'),
+    ('127.0.0.1', '127.0.0.1, 10.4.0.3', '10.4.0.3'),
+    ('127.0.0.1', '10.4.0.4, 127.0.0.1', '10.4.0.4'),
+    ('127.0.0.1', None, '127.0.0.1'),
+])
+def test_client_address(wapp, remote, forwarded, expected):
+    assert wapp.client_address(remote, forwarded) == expected
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('10.4.0.1', '10.4.0.1'),
+    ('10.4.0.1:5000', '10.4.0.1'),
+    ('2001:db8::5', '2001:db8::5'),
+    ('2001:DB8:0::5', '2001:db8::5'),
+    ('::1', '::1'),
+    ('[::1]:443', '::1'),
+    ('[2001:db8::5]', '2001:db8::5'),
+    ('fe80::1%eth0', 'fe80::1%eth0'),
+    ('[fe80::1%eth0]:8080', 'fe80::1%eth0'),
+    ('::ffff:10.4.0.1', '10.4.0.1'),
+    ('unknown', 'unknown'),
+])
+def test_normalize_ip(wapp, address, expected):
+    assert wapp.normalize_ip(address) == expected
+
+
+def test_ipv6_clients_are_told_apart(wapp):
+    # Адреса из одной /16 — разные клиенты с разными ведрами лимитов
+    limiter = wapp.RateLimiter(rate=0.001, burst=1)
+    first, second = wapp.normalize_ip('2001:db8::5'), wapp.normalize_ip('2001:db8::6')
+    assert first != second
+    assert limiter.take(first) == 0
+    assert limiter.take(second) == 0
+    assert limiter.take(first) > 0
+    # Локальный прокси по IPv6 тоже доверенный
+    assert wapp.client_address('::1', '2001:db8::7') == '2001:db8::7'
+    assert wapp.client_address('[::1]:51000', '[2001:db8::8]:1234') == '2001:db8::8'
+
+
+def test_admin_gate_ignores_forged_forwarded_for(client):
+    forged = {'X-Forwarded-For': '127.0.0.1'}
+    assert client.get('/export', headers=forged, environ_base={'REMOTE_ADDR': '10.4.0.5'}).status_code == 403
+    assert client.post('/import', data=b'', headers=forged, environ_base={'REMOTE_ADDR': '10.4.0.5'}).status_code == 403
+    # Через локальный прокси, который дописал настоящий адрес клиента
+    proxied = {'X-Forwarded-For': '127.0.0.1, 10.4.0.5'}
+    assert client.get('/export', headers=proxied).status_code == 403
+    assert client.get('/export').status_code == 200
+
+
+def test_asgi_admin_gate_ignores_forged_forwarded_for(wapp):
+    forged = [(b'x-forwarded-for', b'127.0.0.1')]
+    assert asgi_request(wapp, 'GET', '/export', client='10.4.0.6', headers=forged)[0] == 403
+    assert asgi_request(wapp, 'GET', '/export', client='127.0.0.1')[0] == 200
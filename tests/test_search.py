@@ -0,0 +1,29 @@
+import threading
+
+from conftest import make_message
+
+
+def test_postings_stay_sorted_under_concurrent_appends(wapp, tmp_path):
+    store = wapp.MemoryStore(str(tmp_path / 'history.json'), str(tmp_path / 'history.jsonl'), max_size=100000)
+
+    def writer(number):
+        for count in range(500):
+            message = make_message(0, message=f"общее слово {number} {count}")
+            del message['id']
+            store.append(message)
+
+    threads = [threading.Thread(target=writer, args=(number,)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    closed = threading.Event()
+    wapp.persist_queue.put((store, None, closed))
+    closed.wait()
+
+    postings = list(store.search_index.postings['общее'])
+    assert postings == sorted(postings) == list(range(1, 4001))
+    # Самые новые совпадения — первыми
+    message_ids, total = store.search_index.search('общее слово', 5)
+    assert total == 4000
+    assert message_ids == [4000, 3999, 3998, 3997, 3996]
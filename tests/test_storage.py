@@ -0,0 +1,219 @@
+import json
+import sqlite3
+
+import pytest
+
+from conftest import make_message, parse_ndjson
+
+
+def memory_store(wapp, directory, max_size=50, archive=True):
+    return wapp.MemoryStore(str(directory / 'history.json'), str(directory / 'history.jsonl'), max_size=max_size,
+                            archive_dir=str(directory / 'archive') if archive else None)
+
+
+def test_journal_replay_skips_corrupt_lines(wapp, tmp_path):
+    lines = [wapp.encode_message(make_message(number)) for number in range(1, 6)]
+    lines[1] = b'{"datetime": "01.01.2025 00:00", "mess'
+    lines.insert(3, b'not json at all')
+    lines.insert(4, b'["a list", "not a message"]')
+    # Последняя строка недописана: сервер упал посреди записи
+    (tmp_path / 'history.jsonl').write_bytes(b'\n'.join(lines) + b'\n' + wapp.encode_message(make_message(6))[:20])
+
+    store = memory_store(wapp, tmp_path, archive=False)
+    try:
+        assert [msg.id for msg in store.recent(100)] == [1, 3, 4, 5]
+        assert store.last_id() == 5
+        # Новая запись в журнал начинается с новой строки и не склеивается с недописанной
+        store.append_to_journal([make_message(7)])
+    finally:
+        store.close()
+    reloaded = memory_store(wapp, tmp_path, archive=False)
+    try:
+        assert [msg.id for msg in reloaded.recent(100)] == [1, 3, 4, 5, 7]
+    finally:
+        reloaded.close()
+
+
+def test_journal_replay_orders_and_deduplicates(wapp, tmp_path):
+    snapshot = [wapp.encode_message(make_message(number)) for number in range(1, 4)]
+    (tmp_path / 'history.json').write_bytes(b'\n'.join(snapshot) + b'\n')
+    # Записи журнала могут идти не по порядку и повторять то, что уже есть в снимке
+    journal = [wapp.encode_message(make_message(number)) for number in (2, 5, 4, 3, 6)]
+    (tmp_path / 'history.jsonl').write_bytes(b'\n'.join(journal) + b'\n')
+    store = memory_store(wapp, tmp_path, archive=False)
+    try:
+        assert [msg.id for msg in store.recent(100)] == [1, 2, 3, 4, 5, 6]
+    finally:
+        store.close()
+
+
+def test_memory_store_overflow_goes_to_archive(wapp, tmp_path):
+    store = memory_store(wapp, tmp_path, max_size=50)
+    try:
+        assert store.import_messages(make_message(number) for number in range(1, 201)) == (200, [])
+        assert [msg.id for msg in store.recent(1000)] == list(range(151, 201))
+        store.save_history()
+        assert [msg['id'] for msg in parse_ndjson(store.archived(0, 1000))] == list(range(1, 151))
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('target', ['memory', 'sqlite'])
+def test_export_import_round_trip(wapp, tmp_path, target):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    source = memory_store(wapp, source_dir, max_size=50)
+    messages = [make_message(number, admin=number % 7 == 0, method='WS' if number % 3 else 'POST')
+                for number in range(1, 301)]
+    try:
+        source.import_messages(messages[:120])
+        # Часть вытесненного уже в архиве, часть еще ждет записи — экспорт отдает и то, и другое
+        source.save_history()
+        source.import_messages(messages[120:])
+        exported = b''.join(source.export())
+    finally:
+        source.close()
+    assert [json.loads(line) for line in exported.splitlines()] == messages
+
+    target_dir = tmp_path / 'target'
+    target_dir.mkdir()
+    if target == 'sqlite':
+        store = wapp.SQLiteStore(str(target_dir / 'messages.db'), hot_window=50)
+    else:
+        store = memory_store(wapp, target_dir, max_size=50)
+    try:
+        for repeat in range(2):
+            importer = wapp.Importer(store)
+            for line in exported.splitlines(keepends=True):
+                if importer.add(line):
+                    importer.flush()
+            importer.flush()
+            # Повторный импорт ничего не удваивает
+            expected = {'imported': 0, 'skipped': 300, 'rejected': 0, 'invalid': 0} if repeat else \
+                {'imported': 300, 'skipped': 0, 'rejected': 0, 'invalid': 0}
+            assert importer.counts == expected
+        assert b''.join(store.export()) == exported
+        assert store.last_id() == 300
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('target', ['memory', 'sqlite'])
+def test_import_with_gaps(wapp, tmp_path, target):
+    if target == 'sqlite':
+        store = wapp.SQLiteStore(str(tmp_path / 'messages.db'), hot_window=50)
+    else:
+        store = memory_store(wapp, tmp_path, max_size=50)
+    # В истории id через один: 2, 4, ..., 200 — часть в окне, часть в архиве
+    present = list(range(2, 201, 2))
+    try:
+        store.import_messages(make_message(number) for number in present)
+        if target == 'memory':
+            store.save_history()
+        importer = wapp.Importer(store)
+        for number in range(1, 211):
+            importer.add(wapp.encode_message(make_message(number)) + b'\n')
+        importer.flush()
+        summary = importer.summary()
+        if target == 'sqlite':
+            # База вставляет недостающие id по первичному ключу
+            assert summary == {'imported': 110, 'skipped': 100, 'rejected': 0, 'invalid': 0, 'rejected_ids': []}
+            assert [json.loads(line)['id'] for line in b''.join(store.export()).splitlines()] == list(range(1, 211))
+        else:
+            # Пропущенные id старше последнего не дубликаты: их отклонили, и ответ об этом говорит
+            gaps = list(range(1, 200, 2))
+            assert summary['skipped'] == 100
+            assert summary['rejected'] == len(gaps)
+            assert summary['rejected_ids'] == gaps
+            assert summary['imported'] == 10
+            assert [json.loads(line)['id'] for line in b''.join(store.export()).splitlines()] == \
+                present + list(range(201, 211))
+    finally:
+        store.close()
+
+
+def test_import_rejected_ids_are_capped(wapp, tmp_path, monkeypatch):
+    monkeypatch.setattr(wapp, 'IMPORT_REJECTED_SHOWN', 3)
+    store = memory_store(wapp, tmp_path, archive=False)
+    try:
+        store.import_messages([make_message(100)])
+        importer = wapp.Importer(store)
+        for number in range(1, 11):
+            importer.add(wapp.encode_message(make_message(number)) + b'\n')
+        importer.flush()
+        assert importer.summary()['rejected'] == 10
+        assert importer.summary()['rejected_ids'] == [1, 2, 3]
+    finally:
+        store.close()
+
+
+def test_import_rejects_invalid_lines(wapp, tmp_path):
+    store = memory_store(wapp, tmp_path, archive=False)
+    try:
+        importer = wapp.Importer(store)
+        for line in (b'garbage\n', b'{"id": "1", "message": "x"}\n', b'{"id": 0, "message": "x"}\n',
+                     b'{"id": 1}\n', b'\n', json.dumps({'id': 3, 'message': 'ok'}).encode() + b'\n'):
+            importer.add(line)
+        importer.flush()
+        assert importer.counts == {'imported': 1, 'skipped': 0, 'rejected': 0, 'invalid': 4}
+        assert [msg.message for msg in store.recent(10)] == ['ok']
+    finally:
+        store.close()
+
+
+def test_migration_to_sqlite_keeps_archive(wapp, tmp_path, monkeypatch):
+    for name, value in (('HISTORY_FILE', 'history.json'), ('HISTORY_JOURNAL_FILE', 'history.jsonl'),
+                        ('ARCHIVE_DIR', 'archive'), ('SQLITE_FILE', 'messages.db')):
+        monkeypatch.setattr(wapp, name, str(tmp_path / value))
+    monkeypatch.setattr(wapp, 'ARCHIVE_SEGMENT_SIZE', 100)
+    messages = [make_message(number) for number in range(1, 2501)]
+    legacy = memory_store(wapp, tmp_path, max_size=300)
+    legacy.import_messages(messages[:2000])
+    legacy.save_history()
+    legacy.import_messages(messages[2000:])
+    legacy.close()
+
+    monkeypatch.setattr(wapp, 'STORAGE_BACKEND', 'sqlite')
+    store = wapp.create_store()
+    try:
+        assert [json.loads(line) for line in b''.join(store.export()).splitlines()] == messages
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_compact_rows(wapp, tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(wapp, 'COMPACT_CACHE_SIZE', 10)
+    if backend == 'sqlite':
+        store = wapp.SQLiteStore(str(tmp_path / 'messages.db'), hot_window=50)
+    else:
+        store = memory_store(wapp, tmp_path, max_size=50, archive=False)
+    try:
+        messages = [make_message(number, admin=number % 5 == 0) for number in range(1, 41)]
+        store.import_messages(messages)
+        rows, last_id = store.messages_since(None, compact=True)
+        assert last_id == 40
+        assert rows == [(msg['id'], wapp.encode_row(msg)) for msg in messages]
+        assert store.messages_before(11, 5, compact=True) == \
+            ([(msg['id'], wapp.encode_row(msg)) for msg in messages[5:10]], True)
+        # Строки помнятся только для последних сообщений
+        assert len(store.compact_rows.rows) <= 10
+
+        # Уточненный IP попадает и в компактную строку
+        updated = dict(messages[-1])
+        store.update_ip(updated, '10.0.0.1 (host.example.org)')
+        assert store.messages_since(39, compact=True)[0] == [(40, wapp.encode_row(updated))]
+    finally:
+        store.close()
+
+
+def test_sqlite_store_refuses_writes_after_close(wapp, tmp_path):
+    store = wapp.SQLiteStore(str(tmp_path / 'messages.db'), hot_window=50)
+    store.import_messages([make_message(1)])
+    store.close()
+    # Запись после close() — ошибка, а не новое соединение в обход закрытия
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.update_ip(make_message(1), '10.0.0.1 (host.example.org)')
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.import_messages([make_message(2)])
+    assert store._connections == []
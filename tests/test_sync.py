@@ -0,0 +1,136 @@
+import itertools
+import json
+import threading
+import time
+
+import pytest
+
+room_numbers = itertools.count()
+
+
+@pytest.fixture
+def room(wapp, client, monkeypatch):
+    """Новая комната с тремя сообщениями; лимиты запросов выключены, окно повторов свое"""
+    monkeypatch.setattr(wapp, 'post_limiter', wapp.RateLimiter(0, 0))
+    monkeypatch.setattr(wapp, 'poll_limiter', wapp.RateLimiter(0, 0))
+    monkeypatch.setattr(wapp, 'duplicates', wapp.DuplicateDetector(60, 100))
+    name = f"sync{next(room_numbers)}"
+    for number in range(1, 4):
+        post(client, name, f"сообщение {number}")
+    return name
+
+
+def post(client, room, text):
+    response = client.post(f"/message?room={room}", json={'message': text}, environ_base={'REMOTE_ADDR': '10.7.0.1'})
+    assert response.status_code == 200
+
+
+def get(client, room, query=''):
+    response = client.get(f"/get-messages?room={room}&{query}")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def texts(body):
+    return [msg['message'] for msg in body['history']]
+
+
+def test_since_cursor(client, room):
+    full = get(client, room)
+    assert texts(full) == ['сообщение 1', 'сообщение 2', 'сообщение 3']
+    assert [msg['id'] for msg in full['history']] == [1, 2, 3]
+    assert full['last_id'] == 3
+
+    assert texts(get(client, room, 'since=1')) == ['сообщение 2', 'сообщение 3']
+    assert get(client, room, 'since=3') == {'history': [], 'last_id': 3}
+    # Курсор впереди истории (ее сбросили) — клиент узнает настоящий last_id
+    assert get(client, room, 'since=50')['last_id'] == 3
+
+    post(client, room, 'сообщение 4')
+    assert get(client, room, 'since=3') == {'history': [get(client, room)['history'][-1]], 'last_id': 4}
+
+
+def test_since_with_limit(client, room):
+    body = get(client, room, 'since=0&limit=2')
+    assert texts(body) == ['сообщение 1', 'сообщение 2']
+    assert body['last_id'] == 2 and body['has_more'] is True
+    body = get(client, room, f"since={body['last_id']}&limit=2")
+    assert texts(body) == ['сообщение 3']
+    assert body['last_id'] == 3 and body['has_more'] is False
+
+
+def test_long_poll_wakes_on_new_message(client, room):
+    timer = threading.Timer(0.2, post, (client, room, 'новое'))
+    start = time.monotonic()
+    timer.start()
+    try:
+        body = get(client, room, 'since=3&wait=5')
+    finally:
+        timer.join()
+    assert texts(body) == ['новое']
+    assert body['last_id'] == 4
+    assert time.monotonic() - start < 4
+
+
+def test_long_poll_times_out(client, room):
+    start = time.monotonic()
+    assert get(client, room, 'since=3&wait=0.3') == {'history': [], 'last_id': 3}
+    assert 0.25 <= time.monotonic() - start < 3
+    # Клиент отстал — ответ сразу, без ожидания
+    start = time.monotonic()
+    assert texts(get(client, room, 'since=2&wait=5')) == ['сообщение 3']
+    assert time.monotonic() - start < 1
+
+
+def read_events(response, count):
+    """Первые count событий SSE (комментарии-пинги тоже считаются)"""
+    events = []
+    buffer = b''
+    chunks = response.iter_encoded()
+    while len(events) < count:
+        buffer += next(chunks)
+        while b'\n\n' in buffer and len(events) < count:
+            event, buffer = buffer.split(b'\n\n', 1)
+            events.append(event.decode('utf-8'))
+    return events
+
+
+def test_stream_sends_messages_after_cursor(client, room):
+    response = client.get(f"/stream?room={room}&since=1", buffered=False)
+    try:
+        assert response.mimetype == 'text/event-stream'
+        events = read_events(response, 2)
+        assert [event.split('\n')[0] for event in events] == ['id: 2', 'id: 3']
+        assert json.loads(events[1].split('\n')[1][len('data: '):])['message'] == 'сообщение 3'
+
+        post(client, room, 'после подключения')
+        event = read_events(response, 1)[0]
+        assert event.startswith('id: 4\n')
+        assert 'после подключения' in event
+    finally:
+        response.close()
+
+
+def test_stream_resumes_from_last_event_id(client, room):
+    # Заголовок переподключения главнее параметра
+    response = client.get(f"/stream?room={room}&since=0", headers={'Last-Event-ID': '2'}, buffered=False)
+    try:
+        assert read_events(response, 1)[0].startswith('id: 3\n')
+    finally:
+        response.close()
+
+
+def test_stream_ping_and_reset(wapp, client, room, monkeypatch):
+    monkeypatch.setattr(wapp, 'STREAM_HEARTBEAT', 0.05)
+    response = client.get(f"/stream?room={room}", buffered=False)
+    try:
+        # Без since поток начинается с текущего конца: старые сообщения не присылаются
+        assert read_events(response, 1) == [': ping']
+    finally:
+        response.close()
+
+    response = client.get(f"/stream?room={room}&since=10", buffered=False)
+    try:
+        assert read_events(response, 1) == ['event: reset\ndata: {"last_id": 3}']
+    finally:
+        response.close()
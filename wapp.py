@@ -1,334 +1,2192 @@
-from flask import Flask, request, jsonify, render_template_string, send_file
-from collections import deque
-from datetime import datetime
+from flask import Flask, Response, request, jsonify, send_file, abort, g
+from werkzeug.datastructures import Headers, MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_etags
+from urllib.parse import parse_qsl
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
 import threading
+import asyncio
+import argparse
+import functools
+import hashlib
+import ipaddress
+import gzip
+import heapq
+import math
+import re
+import atexit
+import shutil
+import signal
+import sqlite3
+import queue
+import time
 import json
 import os
 import socket
+import sys
+import io
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Без пакета brotli ответы сжимаются только gzip
+
+try:
+    from flask_sock import Sock, ConnectionClosed
+except ImportError:
+    Sock = None  # Без пакета flask-sock /ws недоступен, клиенты работают через /stream
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None  # Без uvicorn запускается только встроенный сервер Flask
 
 app = Flask(__name__)
 
 # Конфигурация
-HISTORY_FILE = "message_history2.json"
+STORAGE_BACKEND = os.environ.get('MESSENGER_STORAGE', 'memory')  # "memory" — один процесс, "sqlite" — общая база для нескольких воркеров
+SQLITE_FILE = os.environ.get('MESSENGER_SQLITE_FILE', 'messages.db')
+SQLITE_POLL_INTERVAL = 0.1  # Как часто (секунд) проверять, не добавили ли сообщения другие процессы
+SQLITE_HOT_WINDOW = 1000  # Сколько последних сообщений SQLite-хранилище держит в памяти
+HISTORY_FILE = "message_history2.json"  # Снимок истории, по сообщению в строке (переписывается при компактировании)
+HISTORY_CHUNK_SIZE = 256  # По сколько сообщений окно истории хранит в одном куске (см. HistoryLog)
+HISTORY_READ_BLOCK = 1 << 20  # Блоками такого размера (байт) история читается с конца файла при запуске
+HISTORY_JOURNAL_FILE = "message_history2.jsonl"  # Журнал новых сообщений, одна строка — одно сообщение
+JOURNAL_SYNC = "flush"  # "none" — буфер Python, "flush" — сброс в ОС, "fsync" — до диска
+JOURNAL_COMPACT_EVERY = 1000  # Через сколько записей в журнале переписывать снимок
+PERSIST_FLUSH_INTERVAL = 0.5  # Сколько секунд фоновый писатель копит сообщения перед записью
+PERSIST_BATCH_SIZE = 500  # Максимум сообщений в одной записи в журнал
+ARCHIVE_DIR = "message_archive"  # Папка архива: сюда уходят сообщения, вытесненные из окна истории
+ARCHIVE_SEGMENT_SIZE = 10000  # Сколько сообщений в одном сжатом сегменте архива
+ARCHIVE_COMPRESS_LEVEL = 9  # Уровень gzip для сегментов: сжимаются один раз, читаются редко
+ARCHIVE_READ_BLOCK = 1 << 16  # Блоками такого размера (байт) /archive отдает сегменты
+BULK_BATCH_SIZE = 1000  # По сколько сообщений /export отдает и /import добавляет в историю за раз
+MAX_MESSAGE_ID = 2 ** 53  # Наибольший id, который принимает /import (дальше id теряют точность в JavaScript)
+IMPORT_REJECTED_SHOWN = 100  # Сколько id отклоненных сообщений /import перечисляет в ответе
 MAX_HISTORY_SIZE = 10000
+DATETIME_FORMAT = "%d.%m.%Y %H:%M"  # Как показывать время сообщения: "дд.мм.гггг чч:мм"
+DEFAULT_ROOM = "main"  # Комната по умолчанию: ей принадлежат прежние файлы истории и база
+ROOMS_DIR = "rooms"  # Папка с историей остальных комнат (файл или база на комнату)
+ROOM_HISTORY_SIZE = 1000  # Сколько последних сообщений держит в памяти каждая комната, кроме основной
+ROOM_IDLE_TIMEOUT = 600  # Через сколько секунд без запросов и подключений комната выгружается из памяти
+ROOM_EVICT_INTERVAL = 30  # Как часто (секунд) искать простаивающие комнаты
+ROOM_NAME_RE = re.compile(r'^[a-z0-9_-]{1,32}$')  # Допустимые имена комнат
+MAX_ROOMS = 1000  # Сколько всего может быть комнат, считая основную; новые сверх этого не создаются
+ROOM_WAIT_INTERVAL = 1  # Как часто (секунд) long-poll еще не созданной комнаты проверяет, не появилась ли она
 ADMIN_IP = "127.0.0.1"  # IP администратора
+TRUSTED_PROXIES = {address.strip() for address in os.environ.get(  # Обратные прокси, чьему X-Forwarded-For верим (через запятую)
+    'MESSENGER_TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if address.strip()}
+ADMIN_MESSAGES_KEPT = 100  # Сколько последних сообщений администратора можно запросить в /admin-message?n=
+LONG_POLL_MAX_WAIT = 30  # Максимальное ожидание для /get-messages?wait=, секунд
+STREAM_HEARTBEAT = 15  # Интервал пустых событий в /stream, чтобы прокси не рвали соединение
+WS_SEND_QUEUE = 256  # Сколько кадров может ждать отправки одному WebSocket-клиенту
+WS_MAX_RESYNCS = 3  # Сколько раз подряд отставший клиент догоняет историю, прежде чем его отключат
+WS_PING_INTERVAL = 25  # Интервал ping-кадров WebSocket, секунд
+ASGI_MIRROR_SIZE = 1000  # Сколько последних сообщений ASGI-режим держит в копии для событийного цикла
+ASGI_THREADS = 32  # Потоков для блокирующей работы в ASGI-режиме (хранилище, страницы Flask)
+RESOLVE_HOSTNAMES = True  # False — не делать обратных DNS-запросов вообще
+DNS_CACHE_SIZE = 4096  # Сколько IP держать в кэше имен
+DNS_CACHE_TTL = 3600  # Сколько секунд помнить найденное имя
+DNS_NEGATIVE_TTL = 300  # Сколько секунд помнить, что у IP имени нет
+DNS_WORKERS = 4  # Потоков для обратных DNS-запросов
+PAGE_SIZE = 50  # Сколько старых сообщений отдавать за раз в /get-messages?before=
+INITIAL_MESSAGES = 50  # Сколько последних сообщений рисовать сразу на странице, остальное — по прокрутке
+MAX_PAGE_SIZE = 500  # Верхняя граница для ?limit=
+SEARCH_PAGE_SIZE = 20  # Сколько результатов /search отдает за раз
+COMPRESS_MIN_SIZE = 1024  # Ответы меньше этого (байт) не сжимаем — выигрыш меньше накладных расходов
+COMPRESS_LEVEL = 6  # Уровень gzip: 1 — быстрее, 9 — плотнее
+BROTLI_QUALITY = 5  # Качество brotli (0-11), если пакет установлен
+COMPRESS_CACHE_SIZE = 256  # Сколько сжатых ответов помнить (ключ — адрес, ETag и кодировка)
+COMPACT_MIMETYPE = 'application/vnd.messenger.compact+json'  # Компактный формат истории: имена полей один раз, сообщения — массивами
+COMPACT_COLUMNS = ('id', 'datetime', 'method', 'message', 'ip', 'admin', 'ts')  # Порядок полей в строке компактного формата
+COMPACT_CACHE_SIZE = 1000  # Для скольких последних сообщений хранилище помнит готовые строки компактного формата
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/plain', COMPACT_MIMETYPE}
+BLOCKLIST_FILE = os.environ.get(  # Запрещенные слова, по одному в строке; перечитывается при изменении
+    'MESSENGER_BLOCKLIST', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blocklist.txt'))
+FILTER_ACTION = os.environ.get('MESSENGER_FILTER_ACTION', 'replace')  # "replace" — заменить сообщение, "mask" — закрыть слова звездочками, "reject" — не принять
+FILTER_REPLACEMENT = 'Я тупой даун'  # Чем заменяется сообщение при FILTER_ACTION = "replace"
+FILTER_RELOAD_INTERVAL = 2  # Не чаще чем раз в столько секунд проверять, не изменился ли файл списка
+POST_RATE = 1.0  # Сколько сообщений в секунду в среднем может отправлять один IP (0 — без ограничения)
+POST_BURST = 10  # Сколько сообщений подряд можно отправить без паузы
+POLL_RATE = 10.0  # Запросов в секунду к /get-messages и /stream с одного IP (0 — без ограничения)
+POLL_BURST = 60  # Запас запросов к /get-messages и /stream подряд
+RATE_LIMIT_MAX_CLIENTS = 10000  # Сколько IP помнит каждый ограничитель (давно не приходившие вытесняются)
+DUPLICATE_WINDOW = 60  # Сколько секунд одинаковое сообщение от того же IP считается повтором
+DUPLICATE_MAX_ENTRIES = 100000  # Сколько последних сообщений помнит детектор повторов
+SEARCH_RANK_LIMIT = 5000  # Если совпадений больше, по релевантности ранжируются только самые новые из них
+METRICS_ENABLED = os.environ.get('MESSENGER_METRICS', '1') != '0'  # Сбор метрик для /metrics ("0" — выключить)
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Границы гистограмм, секунд
+
+
+def encode_message(message_data):
+    """Готовый JSON сообщения для ответов; кодируется один раз при добавлении"""
+    return json.dumps(message_data, ensure_ascii=False).encode('utf-8')
+
+
+def encode_row_tail(message_data):
+    """Строка компактного формата без id: 'datetime",...,ts]' — id дописывается спереди, когда известен"""
+    return json.dumps([message_data.get(column) for column in COMPACT_COLUMNS[1:]],
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')[1:]
+
+
+def encode_row(message_data):
+    """Готовая строка компактного формата: значения полей COMPACT_COLUMNS массивом, без имен"""
+    return b'[%d,' % message_data['id'] + encode_row_tail(message_data)
+
+
+COMPACT_COLUMNS_JSON = json.dumps(COMPACT_COLUMNS, separators=(',', ':')).encode()
+
+
+def row_from_json(encoded):
+    """Строка компактного формата из готового JSON"""
+    return encode_row(json.loads(encoded))
+
+
+def parse_datetime(text):
+    """Время сообщения из строки DATETIME_FORMAT в секундах эпохи (для старых сообщений без ts)"""
+    try:
+        return int(datetime.strptime(text, DATETIME_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def history_entry(message_data, encoded):
+    """Запись окна истории: (id, готовый JSON, ts, отправитель, флаги Message).
+
+    Кортеж из одних неизменяемых значений сборщик мусора перестает отслеживать, а текст
+    и время не хранятся второй раз — текст есть в JSON, время форматируется при выводе.
+    """
+    ts = message_data.get('ts')
+    if ts is None:
+        ts = parse_datetime(message_data.get('datetime'))
+    flags = (Message.ADMIN if message_data.get('admin') else 0) | (Message.WS if message_data.get('method') == 'WS' else 0)
+    # Одни и те же адреса с именами хостов повторяются — храним одну строку на отправителя
+    return message_data['id'], encoded, ts, sys.intern(str(message_data.get('ip', ''))), flags
+
+
+class Message:
+    """Сообщение из окна истории для шаблона и обработчиков; собирается из записи по требованию"""
+
+    __slots__ = ('id', 'encoded', 'ts', 'ip', 'flags')
+
+    ADMIN = 1  # Сообщение администратора
+    WS = 2  # Отправлено через WebSocket (method "WS"), иначе "POST"
+
+    def __init__(self, entry):
+        self.id, self.encoded, self.ts, self.ip, self.flags = entry
+
+    @property
+    def admin(self):
+        return bool(self.flags & self.ADMIN)
+
+    @property
+    def method(self):
+        return 'WS' if self.flags & self.WS else 'POST'
+
+    @property
+    def datetime(self):
+        return datetime.fromtimestamp(self.ts).strftime(DATETIME_FORMAT)
+
+    @property
+    def message(self):
+        return json.loads(self.encoded).get('message')
+
+    def to_dict(self):
+        """Словарь в том виде, в каком сообщение уходит клиентам"""
+        return json.loads(self.encoded)
+
+
+class CompactRows:
+    """Строки компактного формата последних сообщений: id -> (JSON, из которого собрана строка, строка).
+
+    В записях окна истории строк нет — они почти в полтора раза увеличили бы его память. Строка
+    собирается из готового JSON, когда ее спросят, и запоминается, только если сообщение среди
+    последних size: их и запрашивают синхронизирующиеся клиенты. Если JSON записи заменили
+    (update_ip()), строка собирается заново.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rows = {}
+        self.newest = 0
+        self.lock = threading.Lock()
+
+    def put(self, message_id, encoded, row):
+        with self.lock:
+            self.rows[message_id] = (encoded, row)
+            self.newest = max(self.newest, message_id)
+            # Словарь помнит порядок добавления, а добавляются в основном новые id — первым уходит самый старый
+            while len(self.rows) > self.size:
+                del self.rows[next(iter(self.rows))]
+
+    def get(self, entry):
+        """Строка для записи окна истории"""
+        message_id, encoded = entry[0], entry[1]
+        cached = self.rows.get(message_id)
+        if cached is not None and cached[0] is encoded:
+            return cached[1]
+        row = row_from_json(encoded)
+        if message_id > self.newest - self.size:
+            self.put(message_id, encoded, row)
+        return row
+
+    def pairs(self, entries):
+        """[(id, строка)] для записей окна истории"""
+        return [(entry[0], self.get(entry)) for entry in entries]
+
+
+def import_record(line):
+    """Сообщение из строки NDJSON для import_messages() (поля в обычном порядке) или None, если строка негодная"""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or type(record.get('id')) is not int or record['id'] <= 0 \
+            or not isinstance(record.get('message'), str):
+        return None
+    ts = record.get('ts') if type(record.get('ts')) is int else parse_datetime(record.get('datetime')) or None
+    datetime_str = record.get('datetime')
+    if not isinstance(datetime_str, str):
+        datetime_str = datetime.fromtimestamp(ts).strftime(DATETIME_FORMAT) if ts else ''
+    return {
+        'datetime': datetime_str,
+        'method': 'WS' if record.get('method') == 'WS' else 'POST',
+        'message': record['message'],
+        'ip': str(record.get('ip', '')),
+        'admin': bool(record.get('admin')),
+        'ts': ts,
+        'id': record['id'],
+    }
 
 
-# Загрузка истории из файла при запуске
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                return deque(json.load(f), maxlen=MAX_HISTORY_SIZE)
-        except Exception as e:
-            print(f"Ошибка загрузки истории: {e}")
-    return deque(maxlen=MAX_HISTORY_SIZE)
-
-
-# Инициализация истории
-message_history = load_history()
-history_lock = threading.Lock()
-
-# HTML шаблон для мессенджера
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Local Messenger</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        * {
-            box-sizing: border-box;
-            margin: 0;
-            padding: 0;
-        }
-
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif;
-            background: linear-gradient(135deg, #6a11cb 0%, #2575fc 100%);
-            height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            padding: 20px;
-            color: #333;
-        }
-
-        .container {
-            width: 100%;
-            max-width: 900px;
-            height: 95vh;
-            background-color: white;
-            display: flex;
-            flex-direction: column;
-            border-radius: 20px;
-            box-shadow: 0 15px 50px rgba(0, 0, 0, 0.2);
-            overflow: hidden;
-            position: relative;
-        }
-
-        .header {
-            background: linear-gradient(to right, #4776E6, #8E54E9);
-            color: white;
-            padding: 20px;
-            text-align: center;
-            position: relative;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-
-        .header-content {
-            flex: 1;
-        }
-
-        h1 {
-            font-size: 1.8rem;
-            font-weight: 600;
-            margin: 0;
-            text-shadow: 0 2px 4px rgba(0,0,0,0.2);
-        }
-
-        .subtitle {
-            font-size: 0.9rem;
-            opacity: 0.9;
-            margin-top: 5px;
-        }
+class ImportRejected(Exception):
+    """Импорт остановлен: пачка с такой строкой не записывается; текст исключения показывается клиенту"""
 
-        .admin-link {
-            background: rgba(255, 255, 255, 0.2);
-            color: white;
-            border: none;
-            border-radius: 20px;
-            padding: 8px 15px;
-            font-size: 0.9rem;
-            cursor: pointer;
-            text-decoration: none;
-            transition: all 0.3s ease;
-            margin-left: 15px;
-        }
 
-        .admin-link:hover {
-            background: rgba(255, 255, 255, 0.3);
-            transform: scale(1.05);
-        }
+class Importer:
+    """Разбирает строки NDJSON для /import и передает сообщения хранилищу пачками по BULK_BATCH_SIZE"""
 
-        .messages-container {
-            flex: 1;
-            overflow-y: auto;
-            padding: 20px;
-            display: flex;
-            flex-direction: column;
-            background-color: #f0f4f8;
-            background-image: url("data:image/svg+xml,%3Csvg width='100' height='100' viewBox='0 0 100 100' xmlns='http://www.w3.org/2000/svg'%3E%3Cpath d='M11 18c3.866 0 7-3.134 7-7s-3.134-7-7-7-7 3.134-7 7 3.134 7 7 7zm48 25c3.866 0 7-3.134 7-7s-3.134-7-7-7-7 3.134-7 7 3.134 7 7 7zm-43-7c1.657 0 3-1.343 3-3s-1.343-3-3-3-3 1.343-3 3 1.343 3 3 3zm63 31c1.657 0 3-1.343 3-3s-1.343-3-3-3-3 1.343-3 3 1.343 3 3 3zM34 90c1.657 0 3-1.343 3-3s-1.343-3-3-3-3 1.343-3 3 1.343 3 3 3zm56-76c1.657 0 3-1.343 3-3s-1.343-3-3-3-3 1.343-3 3 1.343 3 3 3zM12 86c2.21 0 4-1.79 4-4s-1.79-4-4-4-4 1.79-4 4 1.79 4 4 4zm28-65c2.21 0 4-1.79 4-4s-1.79-4-4-4-4 1.79-4 4 1.79 4 4 4zm23-11c2.76 0 5-2.24 5-5s-2.24-5-5-5-5 2.24-5 5 2.24 5 5 5zm-6 60c2.21 0 4-1.79 4-4s-1.79-4-4-4-4 1.79-4 4 1.79 4 4 4zm29 22c2.76 0 5-2.24 5-5s-2.24-5-5-5-5 2.24-5 5 2.24 5 5 5zM32 63c2.76 0 5-2.24 5-5s-2.24-5-5-5-5 2.24-5 5 2.24 5 5 5zm57-13c2.76 0 5-2.24 5-5s-2.24-5-5-5-5 2.24-5 5 2.24 5 5 5zm-9-21c1.105 0 2-.895 2-2s-.895-2-2-2-2 .895-2 2 .895 2 2 2zM60 91c1.105 0 2-.895 2-2s-.895-2-2-2-2 .895-2 2 .895 2 2 2zM35 41c1.105 0 2-.895 2-2s-.895-2-2-2-2 .895-2 2 .895 2 2 2zM12 60c1.105 0 2-.895 2-2s-.895-2-2-2-2 .895-2 2 .895 2 2 2z' fill='%239C92AC' fill-opacity='0.05' fill-rule='evenodd'/%3E%3C/svg%3E");
-        }
+    def __init__(self, store):
+        self.store = store
+        self.batch = []
+        # skipped — id уже есть в истории, rejected — id нет, но хранилищу некуда его поставить
+        self.counts = {'imported': 0, 'skipped': 0, 'rejected': 0, 'invalid': 0}
+        self.rejected_ids = []
 
-        .message { 
-            margin-bottom: 15px; 
-            padding: 15px;
-            border-radius: 18px;
-            max-width: 80%;
-            width: fit-content;
-            position: relative;
-            animation: fadeIn 0.3s ease-out;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-        }
+    def add(self, line):
+        """Добавляет строку; True, если пачка набрана и пора вызвать flush()"""
+        if not line.strip():
+            return False
+        msg = import_record(line)
+        if msg is None:
+            self.counts['invalid'] += 1
+        elif msg['id'] > MAX_MESSAGE_ID:
+            # После такого id следующему сообщению не выдать id (MAX(id) + 1 не влезет в INTEGER SQLite)
+            self.batch = []
+            raise ImportRejected(f"id {msg['id']} больше допустимого ({MAX_MESSAGE_ID})")
+        else:
+            self.batch.append(msg)
+        return len(self.batch) >= BULK_BATCH_SIZE
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        if batch:
+            imported, rejected = self.store.import_messages(batch)
+            self.counts['imported'] += imported
+            self.counts['rejected'] += len(rejected)
+            self.counts['skipped'] += len(batch) - imported - len(rejected)
+            self.rejected_ids.extend(rejected[:IMPORT_REJECTED_SHOWN - len(self.rejected_ids)])
+
+    def summary(self):
+        """Счетчики для ответа /import и первые IMPORT_REJECTED_SHOWN отклоненных id"""
+        return dict(self.counts, rejected_ids=self.rejected_ids)
+
+
+def normalize_text(text):
+    """Текст для поиска: без учета регистра, ё не отличается от е"""
+    if not isinstance(text, str):
+        return ''
+    return text.casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    """Слова текста (буквы и цифры любого алфавита) после normalize_text()"""
+    return re.findall(r'\w+', normalize_text(text))
+
+
+# Похожие буквы кириллицы и греческого сводим к латинским, чтобы "pоrn" с русской "о" не проходил фильтр
+FILTER_HOMOGLYPHS = str.maketrans({
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p',
+    'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'ӏ': 'l',
+    'α': 'a', 'β': 'b', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't', 'υ': 'u', 'χ': 'x',
+})
+# И наоборот — похожие латинские и греческие буквы к кириллическим: "xyй" с латинскими "x" и "y"
+FILTER_HOMOGLYPHS_CYRILLIC = str.maketrans({
+    'a': 'а', 'b': 'в', 'e': 'е', 'k': 'к', 'm': 'м', 'h': 'н', 'o': 'о', 'p': 'р', 'c': 'с', 't': 'т', 'y': 'у', 'x': 'х',
+    'α': 'а', 'ε': 'е', 'κ': 'к', 'ο': 'о', 'ρ': 'р', 'τ': 'т', 'χ': 'х',
+})
+# Слово, где латиница (уже в нижнем регистре) перемешана с греческим или кириллицей, — признак подмены букв
+FILTER_LATIN = re.compile('[a-z]')
+FILTER_NON_LATIN = re.compile('[\u0370-\u052f]')
+FILTER_MIXED_WORD = re.compile(r'\b(?=\w*[a-z])(?=\w*[\u0370-\u052f])\w+')
+
+
+def normalize_for_filter(text):
+    """Варианты текста для фильтра: нижний регистр, а в словах из букв разных алфавитов похожие
+    буквы сведены к латинским (первый вариант) и к кириллическим (второй).
+
+    Слова из букв одного алфавита не меняются: иначе русское слово из списка находилось бы внутри
+    английских ("мех" в "mexico") и наоборот. Каждый символ переходит ровно в один, поэтому
+    позиции совпадений верны и для исходного текста.
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Редкие буквы, у которых нижний регистр длиннее (например, "İ"), оставляем как есть
+        lowered = ''.join(ch.lower() if len(ch.lower()) == 1 else ch for ch in text)
+    if lowered.isascii() or not FILTER_NON_LATIN.search(lowered) or not FILTER_LATIN.search(lowered):
+        return (lowered,)
+    mixed = [match.span() for match in FILTER_MIXED_WORD.finditer(lowered)]
+    if not mixed:
+        return (lowered,)
+    variants = []
+    for table in (FILTER_HOMOGLYPHS, FILTER_HOMOGLYPHS_CYRILLIC):
+        parts = []
+        last = 0
+        for start, end in mixed:
+            parts.append(lowered[last:start])
+            parts.append(lowered[start:end].translate(table))
+            last = end
+        parts.append(lowered[last:])
+        variants.append(''.join(parts))
+    return tuple(variants)
+
+
+class ContentFilter:
+    """Автомат Ахо — Корасик по списку запрещенных слов.
+
+    Текст просматривается за один проход, поэтому время проверки зависит от длины
+    сообщения, а не от размера списка.
+    """
+
+    def __init__(self, terms):
+        # Бор: переходы, ссылки неудач и длины слов, которые заканчиваются в узле
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for term in {variant for term in terms for variant in normalize_for_filter(term) if variant}:
+            node = 0
+            for ch in term:
+                next_node = self.goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][ch] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = next_node
+            self.output[node] += (len(term),)
+        self.size = sum(1 for lengths in self.output if lengths)
+
+        # Ссылки неудач обходом в ширину; слова из суффиксов наследуются
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self.goto[node].items():
+                pending.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    def matches(self, text):
+        """(начало, конец) каждого вхождения запрещенного слова в text"""
+        variants = normalize_for_filter(text)
+        if len(variants) == 1:
+            return self._scan(variants[0])
+        # Вне слов со смесью алфавитов варианты совпадают — одно и то же вхождение отдаем один раз
+        return iter(dict.fromkeys(match for variant in variants for match in self._scan(variant)))
+
+    def _scan(self, normalized):
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for position, ch in enumerate(normalized):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length in output[node]:
+                yield position + 1 - length, position + 1
+
+    def search(self, text):
+        """Есть ли в text хотя бы одно запрещенное слово"""
+        return next(self.matches(text), None) is not None
+
+    def mask(self, text):
+        """text, в котором запрещенные слова закрыты звездочками"""
+        masked = None
+        for start, end in self.matches(text):
+            if masked is None:
+                masked = list(text)
+            masked[start:end] = '*' * (end - start)
+        return text if masked is None else ''.join(masked)
+
+
+class Blocklist:
+    """Автомат по файлу списка. Файл перечитывается на лету: когда он изменился,
+    строится новый автомат и подменяет старый, запросы продолжают работать со старым"""
+
+    def __init__(self, path):
+        self.path = path
+        self.filter = ContentFilter(())
+        self.mtime = None
+        self.checked = 0
+        # Ошибку чтения пишем в лог один раз, а не при каждой проверке, пока файл не починят
+        self.failing = False
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    terms = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+                self.filter = ContentFilter(terms)
+                self.mtime = mtime
+        except OSError as e:
+            if not self.failing:
+                print(f"Ошибка загрузки списка запрещенных слов: {e}")
+                self.failing = True
+            return
+        if self.failing:
+            print(f"Список запрещенных слов снова загружен: {self.filter.size} слов")
+            self.failing = False
+
+    def current(self):
+        """Актуальный автомат (изменения файла проверяются не чаще FILTER_RELOAD_INTERVAL)"""
+        now = time.monotonic()
+        if now - self.checked >= FILTER_RELOAD_INTERVAL and self.lock.acquire(blocking=False):
+            # Перечитывает один поток, остальные не ждут
+            try:
+                self.checked = now
+                self.reload()
+            finally:
+                self.lock.release()
+        return self.filter
+
+
+class SearchIndex:
+    """Инвертированный индекс по тексту сообщений: слово -> {id: сколько раз встречается}.
+
+    Обновляется по одному сообщению, запрос — пересечение списков по всем словам, ранжирование BM25.
+    Хранилище добавляет сообщения под своей блокировкой, в порядке выдачи id, поэтому в каждом
+    списке id уже отсортированы (на этом держится перебор от новых к старым).
+    """
+
+    # Параметры BM25
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self.lock = threading.Lock()
+
+    def add(self, message_id, text):
+        self.add_tokens(message_id, tokenize(text))
+
+    def add_tokens(self, message_id, tokens):
+        """Как add(), но текст уже разбит на слова — разбивать можно заранее, вне блокировки хранилища"""
+        if not tokens:
+            return
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        with self.lock:
+            for token, count in counts.items():
+                self.postings.setdefault(token, {})[message_id] = count
+            self.doc_lengths[message_id] = len(tokens)
+            self.total_length += len(tokens)
+
+    def remove(self, message_id, text):
+        with self.lock:
+            length = self.doc_lengths.pop(message_id, None)
+            if length is None:
+                return
+            self.total_length -= length
+            for token in set(tokenize(text)):
+                documents = self.postings.get(token)
+                if documents is not None:
+                    documents.pop(message_id, None)
+                    if not documents:
+                        del self.postings[token]
+
+    def search(self, query, limit, offset=0):
+        """(id найденных сообщений для страницы — лучшие первыми, всего найдено)"""
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0
+        with self.lock:
+            documents = [self.postings.get(term) for term in terms]
+            if not all(documents):
+                return [], 0
+            # Пересекаем, начиная с самого короткого списка; идем от новых сообщений к старым
+            documents.sort(key=len)
+            smallest, others = documents[0], documents[1:]
+            if others:
+                candidates = [message_id for message_id in reversed(smallest)
+                              if all(message_id in other for other in others)]
+                total = len(candidates)
+            else:
+                candidates = reversed(smallest)
+                total = len(smallest)
+            # Частое слово: считать BM25 для всех совпадений дорого, ранжируем только самые свежие
+            candidates = list(islice(candidates, SEARCH_RANK_LIMIT))
+            if not candidates:
+                return [], 0
+
+            total_docs = len(self.doc_lengths)
+            average_length = self.total_length / total_docs
+            idf = [math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5)) for docs in documents]
+
+            def score(message_id):
+                norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[message_id] / average_length)
+                rank = 0.0
+                for weight, docs in zip(idf, documents):
+                    count = docs[message_id]
+                    rank += weight * count * (self.K1 + 1) / (count + norm)
+                # При равной релевантности новые сообщения выше
+                return rank, message_id
+
+            best = heapq.nlargest(offset + limit, candidates, key=score)
+        return best[offset:], total
+
+
+# Метрики для /metrics (формат Prometheus). Все метрики регистрируются здесь при создании
+metrics_registry = []
+
+
+def format_metric_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """Метрика: значения по наборам меток. collect() — если значения считаются при выдаче, а не копятся"""
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def label_text(self, label_values, extra=None):
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, label_values)]
+        if extra is not None:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        """[(имя, метки, значение), ...]"""
+        if self.collect is not None:
+            values = list(self.collect())
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        return [(self.name, self.label_text(label_values), value) for label_values, value in values]
 
-        .message.other {
-            background-color: white;
-            border-bottom-left-radius: 5px;
-            align-self: flex-start;
-            margin-right: auto;
-        }
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.TYPE}']
+        lines.extend(f'{name}{labels} {format_metric_value(value)}' for name, labels, value in self.samples())
+        return lines
 
-        .message.own {
-            background: linear-gradient(to right, #4776E6, #8E54E9);
-            color: white;
-            border-bottom-right-radius: 5px;
-            align-self: flex-end;
-            margin-left: auto;
-        }
 
-        .message.admin {
-            background: linear-gradient(to right, #4CAF50, #8BC34A);
-            color: white;
-            border-bottom-right-radius: 5px;
-            align-self: flex-end;
-            margin-left: auto;
-        }
+class Counter(Metric):
+    TYPE = 'counter'
 
-        .sender {
-            font-weight: 600;
-            font-size: 0.85rem;
-            margin-bottom: 5px;
-            display: flex;
-            align-items: center;
-        }
 
-        .message.own .sender, .message.admin .sender {
-            color: rgba(255,255,255,0.9);
-        }
+class Gauge(Metric):
+    TYPE = 'gauge'
 
-        .content {
-            font-size: 1.1rem;
-            line-height: 1.4;
-            word-break: break-word;
-            padding: 5px 0;
-        }
+    def dec(self, *label_values):
+        self.inc(*label_values, amount=-1)
 
-        .ip-display {
-            font-size: 0.75rem;
-            opacity: 0.7;
-            margin-top: 3px;
-        }
+    @contextmanager
+    def track(self, *label_values):
+        """Значение больше на единицу, пока выполняется блок with"""
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам METRICS_BUCKETS; наблюдение — один bisect и одна короткая блокировка"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # Число попаданий в каждую корзину (последняя — +Inf) и сумма значений
+                series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, list(series)) for label_values, series in self.values.items()]
+        samples = []
+        for label_values, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                samples.append((f'{self.name}_bucket',
+                                self.label_text(label_values, f'le="{format_metric_value(bound)}"'), cumulative))
+            samples.append((f'{self.name}_sum', self.label_text(label_values), series[-1]))
+            samples.append((f'{self.name}_count', self.label_text(label_values), cumulative))
+        return samples
+
+
+http_requests = Counter('messenger_http_requests_total', 'Запросы по маршрутам и кодам ответа',
+                        ('route', 'method', 'status'))
+http_latency = Histogram('messenger_http_request_duration_seconds',
+                         'Время от начала запроса до заголовков ответа', ('route', 'method'))
+lock_wait_seconds = Histogram('messenger_lock_wait_seconds', 'Ожидание блокировки хранилища', ('lock',))
+lock_hold_seconds = Histogram('messenger_lock_hold_seconds', 'Удержание блокировки хранилища', ('lock',))
+persist_flush_seconds = Histogram('messenger_persist_flush_seconds',
+                                  'Запись истории на диск: журнал, снимок или транзакция SQLite', ('kind',))
+persist_bytes = Counter('messenger_persist_bytes_total', 'Записано байт истории', ('kind',))
+dns_lookup_seconds = Histogram('messenger_dns_lookup_seconds', 'Обратные DNS-запросы')
+active_clients = Gauge('messenger_active_clients', 'Ждущие long-poll запросы и открытые потоки SSE и WebSocket',
+                       ('transport',))
+
+
+class TimedLock:
+    """threading.Lock, который замеряет ожидание и удержание; годится и для threading.Condition.
+
+    Без конкуренции ожидание не замеряется вовсе (захват с первой попытки), а в гистограммы
+    значения попадают уже после освобождения — блокировка не держится дольше обычного.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._owner = None
+        self._waited = 0.0
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            waited = 0.0
+        else:
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            waited = time.perf_counter() - start
+        self._owner = threading.get_ident()
+        self._waited = waited
+        self._acquired_at = time.perf_counter()
+        return True
 
-        .message-footer {
-            display: flex;
-            justify-content: flex-end;
-            margin-top: 8px;
-            font-size: 0.75rem;
-            opacity: 0.8;
-        }
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        waited = self._waited
+        self._owner = None
+        self._lock.release()
+        lock_wait_seconds.observe(waited, self.name)
+        lock_hold_seconds.observe(held, self.name)
 
-        .datetime {
-            text-align: right;
-        }
+    def __enter__(self):
+        return self.acquire()
 
-        .message.other .datetime {
-            color: #666;
-        }
+    def __exit__(self, *exc_info):
+        self.release()
 
-        .message.own .datetime, .message.admin .datetime {
-            color: rgba(255,255,255,0.8);
-        }
+    # Для threading.Condition: wait() отпускает блокировку и захватывает ее снова
+    def _release_save(self):
+        self.release()
 
-        .no-messages {
-            text-align: center;
-            color: #666;
-            padding: 40px 20px;
-            font-size: 1.1rem;
-            flex: 1;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            flex-direction: column;
+    def _acquire_restore(self, state):
+        self.acquire()
+
+    def _is_owned(self):
+        return self._owner == threading.get_ident()
+
+
+def make_lock(name):
+    """Блокировка хранилища: с замерами для /metrics или обычная, если метрики выключены"""
+    return TimedLock(name) if METRICS_ENABLED else threading.Lock()
+
+
+class MessageStore:
+    """Хранилище сообщений. Все методы потокобезопасны.
+
+    log_message() пишет только через append(), маршруты читают через остальные методы.
+    """
+
+    load_seconds = 0.0  # Сколько заняла загрузка истории при открытии
+
+    def append(self, message_data):
+        """Присваивает сообщению id, сохраняет его и будит ждущих клиентов. Возвращает id"""
+        raise NotImplementedError
+
+    def update_ip(self, message_data, ip_display):
+        """Меняет отображаемый IP сообщения (имя хоста стало известно позже)"""
+        raise NotImplementedError
+
+    def last_id(self):
+        """id последнего сообщения (0, если сообщений нет)"""
+        raise NotImplementedError
+
+    def version(self):
+        """Счетчик изменений истории: растет с каждым новым сообщением и уточненным IP.
+        Читается без блокировки — по нему строится ETag"""
+        raise NotImplementedError
+
+    def size(self):
+        """Сколько сообщений сейчас в памяти"""
+        raise NotImplementedError
+
+    def last_message(self):
+        """Последнее сообщение (Message) или None"""
+        raise NotImplementedError
+
+    def admin_messages(self, limit):
+        """Последние limit сообщений администратора (Message, от старых к новым)"""
+        raise NotImplementedError
+
+    def recent(self, limit):
+        """Последние limit сообщений (Message, от старых к новым) для отрисовки страницы"""
+        raise NotImplementedError
+
+    def messages_since(self, since, compact=False):
+        """([(id, JSON), ...] для сообщений новее since, последний id); since=None — все окно.
+        compact — вместо JSON готовые строки компактного формата (encode_row)"""
+        raise NotImplementedError
+
+    def messages_before(self, before_id, limit, compact=False):
+        """([(id, JSON или строка), ...] для не более чем limit сообщений старше before_id, есть ли еще более старые)"""
+        raise NotImplementedError
+
+    def search(self, query, limit, offset=0):
+        """([(id, JSON), ...] для страницы найденных сообщений, лучшие первыми; всего найдено)"""
+        raise NotImplementedError
+
+    def wait(self, since, timeout):
+        """Ждет, пока последний id не станет отличаться от since. True, если дождались"""
+        raise NotImplementedError
+
+    def archived(self, low, high, by_time=False):
+        """Итератор кусков JSON Lines: ушедшие в архив сообщения с id (by_time — с ts) от low до high включительно"""
+        raise NotImplementedError
+
+    def export(self):
+        """Итератор кусков JSON Lines со всей сохраненной историей по возрастанию id"""
+        raise NotImplementedError
+
+    def import_messages(self, messages):
+        """Добавляет готовые сообщения (с id) пачкой; уже существующие id пропускаются.
+
+        Возвращает (сколько добавлено, id сообщений, которых в истории нет, но добавить их нельзя).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Сбрасывает все на диск и освобождает ресурсы"""
+
+
+def read_jsonl_tail(path, limit):
+    """Последние limit записей файла JSON Lines: файл читается с конца блоками, пока записей не хватит.
+
+    Поврежденные строки (например, недописанная последняя) пропускаются.
+    Возвращает (записи в порядке файла, сколько строк пропущено).
+    """
+    records = []
+    skipped = 0
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        partial = b''
+        while position > 0 and len(records) < limit:
+            size = min(HISTORY_READ_BLOCK, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + partial).split(b'\n')
+            # Первая строка блока может начинаться в предыдущем блоке
+            partial = lines.pop(0) if position > 0 else b''
+            for line in reversed(lines):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if not isinstance(record, dict) or not isinstance(record.get('id'), int):
+                    skipped += 1
+                    continue
+                records.append(record)
+                if len(records) == limit:
+                    break
+    records.reverse()
+    return records, skipped
+
+
+def read_json_array(path, limit):
+    """Снимок старого формата (один JSON-массив): последние limit сообщений.
+
+    Массив разбирается по одному сообщению, так что при повреждении остается все, что было до него.
+    Возвращает (сообщения, сколько записей пропущено).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    records = deque(maxlen=limit)
+    skipped = 0
+    last_id = 0
+    position = text.find('[') + 1
+    while position:
+        position = separators.match(text, position).end()
+        if position >= len(text) or text[position] == ']':
+            break
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except ValueError:
+            # Дальше файл не разобрать — оставляем прочитанное
+            skipped += 1
+            break
+        if not isinstance(record, dict):
+            skipped += 1
+            continue
+        # Старые файлы истории не содержат id — нумеруем по порядку
+        if 'id' not in record:
+            record['id'] = last_id + 1
+        last_id = record['id']
+        records.append(record)
+    return list(records), skipped
+
+
+class HistoryView:
+    """Неизменяемый снимок окна истории: записи history_entry() с позициями first..end-1.
+
+    Записи лежат в кусках по HISTORY_CHUNK_SIZE, chunks[0] — кусок номер chunk_base. Писатель
+    только дописывает в куски позиции от end и дальше, поэтому снимок можно читать без блокировок.
+    """
+
+    __slots__ = ('chunks', 'chunk_base', 'first', 'end')
+
+    def __init__(self, chunks, chunk_base, first, end):
+        self.chunks = chunks
+        self.chunk_base = chunk_base
+        self.first = first
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.first
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.end - self.first
+        if not 0 <= index < self.end - self.first:
+            raise IndexError(index)
+        position = self.first + index
+        return self.chunks[position // HISTORY_CHUNK_SIZE - self.chunk_base][position % HISTORY_CHUNK_SIZE]
+
+    def slice(self, start=0, stop=None):
+        """Записи с индексами start..stop-1 списком"""
+        size = self.end - self.first
+        stop = size if stop is None else min(stop, size)
+        result = []
+        position, end = self.first + max(0, start), self.first + stop
+        while position < end:
+            chunk = self.chunks[position // HISTORY_CHUNK_SIZE - self.chunk_base]
+            offset = position % HISTORY_CHUNK_SIZE
+            taken = min(HISTORY_CHUNK_SIZE - offset, end - position)
+            result.extend(chunk[offset:offset + taken])
+            position += taken
+        return result
+
+    def position(self, message_id):
+        """Индекс первой записи с id больше message_id"""
+        return bisect_right(self, message_id, key=lambda entry: entry[0])
+
+    def last_id(self):
+        return self[-1][0] if self.end > self.first else 0
+
+
+class HistoryLog:
+    """Окно последних maxlen сообщений, которое читают без блокировки.
+
+    Писатель (под блокировкой своего хранилища) дописывает записи и публикует новый
+    HistoryView; читатель берет текущий view одним чтением атрибута и работает с ним
+    сколько угодно — писатели его не ждут. Вытесненные куски остаются у тех, кто еще
+    держит старый снимок, и освобождаются вместе с ним.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.chunks = []
+        self.chunk_base = 0
+        self.first = 0
+        self.end = 0
+        self.view = HistoryView((), 0, 0, 0)
+
+    def __len__(self):
+        return self.end - self.first
+
+    def extend(self, entries):
+        """Дописывает записи; возвращает вытесненные из окна"""
+        chunks_changed = False
+        for entry in entries:
+            offset = self.end % HISTORY_CHUNK_SIZE
+            if offset == 0:
+                self.chunks.append([])
+                chunks_changed = True
+            self.chunks[-1].append(entry)
+            self.end += 1
+
+        evicted = []
+        if self.end - self.first > self.maxlen:
+            new_first = self.end - self.maxlen
+            evicted = self.view_of(self.chunks).slice(0, new_first - self.first)
+            self.first = new_first
+            # Куски целиком за пределами окна больше не нужны новым снимкам
+            while (self.chunk_base + 1) * HISTORY_CHUNK_SIZE <= self.first:
+                self.chunks.pop(0)
+                self.chunk_base += 1
+                chunks_changed = True
+        self.publish(chunks_changed)
+        return evicted
+
+    def append(self, entry):
+        return self.extend((entry,))
+
+    def clear(self):
+        """Окно начинается заново (старые снимки не меняются)"""
+        self.first = self.end
+        self.chunks = []
+        self.chunk_base = self.end // HISTORY_CHUNK_SIZE
+        if self.end % HISTORY_CHUNK_SIZE:
+            # Недописанный кусок продолжаем новым списком: старый принадлежит старым снимкам
+            self.chunks.append([None] * (self.end % HISTORY_CHUNK_SIZE))
+        self.publish(True)
+
+    def replace(self, index, entry):
+        """Заменяет запись (например, после уточнения IP); читатели видят старую или новую"""
+        position = self.first + index
+        self.chunks[position // HISTORY_CHUNK_SIZE - self.chunk_base][position % HISTORY_CHUNK_SIZE] = entry
+        self.view = self.view_of(self.view.chunks)
+
+    def view_of(self, chunks):
+        return HistoryView(chunks, self.chunk_base, self.first, self.end)
+
+    def publish(self, chunks_changed):
+        # Кортеж кусков пересобираем, только когда их список изменился (раз в HISTORY_CHUNK_SIZE записей)
+        self.view = self.view_of(tuple(self.chunks) if chunks_changed else self.view.chunks)
+
+
+class Archive:
+    """Архив сообщений, вытесненных из окна MemoryStore: неизменяемые сегменты gzip JSON Lines.
+
+    Сообщения дописываются в открытый сегмент (обычный JSON Lines). Когда в нем набирается
+    ARCHIVE_SEGMENT_SIZE сообщений, он сжимается в <первый id>-<последний id>.jsonl.gz, а рядом
+    кладется индекс .idx.json с диапазонами id и времени — по индексам archived() выбирает
+    нужные сегменты и не распаковывает остальные. id в сегменте идут по возрастанию, а время нет
+    (часы переводили, сообщения импортировали), поэтому для времени индекс хранит min_ts и max_ts.
+    """
+
+    OPEN_SEGMENT = 'open.jsonl'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = make_lock('archive')
+        # Индексы закрытых сегментов по возрастанию id. Папку создает первая запись
+        self.segments = []
+        for name in os.listdir(directory) if os.path.isdir(directory) else ():
+            if name.endswith('.idx.json'):
+                try:
+                    with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                        index = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Ошибка чтения индекса архива {name}: {e}")
+                    continue
+                if 'min_ts' not in index:
+                    # Индекс старого формата знал только время первого и последнего сообщения —
+                    # такой сегмент по времени всегда просматриваем целиком
+                    index['min_ts'], index['max_ts'] = -math.inf, math.inf
+                self.segments.append(index)
+        self.segments.sort(key=lambda index: index['first_id'])
+        sealed_id = self.segments[-1]['last_id'] if self.segments else 0
+
+        # Открытый сегмент. Если сервер упал после сжатия, но до удаления открытого сегмента,
+        # в нем остались уже заархивированные сообщения — их пропускаем
+        self.open_path = os.path.join(directory, self.OPEN_SEGMENT)
+        self.open_file = None
+        self.open_index = None
+        records = []
+        if os.path.exists(self.open_path):
+            try:
+                records, skipped = read_jsonl_tail(self.open_path, math.inf)
+                kept = [msg for msg in records if msg['id'] > sealed_id]
+                # Переписываем, если в сегменте лишние или поврежденные строки: индекс считает строки подряд
+                if skipped or len(kept) != len(records):
+                    records = kept
+                    with open(self.open_path, 'wb') as f:
+                        f.writelines(encode_message(msg) + b'\n' for msg in records)
+            except OSError as e:
+                print(f"Ошибка загрузки архива: {e}")
+                records = []
+        for msg in records:
+            self._index(history_entry(msg, b''))
+
+    def last_id(self):
+        """id последнего сообщения в архиве (0, если архив пуст)"""
+        if self.open_index is not None:
+            return self.open_index['last_id']
+        return self.segments[-1]['last_id'] if self.segments else 0
+
+    def _index(self, entry):
+        if self.open_index is None:
+            self.open_index = {'first_id': entry[0], 'min_ts': entry[2], 'max_ts': entry[2], 'count': 0}
+        index = self.open_index
+        index['last_id'] = entry[0]
+        index['min_ts'] = min(index['min_ts'], entry[2])
+        index['max_ts'] = max(index['max_ts'], entry[2])
+        index['count'] += 1
+
+    @staticmethod
+    def _bounds(index, key):
+        """Наименьшее и наибольшее значение key в сегменте"""
+        if key == 'id':
+            return index['first_id'], index['last_id']
+        return index['min_ts'], index['max_ts']
+
+    def add(self, entries):
+        """Дописывает записи окна истории (по возрастанию id); уже заархивированные пропускает"""
+        with self.lock:
+            last_id = self.last_id()
+            entries = [entry for entry in entries if entry[0] > last_id]
+            while entries:
+                # Сегмент дополняем ровно до ARCHIVE_SEGMENT_SIZE, остальное — в следующий
+                room = ARCHIVE_SEGMENT_SIZE - (self.open_index['count'] if self.open_index else 0)
+                part, entries = entries[:room], entries[room:]
+                lines = b''.join(entry[1] + b'\n' for entry in part)
+                start = time.perf_counter()
+                if self.open_file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self.open_file = open(self.open_path, 'ab')
+                self.open_file.write(lines)
+                if JOURNAL_SYNC in ('flush', 'fsync'):
+                    self.open_file.flush()
+                if JOURNAL_SYNC == 'fsync':
+                    os.fsync(self.open_file.fileno())
+                for entry in part:
+                    self._index(entry)
+                persist_flush_seconds.observe(time.perf_counter() - start, 'archive')
+                persist_bytes.inc('archive', amount=len(lines))
+                if self.open_index['count'] >= ARCHIVE_SEGMENT_SIZE:
+                    self._seal()
+
+    def _seal(self):
+        """Сжимает открытый сегмент в неизменяемый и начинает новый"""
+        index = self.open_index
+        name = f"{index['first_id']:012d}-{index['last_id']:012d}"
+        index['file'] = name + '.jsonl.gz'
+        path = os.path.join(self.directory, name)
+        start = time.perf_counter()
+        self.open_file.close()
+        self.open_file = None
+        with open(self.open_path, 'rb') as f:
+            data = f.read()
+        # Сначала сегмент, потом индекс и только потом удаляем открытый: упав на любом шаге,
+        # при запуске снова сожмем открытый сегмент и ничего не потеряем
+        for suffix, content in (('.jsonl.gz', gzip.compress(data, ARCHIVE_COMPRESS_LEVEL)),
+                                ('.idx.json', json.dumps(index).encode('utf-8'))):
+            with open(path + suffix + '.tmp', 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + suffix + '.tmp', path + suffix)
+        os.remove(self.open_path)
+        self.segments.append(index)
+        self.open_index = None
+        persist_flush_seconds.observe(time.perf_counter() - start, 'archive')
+
+    def read(self, low, high, by_time=False):
+        """Итератор кусков JSON Lines с сообщениями, у которых id (by_time — ts) от low до high"""
+        key = 'ts' if by_time else 'id'
+        with self.lock:
+            parts = [(index, os.path.join(self.directory, index['file'])) for index in self.segments
+                     if self._overlaps(index, key, low, high)]
+            # Открытый сегмент читаем до текущего конца: открываем под блокировкой, пока его не сжали
+            open_part = None
+            if self.open_index is not None and self._overlaps(self.open_index, key, low, high):
+                if self.open_file is not None:
+                    self.open_file.flush()
+                open_part = (dict(self.open_index), open(self.open_path, 'rb'))
+        return self._stream(parts, open_part, key, low, high)
+
+    @staticmethod
+    def _overlaps(index, key, low, high):
+        smallest, largest = Archive._bounds(index, key)
+        return smallest <= high and largest >= low
+
+    @staticmethod
+    def _stream(parts, open_part, key, low, high):
+        for index, path in parts:
+            with gzip.open(path, 'rb') as f:
+                yield from Archive._filter(f, index, key, low, high)
+        if open_part is not None:
+            index, f = open_part
+            with f:
+                yield from Archive._filter(f, index, key, low, high)
+
+    @staticmethod
+    def _filter(f, index, key, low, high):
+        smallest, largest = Archive._bounds(index, key)
+        if low <= smallest and largest <= high:
+            # Сегмент целиком в диапазоне — отдаем как есть, не разбирая строки
+            remaining = index['count']
+            while remaining:
+                block = f.read(ARCHIVE_READ_BLOCK)
+                if not block:
+                    break
+                # Открытый сегмент мог дорасти после индекса — обрезаем по числу строк из него
+                lines = block.count(b'\n')
+                if lines >= remaining:
+                    end = -1
+                    for _ in range(remaining):
+                        end = block.index(b'\n', end + 1)
+                    block = block[:end + 1]
+                    lines = remaining
+                remaining -= lines
+                yield block
+            return
+        chunk = []
+        for number, line in enumerate(f):
+            if number == index['count']:
+                break
+            msg = json.loads(line)
+            # Время считаем так же, как для индекса: у старых сообщений без ts — по datetime
+            value = msg['id'] if key == 'id' else history_entry(msg, b'')[2]
+            if low <= value <= high:
+                chunk.append(line)
+            elif value > high and key == 'id':
+                break
+        if chunk:
+            yield b''.join(chunk)
+
+    def close(self):
+        with self.lock:
+            if self.open_file is not None:
+                self.open_file.close()
+                self.open_file = None
+
+
+class MemoryStore(MessageStore):
+    """Последние max_size сообщений в памяти, на диске — снимок + журнал.
+
+    Годится только для одного процесса: у каждого воркера была бы своя история.
+    history_lock берут только писатели (и ждущие новых сообщений): читатели работают
+    с опубликованным снимком history.view. Вытесненные из окна сообщения уходят
+    в архив archive_dir (None — просто забываются).
+    """
+
+    def __init__(self, history_file, journal_path, max_size=MAX_HISTORY_SIZE, archive_dir=None):
+        self.history_file = history_file
+        self.journal_path = journal_path
+        self.max_size = max_size
+        self.legacy_snapshot = False
+        self.archive = Archive(archive_dir) if archive_dir else None
+        # Вытесненные из окна сообщения, которые фоновый писатель еще не дописал в архив
+        self.archive_pending = []
+        loaded = self.load_history()
+        # Окно истории: записи history_entry()
+        self.history = HistoryLog(max_size)
+        self.history.extend(history_entry(msg, encode_message(msg)) for msg in loaded)
+        self.compact_rows = CompactRows(COMPACT_CACHE_SIZE)
+        self.history_lock = make_lock('history')
+        # Будит long-poll и /stream клиентов при появлении новых сообщений
+        self.history_cond = threading.Condition(self.history_lock)
+        # Последний выданный id сообщения (монотонно растет)
+        self.last_message_id = loaded[-1]['id'] if loaded else 0
+        # Счетчик изменений для ETag
+        self.history_version = 0
+        # Поисковый индекс строим по загруженной истории и дальше обновляем в append()
+        self.search_index = SearchIndex()
+        for msg in loaded:
+            self.search_index.add(msg['id'], msg.get('message'))
+        # Последние сообщения администратора, чтобы не искать их перебором. Кортеж заменяется целиком,
+        # так что читается без блокировки; вытесненные из окна отбрасываются при чтении
+        self.admin_index = tuple(entry for entry in self.history.view.slice()
+                                 if entry[4] & Message.ADMIN)[-ADMIN_MESSAGES_KEPT:]
+
+        # Журнал: открытый на дозапись файл и число строк в нем с последнего снимка
+        self.journal_lock = make_lock('journal')
+        self.journal_file = None
+        self.journal_entries = 0
+        if self.legacy_snapshot:
+            # Снимок старого формата переписываем сразу, чтобы следующий запуск читал его с конца.
+            # Старый файл оставляем рядом: в нем могли остаться записи, которые не удалось разобрать
+            try:
+                shutil.copyfile(self.history_file, self.history_file + '.bak')
+                self.save_history()
+            except OSError as e:
+                print(f"Ошибка преобразования снимка истории: {e}")
+
+    def load_history(self):
+        """Загрузка при запуске: последние max_size сообщений снимка и журнала, файлы читаются с конца"""
+        started = time.perf_counter()
+        history = []
+        skipped = 0
+        if os.path.exists(self.history_file):
+            try:
+                with open(self.history_file, 'rb') as f:
+                    self.legacy_snapshot = f.read(64).lstrip().startswith(b'[')
+                if self.legacy_snapshot:
+                    snapshot, skipped = read_json_array(self.history_file, self.max_size)
+                else:
+                    snapshot, skipped = read_jsonl_tail(self.history_file, self.max_size)
+                history.extend(snapshot)
+            except (OSError, UnicodeError) as e:
+                print(f"Ошибка загрузки истории: {e}")
+
+        # Дописываем то, что попало в журнал после последнего снимка
+        if os.path.exists(self.journal_path):
+            last_id = history[-1]['id'] if history else 0
+            try:
+                # С архивом журнал читаем целиком: то, что не влезет в окно, должно попасть в архив
+                limit = self.max_size if self.archive is None else math.inf
+                records, journal_skipped = read_jsonl_tail(self.journal_path, limit)
+                skipped += journal_skipped
+            except OSError as e:
+                print(f"Ошибка загрузки журнала: {e}")
+                records = []
+            # Параллельные запросы могут записать строки не по порядку id
+            records.sort(key=lambda msg: msg['id'])
+            for msg in records:
+                if msg['id'] > last_id:
+                    history.append(msg)
+                    last_id = msg['id']
+
+        # Не поместившиеся в окно сообщения есть только в старом снимке — после падения
+        # они могли не успеть попасть в архив (повторно архив их не запишет)
+        overflow = len(history) - self.max_size
+        if overflow > 0:
+            if self.archive is not None:
+                self.archive_pending = [history_entry(msg, encode_message(msg)) for msg in history[:overflow]]
+            del history[:overflow]
+
+        self.load_seconds = time.perf_counter() - started
+        if skipped:
+            print(f"Пропущено поврежденных записей истории: {skipped}")
+        print(f"Загружено {len(history)} сообщений из {self.history_file} за {self.load_seconds:.3f} с")
+        return history
+
+    def append(self, message_data):
+        # Кодируем до блокировки; id — последнее поле JSON и первое в компактной строке, его допишем к готовым байтам
+        encoded = encode_message(message_data)[:-1]
+        row_tail = encode_row_tail(message_data)
+        tokens = tokenize(message_data['message'])
+        with self.history_cond:
+            # id выдаем под блокировкой, чтобы порядок id совпадал с порядком в истории
+            self.last_message_id += 1
+            message_data['id'] = self.last_message_id
+            encoded += b', "id": %d}' % self.last_message_id
+            entry = history_entry(message_data, encoded)
+            # Добавляем в конец (новые сообщения будут внизу); самые старые вытесняются из окна
+            evicted = self.history.append(entry)
+            if evicted and self.archive is not None:
+                self.archive_pending.extend(evicted)
+            self.history_version += 1
+            if message_data['admin']:
+                self.admin_index = (self.admin_index + (entry,))[-ADMIN_MESSAGES_KEPT:]
+            # В индекс — под той же блокировкой, иначе параллельные запросы добавят id не по порядку
+            self.search_index.add_tokens(message_data['id'], tokens)
+            # Строку компактного формата уже собрали — она понадобится рассылке, как только разбудим ждущих
+            self.compact_rows.put(self.last_message_id, encoded, b'[%d,' % self.last_message_id + row_tail)
+            # Будим всех, кто ждет новых сообщений
+            self.history_cond.notify_all()
+
+        for evicted_entry in evicted:
+            self.search_index.remove(evicted_entry[0], Message(evicted_entry).message)
+
+        # Запись в журнал делает фоновый поток, запрос не ждет диска
+        persist_queue.put((self, message_data))
+        return message_data['id']
+
+    def update_ip(self, message_data, ip_display):
+        with self.history_lock:
+            message_data['ip'] = ip_display
+            # Перекодируем, если сообщение уже в истории
+            view = self.history.view
+            index = view.position(message_data.get('id', 0)) - 1
+            if index >= 0 and view[index][0] == message_data['id']:
+                self.history.replace(index, history_entry(message_data, encode_message(message_data)))
+                self.history_version += 1
+
+    def import_messages(self, messages):
+        # id в окне и архиве идут по возрастанию, поэтому добавить можно только сообщения новее последнего.
+        # Более старый id либо уже есть (окно, очередь в архив, архив), либо отклоняется: вставить его
+        # в середину нельзя. Вся пачка — одна блокировка и одна запись в журнал
+        messages = {msg['id']: msg for msg in messages}
+        entries = sorted((history_entry(msg, encode_message(msg)) for msg in messages.values()), key=lambda entry: entry[0])
+        tokens = {message_id: tokenize(msg['message']) for message_id, msg in messages.items()}
+        evicted = []
+        with self.history_cond:
+            view = self.history.view
+            added, older = [], []
+            for entry in entries:
+                if entry[0] > self.last_message_id:
+                    added.append(entry)
+                    self.last_message_id = entry[0]
+                elif not self._in_memory(view, entry[0]):
+                    older.append(entry[0])
+            if added:
+                evicted = self.history.extend(added)
+                if evicted and self.archive is not None:
+                    self.archive_pending.extend(evicted)
+                self.history_version += 1
+                admin = tuple(entry for entry in added if entry[4] & Message.ADMIN)
+                if admin:
+                    self.admin_index = (self.admin_index + admin)[-ADMIN_MESSAGES_KEPT:]
+                for entry in added:
+                    self.search_index.add_tokens(entry[0], tokens[entry[0]])
+                self.history_cond.notify_all()
+
+        # Архив только дописывается: чего в нем нет сейчас, того там и не появится
+        archived = self._archived_ids(older)
+        rejected = [message_id for message_id in older if message_id not in archived]
+        for evicted_entry in evicted:
+            self.search_index.remove(evicted_entry[0], Message(evicted_entry).message)
+        if added:
+            # Пишем сразу, а не через фоновый писатель: ответ на импорт означает, что пачка на диске
+            self.append_to_journal([messages[entry[0]] for entry in added])
+        return len(added), rejected
+
+    def _in_memory(self, view, message_id):
+        """Есть ли сообщение в окне или в очереди в архив (вызывается под history_lock)"""
+        index = view.position(message_id) - 1
+        if index >= 0 and view[index][0] == message_id:
+            return True
+        index = bisect_left(self.archive_pending, message_id, key=lambda entry: entry[0])
+        return index < len(self.archive_pending) and self.archive_pending[index][0] == message_id
+
+    def _archived_ids(self, message_ids):
+        """Какие из message_ids уже лежат в архиве"""
+        if not message_ids or self.archive is None:
+            return set()
+        wanted = set(message_ids)
+        found = set()
+        for chunk in self.archive.read(min(wanted), max(wanted)):
+            found.update(json.loads(line)['id'] for line in chunk.splitlines())
+        return wanted & found
+
+    def export(self):
+        # Окно и еще не записанные в архив сообщения берем одним снимком; все, что старше, уже в архиве
+        with self.history_lock:
+            view = self.history.view
+            pending = tuple(self.archive_pending)
+        return self._export(view, pending)
+
+    def _export(self, view, pending):
+        first = pending[0][0] if pending else view[0][0] if view else self.last_message_id + 1
+        if self.archive is not None and first > 1:
+            yield from self.archive.read(0, first - 1)
+        for start in range(0, len(pending), BULK_BATCH_SIZE):
+            yield b''.join(entry[1] + b'\n' for entry in pending[start:start + BULK_BATCH_SIZE])
+        for start in range(0, len(view), BULK_BATCH_SIZE):
+            yield b''.join(entry[1] + b'\n' for entry in view.slice(start, start + BULK_BATCH_SIZE))
+
+    def last_id(self):
+        return self.last_message_id
+
+    def version(self):
+        return self.history_version
+
+    def size(self):
+        return len(self.history)
+
+    def last_message(self):
+        view = self.history.view
+        return Message(view[-1]) if view else None
+
+    def admin_messages(self, limit):
+        view = self.history.view
+        oldest = view[0][0] if view else 0
+        admin = [Message(entry) for entry in self.admin_index if entry[0] >= oldest]
+        return admin[max(0, len(admin) - limit):]
+
+    def recent(self, limit):
+        view = self.history.view
+        return [Message(entry) for entry in view.slice(max(0, len(view) - limit))]
+
+    def messages_since(self, since, compact=False):
+        # Без блокировки: снимок не меняется, копируются только ссылки на готовые байты
+        view = self.history.view
+        start = 0 if since is None else view.position(since)
+        entries = view.slice(start)
+        if compact:
+            return self.compact_rows.pairs(entries), view.last_id()
+        return [(entry[0], entry[1]) for entry in entries], view.last_id()
+
+    def messages_before(self, before_id, limit, compact=False):
+        view = self.history.view
+        end = bisect_left(view, before_id, key=lambda entry: entry[0])
+        start = max(0, end - limit)
+        entries = view.slice(start, end)
+        if compact:
+            return self.compact_rows.pairs(entries), start > 0
+        return [(entry[0], entry[1]) for entry in entries], start > 0
+
+    def search(self, query, limit, offset=0):
+        message_ids, total = self.search_index.search(query, limit, offset)
+        view = self.history.view
+        results = []
+        for message_id in message_ids:
+            index = view.position(message_id) - 1
+            # Сообщение могло только что уйти из окна истории
+            if index >= 0 and view[index][0] == message_id:
+                results.append((message_id, view[index][1]))
+        return results, total
+
+    def wait(self, since, timeout):
+        with self.history_cond:
+            # Условие "не равно", а не "больше": так ждущие просыпаются и после сброса истории
+            return self.history_cond.wait_for(lambda: self.last_message_id != since, timeout=timeout)
+
+    def append_to_journal(self, batch):
+        """Дописывает пачку сообщений в журнал; раз в JOURNAL_COMPACT_EVERY записей переписывает снимок"""
+        lines = ''.join(json.dumps(message_data, ensure_ascii=False) + '\n' for message_data in batch).encode('utf-8')
+        with self.journal_lock:
+            start = time.perf_counter()
+            try:
+                if self.journal_file is None:
+                    self.journal_file = open(self.journal_path, 'ab')
+                    # Если последняя строка недописана, начинаем с новой, чтобы не испортить и эту запись
+                    if self.journal_file.tell() > 0:
+                        with open(self.journal_path, 'rb') as f:
+                            f.seek(-1, os.SEEK_END)
+                            if f.read(1) != b'\n':
+                                self.journal_file.write(b'\n')
+                self.journal_file.write(lines)
+                if JOURNAL_SYNC in ('flush', 'fsync'):
+                    self.journal_file.flush()
+                if JOURNAL_SYNC == 'fsync':
+                    os.fsync(self.journal_file.fileno())
+                self.journal_entries += len(batch)
+                persist_flush_seconds.observe(time.perf_counter() - start, 'journal')
+                persist_bytes.inc('journal', amount=len(lines))
+            except Exception as e:
+                print(f"Ошибка записи в журнал: {e}")
+            need_compaction = self.journal_entries >= JOURNAL_COMPACT_EVERY
+
+        if need_compaction:
+            self.save_history()
+        elif self.archive_pending:
+            self.archive_evicted()
+
+    def archive_evicted(self):
+        """Дописывает в архив вытесненные сообщения и возвращает снимок окна на этот момент.
+
+        Все, что ушло из окна до снимка, к возврату уже в архиве — снимок можно писать поверх старого.
+        None, если архив записать не удалось: тогда старый снимок трогать нельзя.
+        """
+        with self.history_lock:
+            view = self.history.view
+            evicted = list(self.archive_pending)
+        if evicted:
+            try:
+                self.archive.add(evicted)
+            except Exception as e:
+                # Попробуем в следующий раз; до тех пор сообщения остаются в старом снимке
+                print(f"Ошибка записи в архив: {e}")
+                return None
+            # Из очереди убираем только после записи: пока запись идет, импорт и экспорт находят сообщения в очереди
+            with self.history_lock:
+                del self.archive_pending[:bisect_right(self.archive_pending, evicted[-1][0], key=lambda entry: entry[0])]
+        return view
+
+    def save_history(self):
+        """Сохраняет снимок последних max_size сообщений и очищает журнал"""
+        # Держим journal_lock, чтобы между снимком и очисткой журнала ничего не потерялось:
+        # все, что уже есть в журнале, к этому моменту есть и в окне истории
+        with self.journal_lock:
+            view = self.archive_evicted()
+            if view is None:
+                return
+            # Уже закодированные сообщения: снимок — это те же строки JSON, что и в журнале
+            encoded = [entry[1] for entry in view.slice()]
+            start = time.perf_counter()
+            try:
+                # Пишем во временный файл и атомарно подменяем — снимок никогда не бывает недописанным
+                tmp_file = self.history_file + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    if encoded:
+                        f.write(b'\n'.join(encoded) + b'\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                    snapshot_size = f.tell()
+                os.replace(tmp_file, self.history_file)
+
+                if self.journal_file is not None:
+                    self.journal_file.close()
+                self.journal_file = open(self.journal_path, 'wb')
+                self.journal_entries = 0
+                self.legacy_snapshot = False
+                persist_flush_seconds.observe(time.perf_counter() - start, 'snapshot')
+                persist_bytes.inc('snapshot', amount=snapshot_size)
+            except Exception as e:
+                print(f"Ошибка сохранения истории: {e}")
+
+    def archived(self, low, high, by_time=False):
+        if self.archive is None:
+            return iter(())
+        return self.archive.read(low, high, by_time)
+
+    def close(self):
+        """Сбрасывает буфер журнала и архива и закрывает файлы (важно для JOURNAL_SYNC = "none")"""
+        with self.journal_lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+        if self.archive is not None:
+            self.archive_evicted()
+            self.archive.close()
+
+
+class SQLiteStore(MessageStore):
+    """История в SQLite (режим WAL): одну базу безопасно делят несколько процессов-воркеров.
+
+    В базе хранится вся история без ограничения размера, в памяти — только горячее окно
+    из последних hot_window сообщений; за более старыми идем в базу по индексу.
+    О сообщениях, добавленных другими процессами, узнает фоновый поток: раз в
+    SQLITE_POLL_INTERVAL секунд он подтягивает их в окно и будит своих ждущих клиентов.
+    """
+
+    # Порядок колонок, который понимает _row_to_message()
+    COLUMNS = 'datetime, method, message, ip, admin, id, ts, encoded, compact'
+
+    def __init__(self, path, hot_window=SQLITE_HOT_WINDOW):
+        self.path = path
+        self.hot_window = hot_window
+        # У каждого потока свое соединение: соединения sqlite3 нельзя делить между потоками
+        self._local = threading.local()
+        # Все открытые соединения, чтобы close() закрыл и соединения других потоков
+        self._connections = []
+        self._cond = threading.Condition(make_lock('history'))
+        self._closed = False
+
+        conn = self._connection()
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            datetime TEXT NOT NULL,
+            method TEXT NOT NULL,
+            message TEXT,
+            ip TEXT NOT NULL,
+            admin INTEGER NOT NULL,
+            encoded BLOB NOT NULL,
+            ts INTEGER,
+            compact BLOB
+        )''')
+        # Базы, созданные до появления колонок ts и compact (у старых строк compact пуст — строится при чтении)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+        if 'ts' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN ts INTEGER')
+        if 'compact' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN compact BLOB')
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)')
+        # Для /admin-message: последние сообщения администратора без полного просмотра таблицы
+        conn.execute('CREATE INDEX IF NOT EXISTS messages_admin ON messages (admin, id)')
+
+        # Полнотекстовый индекс FTS5. Текст кладем уже нормализованным (normalize_text),
+        # поэтому таблица без собственной копии содержимого (content='')
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        if not has_fts:
+            conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(body, content='', tokenize='unicode61')")
+            self._rebuild_search_index(conn)
+
+        # Горячее окно: записи history_entry() последних сообщений, id идут подряд; читается без блокировки
+        self._hot = HistoryLog(hot_window)
+        self.compact_rows = CompactRows(COMPACT_CACHE_SIZE)
+        self._refresh_lock = threading.Lock()
+        self._last_id = 0
+        self._version = 0
+        self._refresh()
+
+        self._watcher = threading.Thread(target=self._watch, name='sqlite-watcher', daemon=True)
+        self._watcher.start()
+
+    def _connection(self):
+        if self._closed:
+            # Иначе запись после close() молча открыла бы новое соединение, которое никто не закроет
+            raise sqlite3.ProgrammingError("Хранилище закрыто")
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None — транзакциями управляем сами (BEGIN IMMEDIATE при записи)
+            # check_same_thread=False нужен только для того, чтобы close() мог закрыть его из другого потока
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._cond:
+                self._connections.append(conn)
+        return conn
+
+    @staticmethod
+    def _query_last_id(conn):
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+    @staticmethod
+    def _row_to_message(row):
+        return {
+            'datetime': row[0],
+            'method': row[1],
+            'message': row[2],
+            'ip': row[3],
+            'admin': bool(row[4]),
+            'id': row[5],
+            'ts': row[6],
         }
 
-        .input-container {
-            background-color: white;
-            padding: 20px;
-            border-top: 1px solid #e0e4e8;
-        }
+    @staticmethod
+    def _rebuild_search_index(conn):
+        """Индексирует сообщения, записанные до появления полнотекстового индекса"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT id, message FROM messages')
+            conn.executemany('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                             ((message_id, normalize_text(text)) for message_id, text in rows))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _refresh(self):
+        """Подтягивает в горячее окно сообщения новее последнего известного id и будит ждущих"""
+        with self._refresh_lock:
+            rows = self._connection().execute(
+                f'SELECT * FROM (SELECT {self.COLUMNS} FROM messages WHERE id > ? ORDER BY id DESC LIMIT ?) '
+                'ORDER BY id', (self._last_id, self.hot_window)).fetchall()
+            if not rows:
+                return
+            with self._cond:
+                if len(rows) == self.hot_window:
+                    # Новых сообщений больше, чем окно, — окно начинается заново
+                    self._hot.clear()
+                self._hot.extend(history_entry(self._row_to_message(row), row[7]) for row in rows)
+                for row in rows[-self.compact_rows.size:]:
+                    if row[8]:
+                        self.compact_rows.put(row[5], row[7], row[8])
+                self._last_id = rows[-1][5]
+                self._version += 1
+                self._cond.notify_all()
+
+    def _watch(self):
+        while not self._closed:
+            time.sleep(SQLITE_POLL_INTERVAL)
+            try:
+                self._refresh()
+            except sqlite3.Error as e:
+                if not self._closed:
+                    print(f"Ошибка опроса базы сообщений: {e}")
+
+    def append(self, message_data):
+        conn = self._connection()
+        start = time.perf_counter()
+        # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому выдача id не гоняется с другими процессами
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            message_id = self._query_last_id(conn) + 1
+            message_data['id'] = message_id
+            row = self._message_to_row(message_data)
+            conn.execute(
+                'INSERT INTO messages (id, datetime, method, message, ip, admin, ts, encoded, compact) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            conn.execute('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                         (message_id, normalize_text(message_data['message'])))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        persist_flush_seconds.observe(time.perf_counter() - start, 'sqlite')
+        persist_bytes.inc('sqlite', amount=len(row[7]))
+        self._refresh()
+        return message_id
+
+    @staticmethod
+    def _message_to_row(message_data):
+        return (message_data['id'], message_data['datetime'], message_data['method'], message_data['message'],
+                message_data['ip'], int(message_data['admin']), message_data.get('ts'), encode_message(message_data),
+                encode_row(message_data))
+
+    def import_messages(self, messages):
+        # Одна транзакция на пачку. По первичному ключу встает любой id, которого еще нет, — отклонять нечего
+        conn = self._connection()
+        added = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for msg in messages:
+                inserted = conn.execute(
+                    'INSERT OR IGNORE INTO messages (id, datetime, method, message, ip, admin, ts, encoded, compact) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', self._message_to_row(msg)).rowcount
+                if inserted:
+                    conn.execute('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                                 (msg['id'], normalize_text(msg.get('message'))))
+                    added += 1
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._refresh()
+        return added, []
+
+    def update_ip(self, message_data, ip_display):
+        message_data['ip'] = ip_display
+        # Если сообщение еще не записано, новое значение попадет в базу вместе с ним
+        if 'id' not in message_data:
+            return
+        encoded = encode_message(message_data)
+        row = encode_row(message_data)
+        self._connection().execute('UPDATE messages SET ip = ?, encoded = ?, compact = ? WHERE id = ?',
+                                   (ip_display, encoded, row, message_data['id']))
+        with self._cond:
+            view = self._hot.view
+            index = bisect_left(view, message_data['id'], key=lambda entry: entry[0])
+            if index < len(view) and view[index][0] == message_data['id']:
+                self._hot.replace(index, history_entry(message_data, encoded))
+                self.compact_rows.put(message_data['id'], encoded, row)
+                self._version += 1
+
+    def last_id(self):
+        return self._last_id
+
+    def version(self):
+        # Счетчик у каждого процесса свой, поэтому в ETag он идет вместе с last_id
+        return self._version
+
+    def size(self):
+        return len(self._hot)
+
+    def last_message(self):
+        view = self._hot.view
+        return Message(view[-1]) if view else None
+
+    def admin_messages(self, limit):
+        rows = self._connection().execute(
+            f'SELECT {self.COLUMNS} FROM messages WHERE admin = 1 ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [Message(history_entry(self._row_to_message(row), row[7])) for row in reversed(rows)]
+
+    def recent(self, limit):
+        view = self._hot.view
+        return [Message(entry) for entry in view.slice(max(0, len(view) - limit))]
+
+    @staticmethod
+    def _pairs(rows):
+        """[(id, JSON или строка)] из выборки (id, encoded, compact); пустой compact строится из JSON"""
+        return [(message_id, encoded if compact is None else compact or row_from_json(encoded))
+                for message_id, encoded, compact in rows]
+
+    def messages_since(self, since, compact=False):
+        view = self._hot.view
+        # Обычный случай: клиент отстал не дальше горячего окна — базу не трогаем
+        if since is None or not view or since >= view[0][0] - 1:
+            start = 0 if since is None else view.position(since)
+            entries = view.slice(start)
+            if compact:
+                return self.compact_rows.pairs(entries), view.last_id()
+            return [(entry[0], entry[1]) for entry in entries], view.last_id()
+
+        conn = self._connection()
+        # Читаем в одной транзакции, чтобы last_id соответствовал выбранным сообщениям
+        conn.execute('BEGIN')
+        try:
+            rows = conn.execute(
+                'SELECT * FROM (SELECT id, encoded, %s FROM messages WHERE id > ? ORDER BY id DESC LIMIT ?) ORDER BY id'
+                % ("coalesce(compact, x'')" if compact else 'NULL'), (since, MAX_HISTORY_SIZE)).fetchall()
+            last_id = self._query_last_id(conn)
+        finally:
+            conn.execute('COMMIT')
+        return self._pairs(rows), last_id
+
+    def search(self, query, limit, offset=0):
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+        # Каждое слово в кавычках: спецсимволы запроса не станут синтаксисом FTS5, слова объединяются через AND
+        match = ' '.join('"%s"' % term for term in terms)
+        conn = self._connection()
+        total = conn.execute('SELECT count(*) FROM messages_fts WHERE messages_fts MATCH ?', (match,)).fetchone()[0]
+        rows = conn.execute(
+            'SELECT m.id, m.encoded FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+            'WHERE messages_fts MATCH ? ORDER BY rank, m.id DESC LIMIT ? OFFSET ?', (match, limit, offset)).fetchall()
+        return rows, total
+
+    def messages_before(self, before_id, limit, compact=False):
+        # Страницы старой истории читаем из базы по первичному ключу; берем на одно больше, чтобы узнать has_more
+        rows = self._connection().execute(
+            'SELECT id, encoded, %s FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?'
+            % ("coalesce(compact, x'')" if compact else 'NULL'), (before_id, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        return self._pairs(rows[:limit][::-1]), has_more
+
+    def wait(self, since, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._last_id != since, timeout=timeout)
+
+    def archived(self, low, high, by_time=False):
+        # Вся история и так в базе: отдаем диапазон по индексу пачками, не собирая его в памяти.
+        # Куски могут забирать разные потоки, поэтому у выдачи свое соединение
+        column = 'ts' if by_time else 'id'
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        try:
+            cursor = conn.execute(f'SELECT encoded FROM messages WHERE {column} BETWEEN ? AND ? ORDER BY id', (low, high))
+            while True:
+                rows = cursor.fetchmany(BULK_BATCH_SIZE)
+                if not rows:
+                    break
+                yield b''.join(row[0] + b'\n' for row in rows)
+        finally:
+            conn.close()
+
+    def export(self):
+        return self.archived(0, sys.maxsize)
+
+    def close(self):
+        self._closed = True
+        if self._watcher is not threading.current_thread():
+            self._watcher.join()
+        with self._cond:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+# Фоновый писатель: MemoryStore.append() только кладет сообщение в очередь,
+# а запись на диск идет пачками в отдельном потоке. (хранилище, None) — закрыть
+# хранилище после того, как записано все, что было поставлено в очередь до этого
+persist_queue = queue.Queue()
+_STOP_PERSISTENCE = object()
+
+
+def persistence_worker():
+    """Собирает сообщения в пачки (до PERSIST_BATCH_SIZE или PERSIST_FLUSH_INTERVAL) и пишет их в журнал"""
+    stopping = False
+    while not stopping:
+        item = persist_queue.get()
+        if item is _STOP_PERSISTENCE:
+            break
+        batches = {}
+        closing = []
+        pending = 1
+        if item[1] is None:
+            closing.append(item)
+        else:
+            batches.setdefault(item[0], []).append(item[1])
+        deadline = time.monotonic() + PERSIST_FLUSH_INTERVAL
+        while pending < PERSIST_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = persist_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP_PERSISTENCE:
+                stopping = True
+                break
+            if item[1] is None:
+                closing.append(item)
+                break
+            batches.setdefault(item[0], []).append(item[1])
+            pending += 1
+        for target, batch in batches.items():
+            target.append_to_journal(batch)
+        for target, _, closed in closing:
+            target.close()
+            closed.set()
+
+
+# Файлы, по которым видно, что комната есть на диске (расширения к rooms/<имя>)
+ROOM_FILE_SUFFIXES = {'sqlite': ('.db',), 'memory': ('.json', '.jsonl', '.archive')}
+
+
+def room_on_disk(name):
+    """Есть ли на диске история комнаты (ее мог создать и другой воркер с общей базой)"""
+    base = os.path.join(ROOMS_DIR, name)
+    return any(os.path.exists(base + suffix) for suffix in ROOM_FILE_SUFFIXES.get(STORAGE_BACKEND, ()))
+
+
+def rooms_on_disk():
+    """Имена комнат, чья история лежит в ROOMS_DIR"""
+    try:
+        entries = os.listdir(ROOMS_DIR)
+    except OSError:
+        return set()
+    suffixes = ROOM_FILE_SUFFIXES.get(STORAGE_BACKEND, ())
+    return {name for name, suffix in map(os.path.splitext, entries)
+            if suffix in suffixes and ROOM_NAME_RE.match(name)}
+
+
+def create_store(room=DEFAULT_ROOM):
+    """Создает хранилище комнаты, выбранное в STORAGE_BACKEND"""
+    if room != DEFAULT_ROOM:
+        # У каждой комнаты свои файлы и меньший предел истории в памяти
+        os.makedirs(ROOMS_DIR, exist_ok=True)
+        base = os.path.join(ROOMS_DIR, room)
+        if STORAGE_BACKEND == 'sqlite':
+            return SQLiteStore(f"{base}.db", hot_window=ROOM_HISTORY_SIZE)
+        if STORAGE_BACKEND == 'memory':
+            return MemoryStore(f"{base}.json", f"{base}.jsonl", max_size=ROOM_HISTORY_SIZE,
+                               archive_dir=f"{base}.archive")
+        raise ValueError(f"Неизвестное хранилище: {STORAGE_BACKEND}")
+    if STORAGE_BACKEND == 'sqlite':
+        sqlite_store = SQLiteStore(SQLITE_FILE)
+        # Переезд с хранения в памяти: один раз переносим старую историю в пустую базу
+        if sqlite_store.last_id() == 0 and any(map(os.path.exists, (HISTORY_FILE, HISTORY_JOURNAL_FILE, ARCHIVE_DIR))):
+            # Вся история — окно и архив — потоком, пачками по BULK_BATCH_SIZE, как при /import
+            legacy_store = MemoryStore(HISTORY_FILE, HISTORY_JOURNAL_FILE, archive_dir=ARCHIVE_DIR)
+            importer = Importer(sqlite_store)
+            try:
+                for chunk in legacy_store.export():
+                    for line in chunk.splitlines():
+                        if importer.add(line):
+                            importer.flush()
+                importer.flush()
+            except ImportRejected as e:
+                print(f"Ошибка переноса истории: {e}")
+            finally:
+                legacy_store.close()
+            print(f"Перенесено в базу сообщений: {importer.counts['imported']}")
+        return sqlite_store
+    if STORAGE_BACKEND == 'memory':
+        return MemoryStore(HISTORY_FILE, HISTORY_JOURNAL_FILE, archive_dir=ARCHIVE_DIR)
+    raise ValueError(f"Неизвестное хранилище: {STORAGE_BACKEND}")
+
+
+class Room:
+    """Комната: свое хранилище (со своей блокировкой, счетчиком id и файлами) и своя рассылка"""
+
+    def __init__(self, name):
+        self.name = name
+        self.store = create_store(name)
+        self.broadcaster = None  # Рассылка WebSocket, создается с первым подключением
+        self.async_history = None  # Копия истории для ASGI, создается с первым запросом
+        # Сколько запросов и подключений сейчас работают с комнатой
+        self.clients = 0
+        self.last_used = time.monotonic()
+        self.closed = threading.Event()  # Хранилище дописано на диск и закрыто
+
+    def get_broadcaster(self):
+        if self.broadcaster is None:
+            self.broadcaster = Broadcaster(self.store)
+        return self.broadcaster
+
+    def close(self):
+        """Останавливает фоновые потоки комнаты; хранилище закроется, когда допишется его очередь"""
+        if self.broadcaster is not None:
+            self.broadcaster.close()
+        if self.async_history is not None:
+            self.async_history.close()
+        persist_queue.put((self.store, None, self.closed))
+
+
+class RoomLimitReached(Exception):
+    """Комнат уже MAX_ROOMS — новую не создаем"""
+
+
+class Rooms:
+    """Открытые комнаты. Комната загружается при первом обращении, а простаивающая дольше
+    ROOM_IDLE_TIMEOUT выгружается из памяти — память растет с числом активных комнат, а не всех.
+
+    Создает комнату только запись (acquire(name, create=True)): чтение несуществующей комнаты
+    не открывает хранилище и не оставляет на диске файлов.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        # Выгруженные комнаты, чьи хранилища еще дописываются на диск
+        self.closing = {}
+        # Комнаты, которые сейчас загружаются: имя -> Event, который выставят, когда загрузка закончится
+        self.loading = {}
+        # Комнаты, которые уже есть: найденные на диске при запуске и созданные с тех пор
+        self.known = rooms_on_disk() | {DEFAULT_ROOM}
+        self.lock = threading.Lock()
+        self.evict_checked = time.monotonic()
+        self.default = self.acquire(DEFAULT_ROOM)
+        self.release(self.default)
+
+    def exists(self, name):
+        if name in self.known:
+            return True
+        if room_on_disk(name):
+            with self.lock:
+                self.known.add(name)
+            return True
+        return False
+
+    def acquire(self, name, create=False):
+        """Комната по имени; пока она не отпущена через release(), ее не выгрузят.
+
+        None, если комнаты еще нет и create не задан. RoomLimitReached, если создать ее нельзя.
+        Загрузка идет без общей блокировки: пока одна комната читается с диска, другие доступны,
+        а запросы к ней самой ждут ту же загрузку.
+        """
+        if not self.exists(name):
+            if not create:
+                return None
+            with self.lock:
+                if name not in self.known and len(self.known) >= MAX_ROOMS:
+                    raise RoomLimitReached(f"Комнат уже {MAX_ROOMS}, новую создать нельзя")
+                self.known.add(name)
+        while True:
+            with self.lock:
+                room = self.rooms.get(name)
+                if room is not None:
+                    room.clients += 1
+                    room.last_used = time.monotonic()
+                    break
+                loading = self.loading.get(name)
+                loader = loading is None
+                if loader:
+                    loading = self.loading[name] = threading.Event()
+                    closing = self.closing.pop(name, None)
+            if not loader:
+                # Комнату уже загружает другой запрос — дожидаемся и берем готовую
+                loading.wait()
+                continue
+            try:
+                if closing is not None:
+                    # Комнату только что выгрузили — открываем файлы, только когда старое хранилище их допишет
+                    closing.closed.wait()
+                room = Room(name)
+            finally:
+                with self.lock:
+                    del self.loading[name]
+                    if room is not None:
+                        self.rooms[name] = room
+                        room.clients += 1
+                        room.last_used = time.monotonic()
+                loading.set()
+            break
+        self.evict_idle()
+        return room
+
+    def release(self, room):
+        with self.lock:
+            room.clients -= 1
+            room.last_used = time.monotonic()
+
+    @contextmanager
+    def using(self, name, create=False):
+        """Комната на время блока with (None, если ее нет, см. acquire())"""
+        room = self.acquire(name, create)
+        try:
+            yield room
+        finally:
+            if room is not None:
+                self.release(room)
+
+    def evict_idle(self):
+        """Выгружает комнаты без подключений, к которым давно не обращались (не чаще ROOM_EVICT_INTERVAL)"""
+        now = time.monotonic()
+        if now - self.evict_checked < ROOM_EVICT_INTERVAL:
+            return
+        with self.lock:
+            self.evict_checked = now
+            idle = [room for room in self.rooms.values()
+                    if room.name != DEFAULT_ROOM and room.clients == 0 and now - room.last_used > ROOM_IDLE_TIMEOUT]
+            for room in idle:
+                del self.rooms[room.name]
+                self.closing[room.name] = room
+            for name in [name for name, room in self.closing.items() if room.closed.is_set()]:
+                del self.closing[name]
+        for room in idle:
+            room.close()
+
+    def close_all(self):
+        with self.lock:
+            open_rooms, self.rooms = list(self.rooms.values()), {}
+        for room in open_rooms:
+            room.close()
 
-        .input-area {
-            display: flex;
-            padding: 0;
-        }
 
-        #message-input {
-            flex: 1;
-            padding: 15px 20px;
-            border: none;
-            border-radius: 30px;
-            font-size: 1.1rem;
-            outline: none;
-            background-color: #f0f4f8;
-            box-shadow: inset 0 2px 5px rgba(0,0,0,0.05);
-            transition: all 0.3s ease;
-        }
+# Инициализация истории
+rooms = Rooms()
 
-        #message-input:focus {
-            background-color: #e6eef9;
-            box-shadow: inset 0 2px 8px rgba(0,0,0,0.08);
-        }
+persist_thread = threading.Thread(target=persistence_worker, name='history-writer', daemon=True)
+persist_thread.start()
 
-        #send-button {
-            background: linear-gradient(to right, #4776E6, #8E54E9);
-            color: white;
-            border: none;
-            border-radius: 50%;
-            width: 50px;
-            height: 50px;
-            margin-left: 15px;
-            cursor: pointer;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 1.3rem;
-            box-shadow: 0 5px 15px rgba(135, 99, 232, 0.4);
-            transition: all 0.3s ease;
-        }
 
-        #send-button:hover {
-            transform: scale(1.05);
-            box-shadow: 0 7px 20px rgba(135, 99, 232, 0.6);
-        }
+@atexit.register
+def stop_persistence():
+    """Дописывает все, что осталось в очереди, и закрывает хранилища комнат"""
+    rooms.close_all()
+    if persist_thread.is_alive():
+        persist_queue.put(_STOP_PERSISTENCE)
+        persist_thread.join()
 
-        #send-button:disabled {
-            background: #e0e4e8;
-            cursor: not-allowed;
-            transform: none;
-            box-shadow: none;
-        }
 
-        @keyframes fadeIn {
-            from { opacity: 0; transform: translateY(10px); }
-            to { opacity: 1; transform: translateY(0); }
-        }
+def _handle_sigterm(signum, frame):
+    # SystemExit запускает обработчики atexit, так что очередь будет сброшена на диск
+    raise SystemExit(0)
 
-        .scroll-down {
-            position: absolute;
-            bottom: 10px;
-            right: 20px;
-            background: rgba(255,255,255,0.9);
-            width: 35px;
-            height: 35px;
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            cursor: pointer;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            opacity: 0;
-            transform: translateY(10px);
-            transition: all 0.3s ease;
-            z-index: 10;
-        }
 
-        .scroll-down.visible {
-            opacity: 1;
-            transform: translateY(0);
-        }
+# Ставим обработчик, только если SIGTERM никто не перехватил (gunicorn и т.п. ставят свой)
+if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+    signal.signal(signal.SIGTERM, _handle_sigterm)
 
-        @media (max-width: 768px) {
-            .container {
-                height: 100vh;
-                border-radius: 0;
-            }
-
-            .message {
-                max-width: 85%;
-            }
-
-            .header {
-                padding: 15px;
-                flex-direction: column;
-            }
-
-            .admin-link {
-                margin-top: 10px;
-                margin-left: 0;
-            }
-
-            h1 {
-                font-size: 1.5rem;
-            }
-
-            .input-container {
-                padding: 15px;
-            }
-        }
-    </style>
+# HTML шаблон для мессенджера
+HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>{% if room %}#{{ room }} — {% endif %}Local Messenger</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" href="{{ static_url('messenger.css') }}">
 </head>
 <body>
     <div class="container">
@@ -337,15 +2195,20 @@ HTML_TEMPLATE = """
                 <h1>Local Messenger</h1>
                 <div class="subtitle">End-to-end encrypted communication</div>
             </div>
-            <a href="/admin-message" class="admin-link">Последнее сообщение админа</a>
+            <a href="/admin-message{% if room %}?room={{ room }}{% endif %}" class="admin-link">Последнее сообщение админа</a>
         </div>
 
-        <div class="messages-container" id="messages-container">
+        <div class="messages-container" id="messages-container"
+             data-current-ip="{{ current_ip }}"
+             data-room="{{ room }}"
+             data-last-id="{{ history[-1].id if history else 0 }}"
+             data-oldest-id="{{ history[0].id if history else 0 }}">
             {% if history %}
                 {% for msg in history %}
-                    <div class="message{% if msg.is_own %} own{% elif msg.admin %} admin{% else %} other{% endif %}">
+                    {% set is_own = msg.ip.split(' ')[0] == current_ip %}
+                    <div class="message{% if is_own %} own{% elif msg.admin %} admin{% else %} other{% endif %}" data-id="{{ msg.id }}">
                         <div class="sender">
-                            {% if msg.is_own %}Вы{% elif msg.admin %}Админ{% else %}{{ msg.ip }}{% endif %}
+                            {% if is_own %}Вы{% elif msg.admin %}Админ{% else %}{{ msg.ip }}{% endif %}
                         </div>
                         <div class="content">{{ msg.message }}</div>
                         <div class="message-footer">
@@ -376,220 +2239,282 @@ HTML_TEMPLATE = """
         </div>
     </div>
 
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const input = document.getElementById('message-input');
-            const button = document.getElementById('send-button');
-            const messagesContainer = document.getElementById('messages-container');
-            const scrollDownBtn = document.getElementById('scroll-down');
-
-            let isAtBottom = true;
-            let lastMessageCount = {{ history|length if history else 0 }};
-            let updateInterval;
-            let currentIP = "{{ current_ip }}";  // IP текущего пользователя
-
-            // Прокрутить вниз при загрузке
-            scrollToBottom();
-
-            // Проверка положения скролла
-            messagesContainer.addEventListener('scroll', function() {
-                const isBottom = messagesContainer.scrollTop + messagesContainer.clientHeight >= messagesContainer.scrollHeight - 50;
-                scrollDownBtn.classList.toggle('visible', !isBottom);
-                isAtBottom = isBottom;
-            });
-
-            // Кнопка прокрутки вниз
-            scrollDownBtn.addEventListener('click', scrollToBottom);
-
-            function scrollToBottom() {
-                messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                scrollDownBtn.classList.remove('visible');
-                isAtBottom = true;
-            }
-
-            // Функция для отправки сообщения
-            async function sendMessage() {
-                const message = input.value.trim();
-                if (!message) return;
-
-                button.disabled = true;
-                input.disabled = true;
-
-                try {
-                    const response = await fetch('/message', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({ message })
-                    });
-
-                    const data = await response.json();
-
-                    if (data.status === 'success') {
-                        input.value = '';
-                        // После отправки сразу запрашиваем обновленную историю
-                        await checkForNewMessages();
-                    } else {
-                        console.error("Ошибка отправки:", data.message);
-                    }
-                } catch (error) {
-                    console.error("Ошибка сети:", error);
-                } finally {
-                    button.disabled = false;
-                    input.disabled = false;
-                    input.focus();
-                }
-            }
-
-            // Функция для проверки новых сообщений
-            async function checkForNewMessages() {
-                try {
-                    const response = await fetch('/get-messages');
-                    const data = await response.json();
-
-                    if (data.history && data.history.length > lastMessageCount) {
-                        // Получаем только новые сообщения
-                        const newMessages = data.history.slice(lastMessageCount);
-
-                        const noMessages = document.querySelector('.no-messages');
-                        if (noMessages && newMessages.length > 0) {
-                            noMessages.remove();
-                        }
-
-                        // Добавляем новые сообщения
-                        for (const msg of newMessages) {
-                            const messageElement = document.createElement('div');
-
-                            // Определяем класс сообщения
-                            let msgClass = 'other';
-                            if (msg.is_own) msgClass = 'own';
-                            else if (msg.admin) msgClass = 'admin';
-
-                            messageElement.className = `message ${msgClass}`;
-
-                            // Определяем отправителя
-                            let sender = msg.ip;
-                            if (msg.is_own) sender = 'Вы';
-                            else if (msg.admin) sender = 'Админ';
-
-                            // Формируем содержимое сообщения
-                            let contentHTML = `
-                                <div class="sender">${sender}</div>
-                                <div class="content">${msg.message}</div>
-                            `;
-
-                            // Добавляем IP только для чужих сообщений
-                            if (!msg.is_own && !msg.admin) {
-                                contentHTML += `<div class="ip-display">IP: ${msg.ip}</div>`;
-                            }
-
-                            contentHTML += `
-                                <div class="message-footer">
-                                    <div class="datetime">${msg.datetime}</div>
-                                </div>
-                            `;
-
-                            messageElement.innerHTML = contentHTML;
-                            messagesContainer.appendChild(messageElement);
-                        }
-
-                        // Обновляем счетчик сообщений
-                        lastMessageCount = data.history.length;
-
-                        // Прокрутка к новому сообщению, если пользователь внизу
-                        if (isAtBottom) {
-                            scrollToBottom();
-                        }
-                    }
-                } catch (error) {
-                    console.error("Ошибка при проверке новых сообщений:", error);
-                }
-            }
-
-            // Запускаем периодическую проверку новых сообщений
-            updateInterval = setInterval(checkForNewMessages, 1000);
-
-            // Обработчики событий
-            button.addEventListener('click', sendMessage);
-
-            input.addEventListener('keypress', (e) => {
-                if (e.key === 'Enter') {
-                    sendMessage();
-                }
-            });
-
-            // Автофокус на поле ввода
-            input.focus();
-
-            // Остановка интервала при закрытии страницы
-            window.addEventListener('beforeunload', () => {
-                clearInterval(updateInterval);
-            });
-        });
-    </script>
+    <script src="{{ static_url('messenger.js') }}" defer></script>
 </body>
 </html>
 """
 
+# Шаблон компилируется один раз при запуске, а не на каждый запрос
+PAGE_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 
-def save_history():
-    """Сохраняет текущую историю в файл"""
-    with history_lock:
-        history_list = list(message_history)
+@functools.lru_cache(maxsize=None)
+def static_url(filename):
+    """URL статического файла с хэшем содержимого: браузер кэширует его навсегда,
+    а после изменения файла получит новый адрес"""
     try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(history_list, f, indent=2)
-    except Exception as e:
-        print(f"Ошибка сохранения истории: {e}")
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = hashlib.sha1(f.read()).hexdigest()[:12]
+    except OSError as e:
+        print(f"Ошибка чтения статического файла {filename}: {e}")
+        return f"/static/{filename}"
+    return f"/static/{filename}?v={version}"
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Время и код ответа по маршрутам. Зарегистрирован первым — выполняется последним, со сжатием"""
+    started = g.get('request_started')
+    if METRICS_ENABLED and started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_latency.observe(time.perf_counter() - started, route, request.method)
+        http_requests.inc(route, request.method, str(response.status_code))
+    return response
+
+
+@app.after_request
+def cache_static(response):
+    """Файлы с версией в адресе не меняются — разрешаем кэшировать их без перепроверки"""
+    if request.endpoint == 'static' and 'v' in request.args and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+
+def history_etag(store, compact=False):
+    """ETag текущей версии истории комнаты; читается без блокировки истории"""
+    return f"h{store.last_id()}-{store.version()}{'-c' if compact else ''}"
+
+
+def wants_compact(args, accept):
+    """Просит ли клиент компактный формат: ?format=compact или Accept, где COMPACT_MIMETYPE предпочтительнее JSON"""
+    if 'format' in args:
+        return args.get('format') == 'compact'
+    return accept[COMPACT_MIMETYPE] > accept['application/json']
+
+
+def not_modified(etag):
+    """Пустой 304, если у клиента уже есть эта версия ответа, иначе None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+def with_etag(response, etag):
+    """Помечает ответ версией: браузер будет переспрашивать и получать 304, пока ничего не изменилось"""
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+# Сжатые тела ответов: (адрес, ETag, кодировка) -> байты. Порядок — LRU
+compressed_cache = OrderedDict()
+compressed_cache_lock = threading.Lock()
+
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def choose_encoding(accepted):
+    """Лучшая поддерживаемая клиентом кодировка сжатия (по разобранному Accept-Encoding) или None"""
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_cached(body, encoding, key):
+    """Сжимает тело; если задан key (адрес, ETag, кодировка), берет результат из кэша или кладет в него"""
+    if key is None:
+        return compress_body(body, encoding)
+    with compressed_cache_lock:
+        compressed = compressed_cache.get(key)
+        if compressed is not None:
+            compressed_cache.move_to_end(key)
+            return compressed
+    compressed = compress_body(body, encoding)
+    with compressed_cache_lock:
+        compressed_cache[key] = compressed
+        while len(compressed_cache) > COMPRESS_CACHE_SIZE:
+            compressed_cache.popitem(last=False)
+    return compressed
+
+
+@app.after_request
+def compress_response(response):
+    """Сжимает ответ (brotli или gzip — что поддерживает клиент).
+
+    Ответы с ETag одинаковы для всех, кто пришел за той же версией, поэтому их
+    сжатые тела кэшируются: горячий ответ сжимается один раз, а не для каждого клиента.
+    """
+    if response.mimetype not in COMPRESSIBLE_TYPES or response.is_streamed or response.status_code != 200:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (request.full_path, etag, encoding) if etag else None
+    response.set_data(compress_cached(body, encoding, key))
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое тело отличается побайтно, поэтому строгий ETag становится слабым
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def normalize_ip(client_ip):
+    """Адрес без порта в каноническом виде: '10.0.0.1:80' -> '10.0.0.1', '[2001:DB8::5]:443' -> '2001:db8::5'.
+
+    Порт отрезается только у IPv4 (адрес:порт) и у IPv6 в квадратных скобках: в голом IPv6 двоеточия — часть
+    адреса. Зона (fe80::1%eth0) остается, IPv4 из смешанного вида (::ffff:10.0.0.1) достается как IPv4.
+    """
+    address = client_ip.strip()
+    if address.startswith('['):
+        address = address[1:].partition(']')[0]
+    elif address.count(':') == 1:
+        address = address.partition(':')[0]
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return str(ip)
+
+
+def client_address(remote_addr, forwarded_for):
+    """IP клиента по адресу соединения и заголовку X-Forwarded-For.
+
+    Заголовок пишет кто угодно, поэтому он учитывается, только если соединение пришло от прокси
+    из TRUSTED_PROXIES. Каждый прокси дописывает адрес справа — клиент первый справа не из них.
+    """
+    address = normalize_ip(remote_addr or '')
+    if forwarded_for and address in TRUSTED_PROXIES:
+        for hop in reversed(forwarded_for.split(',')):
+            address = normalize_ip(hop)
+            if address not in TRUSTED_PROXIES:
+                break
+    return address
+
+
+def get_client_ip():
+    """IP клиента текущего запроса Flask"""
+    return client_address(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+
+def too_many_requests(retry_after, message="Слишком много запросов, попробуйте позже"):
+    """Ответ 429 с заголовком Retry-After (целые секунды)"""
+    response = jsonify({"status": "error", "message": message, "retry_after": math.ceil(retry_after)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
+def with_room(view=None, *, create=False, missing=None):
+    """Передает обработчику комнату запроса (/r/<room> или ?room=); пока он работает, комнату не выгрузят.
+
+    Комнату, которой еще нет, создают только обработчики записи (create=True). Для остальных
+    отвечает missing(имя комнаты), а без него — 404.
+    """
+    if view is None:
+        return functools.partial(with_room, create=create, missing=missing)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        name = kwargs.pop('room', None) or request.args.get('room', DEFAULT_ROOM)
+        if not ROOM_NAME_RE.match(name):
+            abort(404)
+        try:
+            with rooms.using(name, create) as room:
+                if room is None:
+                    if missing is None:
+                        abort(404)
+                    return missing(name)
+                return view(room, *args, **kwargs)
+        except RoomLimitReached as e:
+            return jsonify({"status": "error", "message": str(e)}), 503
+    return wrapper
+
+
+def admin_only(view):
+    """Обработчик только для администратора; проверка идет раньше with_room, чтобы не создать комнату"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if get_client_ip() != ADMIN_IP:
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def empty_page(name):
+    """Страница комнаты, которой еще нет: пустая, комната появится с первым сообщением"""
+    return PAGE_TEMPLATE.render(history=[], current_ip=get_client_ip(), static_url=static_url, room=name)
 
 
 @app.route('/')
-def home():
+@app.route('/r/<room>')
+@with_room(missing=empty_page)
+def home(room):
+    store = room.store
     # Получаем IP текущего пользователя
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    current_ip = client_ip.split(',')[0].strip() if ',' in client_ip else client_ip
-    current_ip = current_ip.split(':')[0]  # Убираем порт
+    current_ip = get_client_ip()
 
-    # Помечаем сообщения как "свои" для текущего пользователя
-    with history_lock:
-        history = []
-        for msg in list(message_history):
-            # Создаем копию сообщения, чтобы не изменять оригинал
-            msg_copy = msg.copy()
-            # Сравниваем IP без порта
-            msg_ip = msg_copy['ip'].split(':')[0]  # Убираем порт
-            msg_copy['is_own'] = (msg_ip == current_ip)
-            history.append(msg_copy)
+    # Страница зависит от версии истории, IP клиента ("свои" сообщения) и версий статики
+    page_context = f"{current_ip} {static_url('messenger.css')} {static_url('messenger.js')}"
+    etag = f"{history_etag(store)}-{hashlib.sha1(page_context.encode()).hexdigest()[:12]}"
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
 
-    return render_template_string(HTML_TEMPLATE, history=history, current_ip=current_ip)
+    # Рисуем только последние сообщения — более старые страница подгрузит при прокрутке
+    history = store.recent(INITIAL_MESSAGES)
+
+    page = PAGE_TEMPLATE.render(history=history, current_ip=current_ip, static_url=static_url,
+                                room=room.name if room.name != DEFAULT_ROOM else '')
+    return with_etag(app.make_response(page), etag)
 
 
 @app.route('/message', methods=['POST'])
-def handle_message():
+@with_room(create=True)
+def handle_message(room):
     # Получаем IP-адрес клиента
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    clean_ip = client_ip.split(',')[0].strip() if ',' in client_ip else client_ip
-    clean_ip = clean_ip.split(':')[0]  # Убираем порт
+    clean_ip = get_client_ip()
 
     # Извлекаем сообщение
     message = None
     json_data = request.get_json(silent=True)
-    if json_data and 'message' in json_data:
-        message = json_data['message']
-
-    # Логируем сообщение
-    if len(message_history) == 0:
-        if 'porn' in message:
-            message = 'Я тупой даун'
-        is_admin = (clean_ip == ADMIN_IP)
-        log_message('POST', message, clean_ip, is_admin)
-    else:
-        if message != message_history[-1]['message']:
-            if 'porn' in message:
-                message = 'Я тупой даун'
-            is_admin = (clean_ip == ADMIN_IP)
-            log_message('POST', message, clean_ip, is_admin)
+    if isinstance(json_data, dict):
+        message = json_data.get('message')
+
+    try:
+        message = submit_message(room.store, 'POST', message, clean_ip)
+    except RateLimited as e:
+        return too_many_requests(e.retry_after, str(e))
+    except MessageRejected as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
     return jsonify({
         "status": "success",
@@ -599,67 +2524,713 @@ def handle_message():
     })
 
 
-@app.route('/get-messages')
-def get_messages():
-    # Получаем IP текущего пользователя
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-    current_ip = client_ip.split(',')[0].strip() if ',' in client_ip else client_ip
-    current_ip = current_ip.split(':')[0]  # Убираем порт
+class RateLimiter:
+    """Корзина токенов для каждого клиента: в среднем rate запросов в секунду, до burst подряд.
+
+    Таблица корзин ограничена: давно не приходившие клиенты вытесняются, а корзина, которая
+    успела бы наполниться целиком, ничем не отличается от новой и просто удаляется.
+    """
+
+    def __init__(self, rate, burst, max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # Клиент -> (токены, когда обновлялись). Порядок — по последнему запросу
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """0, если запрос можно выполнить, иначе через сколько секунд повторить"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        refill_time = self.burst / self.rate
+        with self.lock:
+            # Устаревшие записи — в начале таблицы
+            while self.buckets:
+                oldest = next(iter(self.buckets))
+                if now - self.buckets[oldest][1] < refill_time and len(self.buckets) < self.max_clients:
+                    break
+                del self.buckets[oldest]
+
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            return retry_after
+
+
+class DuplicateDetector:
+    """Хэши сообщений каждого клиента за последние window секунд: ловит повторы,
+    даже если их перемежают другими сообщениями"""
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        # (клиент, хэш) -> когда отправлено. Порядок — по времени
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check(self, key, text):
+        """0, если сообщение новое (и запоминает его), иначе через сколько секунд повтор будет принят"""
+        digest = hashlib.blake2b(normalize_text(text).strip().encode('utf-8'), digest_size=8).digest()
+        now = time.monotonic()
+        with self.lock:
+            while self.seen:
+                oldest = next(iter(self.seen))
+                if now - self.seen[oldest] < self.window and len(self.seen) < self.max_entries:
+                    break
+                del self.seen[oldest]
+
+            seen_at = self.seen.get((key, digest))
+            if seen_at is not None:
+                return self.window - (now - seen_at)
+            self.seen[(key, digest)] = now
+            return 0
+
+
+class MessageRejected(Exception):
+    """Фильтр не пропустил сообщение; текст исключения показывается клиенту"""
+
+
+class RateLimited(MessageRejected):
+    """Клиент превысил лимит; повторить можно через retry_after секунд"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+post_limiter = RateLimiter(POST_RATE, POST_BURST)
+poll_limiter = RateLimiter(POLL_RATE, POLL_BURST)
+duplicates = DuplicateDetector(DUPLICATE_WINDOW, DUPLICATE_MAX_ENTRIES)
+
+
+blocklist = Blocklist(BLOCKLIST_FILE)
+
+
+def blocklist_filter(message):
+    """Фильтр запрещенных слов: действие задает FILTER_ACTION"""
+    content_filter = blocklist.current()
+    if FILTER_ACTION == 'mask':
+        return content_filter.mask(message)
+    if content_filter.search(message):
+        if FILTER_ACTION == 'reject':
+            raise MessageRejected("Сообщение содержит запрещенные слова")
+        return FILTER_REPLACEMENT
+    return message
+
+
+# Фильтры по порядку: функция(текст) -> новый текст или исключение MessageRejected
+MESSAGE_FILTERS = [blocklist_filter]
+
+
+def submit_message(store, method, message, clean_ip):
+    """Проверяет сообщение и логирует его в хранилище комнаты (общий путь записи для /message и /ws).
+    Возвращает итоговый текст"""
+    # Фильтры и хранилище работают со строкой: null, число или объект в "message" — ошибка клиента
+    if not isinstance(message, str):
+        raise MessageRejected("Нет текста сообщения")
+    retry_after = post_limiter.take(clean_ip)
+    if retry_after:
+        raise RateLimited("Слишком много сообщений, попробуйте позже", retry_after)
+
+    # Фильтры — раньше проверки повторов: отклоненное сообщение не должно запомниться как отправленное,
+    # иначе его исправленный вариант упрется в окно повторов
+    text = message
+    for message_filter in MESSAGE_FILTERS:
+        text = message_filter(text)
+
+    # Повтор последнего сообщения не записываем
+    last_message = store.last_message()
+    if last_message is not None and message == last_message.message:
+        return text
+    # Повторы вперемешку с другими сообщениями отклоняем. Сравниваем исходный текст: замененные
+    # фильтром разные сообщения повторами друг друга не считаются
+    retry_after = duplicates.check(clean_ip, message)
+    if retry_after:
+        raise RateLimited("Такое сообщение уже было отправлено", retry_after)
+
+    log_message(store, method, text, clean_ip, clean_ip == ADMIN_IP)
+    return text
+
+
+def history_body(messages, last_id, has_more=None, compact=False):
+    """Собирает JSON {"history": [...], "last_id": N} склейкой готовых фрагментов.
+
+    compact — {"columns": [...], "rows": [[...], ...], "last_id": N}: имена полей один раз,
+    messages уже содержат строки компактного формата.
+    """
+    parts = [
+        b'{"columns":%s,"rows":[' % COMPACT_COLUMNS_JSON if compact else b'{"history":[',
+        b','.join(encoded for _, encoded in messages),
+        b'],"last_id":',
+        str(last_id).encode(),
+    ]
+    if has_more is not None:
+        parts.append(b',"has_more":true' if has_more else b',"has_more":false')
+    parts.append(b'}')
+    return b''.join(parts)
+
+
+def history_response(messages, last_id, has_more=None, compact=False):
+    response = Response(history_body(messages, last_id, has_more, compact),
+                        mimetype=COMPACT_MIMETYPE if compact else 'application/json')
+    response.vary.add('Accept')
+    return response
+
+
+def empty_history(name):
+    """/get-messages комнаты, которой еще нет: пустая история. Long-poll ждет, пока комнату не создадут"""
+    retry_after = poll_limiter.take(get_client_ip())
+    if retry_after:
+        return too_many_requests(retry_after)
+    compact = wants_compact(request.args, request.accept_mimetypes)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    if request.args.get('since', type=int) is not None and wait > 0:
+        deadline = time.monotonic() + wait
+        with active_clients.track('long_poll'):
+            # Проверяем и диск: комнату может создать другой воркер
+            while not rooms.exists(name) and time.monotonic() < deadline:
+                time.sleep(min(ROOM_WAIT_INTERVAL, max(0, deadline - time.monotonic())))
+    has_more = False if 'before' in request.args or 'limit' in request.args else None
+    return history_response([], 0, has_more, compact)
 
-    with history_lock:
-        history = []
-        for msg in list(message_history):
-            # Создаем копию сообщения, чтобы не изменять оригинал
-            msg_copy = msg.copy()
-            # Сравниваем IP без порта
-            msg_ip = msg_copy['ip'].split(':')[0]  # Убираем порт
-            msg_copy['is_own'] = (msg_ip == current_ip)
-            history.append(msg_copy)
-
-    return jsonify(history=history)
 
-
-@app.route('/admin-message')
-def admin_message():
-    """Страница с последним сообщением администратора"""
-    with history_lock:
-        # Ищем последнее сообщение администратора
-        admin_messages = [msg for msg in reversed(message_history) if msg.get('admin')]
-
-        if admin_messages:
-            last_admin_msg = admin_messages[0]['message']
-            return last_admin_msg
+@app.route('/get-messages')
+@with_room(missing=empty_history)
+def get_messages(room):
+    store = room.store
+    retry_after = poll_limiter.take(get_client_ip())
+    if retry_after:
+        return too_many_requests(retry_after)
+    # Компактный формат: ?format=compact или Accept: application/vnd.messenger.compact+json
+    compact = wants_compact(request.args, request.accept_mimetypes)
+
+    # Постраничная загрузка старой истории: ?before=<id>&limit=N
+    before = request.args.get('before', type=int)
+    if before is not None:
+        etag = history_etag(store, compact)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        history, has_more = store.messages_before(before, limit, compact)
+        return with_etag(history_response(history, store.last_id(), has_more, compact), etag)
+
+    # Курсор: id последнего сообщения, которое уже есть у клиента
+    since = request.args.get('since', type=int)
+    # Long-polling: сколько секунд можно ждать новых сообщений
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+
+    if since is not None and wait > 0:
+        # Ждем, пока log_message() не разбудит
+        with active_clients.track('long_poll'):
+            store.wait(since, wait)
+
+    # Ответ зависит только от адреса и версии истории ("свои" сообщения отмечает клиент),
+    # так что при неизменной истории отвечаем 304, не трогая ее
+    etag = history_etag(store, compact)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    history, last_id = store.messages_since(since, compact)
+
+    # Догрузка выгруженных со страницы сообщений: ?since=<id>&limit=N
+    if 'limit' in request.args:
+        limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        has_more = len(history) > limit
+        if has_more:
+            history = history[:limit]
+            last_id = history[-1][0]
+        return with_etag(history_response(history, last_id, has_more, compact), etag)
+
+    # Сериализация — уже без блокировки
+    return with_etag(history_response(history, last_id, compact=compact), etag)
+
+
+@app.route('/stream')
+@with_room
+def stream(room):
+    """Server-Sent Events: новые сообщения отправляются сразу после записи.
+
+    ?format=compact — в событиях строки компактного формата, имена полей приходят первым событием "columns".
+    """
+    store = room.store
+    retry_after = poll_limiter.take(get_client_ip())
+    if retry_after:
+        return too_many_requests(retry_after)
+    compact = wants_compact(request.args, request.accept_mimetypes)
+
+    # При переподключении браузер сам присылает id последнего полученного события
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        since = store.last_id()
+
+    def events():
+        cursor = since
+        if compact:
+            yield b'event: columns\ndata: ' + COMPACT_COLUMNS_JSON + b'\n\n'
+        with active_clients.track('stream'):
+            while True:
+                store.wait(cursor, STREAM_HEARTBEAT)
+                history, last_id = store.messages_since(cursor, compact)
+
+                if last_id == cursor:
+                    # Никого нет — пустое событие-комментарий держит соединение живым
+                    yield b": ping\n\n"
+                    continue
+                if last_id < cursor:
+                    # История на сервере была сброшена — клиент должен перенести курсор назад
+                    yield f"event: reset\ndata: {json.dumps({'last_id': last_id})}\n\n".encode()
+                for message_id, encoded in history:
+                    yield b''.join((b'id: ', str(message_id).encode(), b'\ndata: ', encoded, b'\n\n'))
+                cursor = last_id
+
+    response = Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Отключаем буферизацию в nginx
+    })
+    # Комната нужна, пока открыт поток, а не только пока работает обработчик
+    streaming_room = rooms.acquire(room.name)
+    response.call_on_close(lambda: rooms.release(streaming_room))
+    return response
+
+
+# Отметка в очереди WebSocket-клиента: очередь переполнилась, нужно догнать историю из хранилища
+_RESYNC = object()
+
+
+def message_frame(encoded, compact=False):
+    """Кадр WebSocket с сообщением: {"type":"message","message":{...}} или {"type":"row","row":[...]}"""
+    return b''.join((b'{"type":"row","row":' if compact else b'{"type":"message","message":', encoded, b'}'))
+
+
+def columns_frame():
+    """Первый кадр для клиента компактного формата: имена полей строк"""
+    return b'{"type":"columns","columns":%s}' % COMPACT_COLUMNS_JSON
+
+
+class Broadcaster:
+    """Рассылает новые сообщения WebSocket-клиентам.
+
+    Один поток ждет новых сообщений в хранилище и раскладывает готовые кадры по
+    ограниченным очередям подписчиков. Медленный клиент не задерживает рассылку:
+    при переполнении его очередь сбрасывается, и он сам догоняет историю из хранилища.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # Очередь подписчика -> нужен ли ему компактный формат
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def subscribe(self, compact=False):
+        subscriber = queue.Queue(maxsize=WS_SEND_QUEUE)
+        if compact:
+            subscriber.put_nowait((None, columns_frame().decode()))
+        with self.lock:
+            self.subscribers[subscriber] = compact
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='ws-broadcast', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+
+    def publish(self, message_id, frame, compact_frame=None):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for subscriber, compact in subscribers:
+            if compact and frame is not _RESYNC:
+                # Нет строки (сообщение успело уйти из окна) — такой клиент догонит историю из хранилища
+                frame_sent = compact_frame or _RESYNC
+            else:
+                frame_sent = frame
+            try:
+                subscriber.put_nowait((message_id, frame_sent))
+            except queue.Full:
+                # Клиент не успевает читать — выбрасываем его очередь и просим догнать историю
+                stopped = False
+                try:
+                    while True:
+                        stopped = subscriber.get_nowait()[1] is None or stopped
+                except queue.Empty:
+                    pass
+                # Отметку об отключении клиента не теряем
+                subscriber.put_nowait((message_id, None if stopped else _RESYNC))
+
+    def close(self):
+        # Поток заметит это после очередного ожидания
+        self.closed = True
+
+    def _run(self):
+        cursor = self.store.last_id()
+        while not self.closed:
+            self.store.wait(cursor, STREAM_HEARTBEAT)
+            history, last_id = self.store.messages_since(cursor)
+            if last_id < cursor:
+                # История на сервере была сброшена — каждый клиент перенесет курсор при догонке
+                self.publish(last_id, _RESYNC)
+                cursor = last_id
+                continue
+            # Компактные строки нужны, только если есть такие подписчики
+            with self.lock:
+                compact_wanted = any(self.subscribers.values())
+            rows = dict(self.store.messages_since(cursor, True)[0]) if compact_wanted else {}
+            for message_id, encoded in history:
+                # Кадр собирается один раз и отправляется всем подписчикам
+                row = rows.get(message_id)
+                self.publish(message_id, message_frame(encoded), row and message_frame(row, True))
+            cursor = last_id
+
+
+def websocket_sender(ws, store, subscriber, sent_id, compact=False):
+    """Отправляет кадры из очереди подписчика, пока клиент не отключится.
+
+    В очереди лежат (id, кадр) новых сообщений, (None, кадр) служебных ответов
+    и (id, _RESYNC), когда надо догнать историю начиная с последнего отправленного id.
+    """
+    resyncs = 0
+    try:
+        while True:
+            message_id, frame = subscriber.get()
+            if frame is None:
+                return
+            if frame is _RESYNC:
+                if message_id != sent_id:
+                    resyncs += 1
+                if resyncs > WS_MAX_RESYNCS:
+                    # Клиент безнадежно отстает — отключаем, браузер переподключится с курсором
+                    ws.close(reason=1008, message='Too slow')
+                    return
+                history, last_id = store.messages_since(sent_id, compact)
+                if last_id < sent_id:
+                    ws.send(json.dumps({'type': 'reset', 'last_id': last_id}))
+                for message_id, encoded in history:
+                    ws.send(message_frame(encoded, compact).decode())
+                sent_id = last_id
+            elif message_id is None:
+                ws.send(frame)
+            elif message_id > sent_id:
+                # Кадры, уже отправленные при догонке, пропускаем
+                resyncs = 0
+                ws.send(frame.decode())
+                sent_id = message_id
+    except ConnectionClosed:
+        pass
+
+
+if Sock is not None:
+    app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': WS_PING_INTERVAL}
+    sock = Sock(app)
+
+    @sock.route('/ws')
+    @with_room
+    def websocket(room, ws):
+        """WebSocket: клиент отправляет сообщения и получает новые по одному соединению.
+
+        ?since=<id> — прислать сначала все сообщения новее этого id.
+        ?format=compact — сообщения кадрами {"type":"row"}, имена полей — первым кадром {"type":"columns"}.
+        """
+        store = room.store
+        broadcaster = room.get_broadcaster()
+        clean_ip = get_client_ip()
+        compact = request.args.get('format') == 'compact'
+
+        subscriber = broadcaster.subscribe(compact)
+        since = request.args.get('since', type=int)
+        if since is None:
+            since = store.last_id()
         else:
-            return "Нет сообщений администратора"
+            # Сначала догоняем историю, затем идут живые кадры
+            subscriber.put_nowait((since, _RESYNC))
+
+        # Чтение и отправка в разных потоках: медленная отправка не мешает принимать сообщения.
+        # Сам пишет в сокет только поток отправки, ответы на сообщения идут через ту же очередь
+        sender = threading.Thread(target=websocket_sender, args=(ws, store, subscriber, since, compact), daemon=True)
+        sender.start()
+        active_clients.inc('websocket')
+        try:
+            while sender.is_alive():
+                data = ws.receive()
+                try:
+                    message = json.loads(data)['message']
+                except (ValueError, KeyError, TypeError):
+                    ack = {'type': 'ack', 'status': 'error', 'message': 'Некорректный кадр'}
+                else:
+                    if not isinstance(message, str) or not message.strip():
+                        continue
+                    try:
+                        message = submit_message(store, 'WS', message, clean_ip)
+                        ack = {'type': 'ack', 'status': 'success', 'your_message': message}
+                    except RateLimited as e:
+                        ack = {'type': 'ack', 'status': 'error', 'message': str(e),
+                               'retry_after': math.ceil(e.retry_after)}
+                    except MessageRejected as e:
+                        ack = {'type': 'ack', 'status': 'error', 'message': str(e)}
+                try:
+                    subscriber.put_nowait((None, json.dumps(ack, ensure_ascii=False)))
+                except queue.Full:
+                    pass  # Подтверждение не обязательно: само сообщение клиент получит рассылкой
+        except ConnectionClosed:
+            pass
+        finally:
+            active_clients.dec('websocket')
+            broadcaster.unsubscribe(subscriber)
+            try:
+                subscriber.put_nowait((0, None))
+            except queue.Full:
+                pass
+
+
+@app.route('/search')
+@with_room
+def search(room):
+    """Поиск по тексту сообщений: /search?q=...&limit=N&offset=M"""
+    store = room.store
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    results, total = store.search(query, limit, offset)
+    body = b''.join((
+        b'{"results":[',
+        b','.join(encoded for _, encoded in results),
+        b'],"total":',
+        str(total).encode(),
+        b',"offset":',
+        str(offset).encode(),
+        b'}',
+    ))
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/archive')
+@with_room
+def archive(room):
+    """Старая история в JSON Lines: /archive?from=ID&to=ID (или ?by=time&from=TS&to=TS — секунды эпохи).
+
+    Сообщения, вытесненные из окна истории, читаются из сжатых сегментов архива — только тех,
+    что пересекаются с диапазоном. Ответ отдается потоком, не собираясь целиком в памяти.
+    """
+    low = request.args.get('from', 0, type=int)
+    high = request.args.get('to', sys.maxsize, type=int)
+    by_time = request.args.get('by') == 'time'
+    return Response(room.store.archived(low, high, by_time), mimetype='application/x-ndjson')
+
+
+@app.route('/export')
+@admin_only
+@with_room
+def export(room):
+    """Вся история комнаты в NDJSON (только для администратора); отдается потоком"""
+    return Response(room.store.export(), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{room.name}.ndjson"'})
+
+
+@app.route('/import', methods=['POST'])
+@admin_only
+@with_room(create=True)
+def import_history(room):
+    """Загружает сообщения из NDJSON (только для администратора): тело читается потоком, по пачке за раз.
+
+    Сообщения с уже существующими id пропускаются (skipped), так что повторный импорт ничего не удвоит.
+    Хранилище в памяти только дописывает историю: сообщение старше последнего, которого в истории нет,
+    оно не примет — такие id попадают в rejected и rejected_ids.
+    """
+    importer = Importer(room.store)
+    try:
+        for line in request.stream:
+            if importer.add(line):
+                importer.flush()
+        importer.flush()
+    except ImportRejected as e:
+        # Уже записанные пачки остаются; counts говорит, сколько успело попасть в историю
+        return jsonify(status="error", message=str(e), **importer.summary()), 400
+    return jsonify(status="success", **importer.summary())
 
 
-def log_message(method, message, ip, is_admin=False):
-    """Логирует сообщение в историю (добавляет в конец)"""
-    # Получаем имя хоста по IP (если возможно)
+@app.route('/admin-message')
+@with_room
+def admin_message(room):
+    """Страница с последним сообщением администратора.
+
+    ?n=N (или ?format=json) — последние N сообщений администратора в JSON.
+    Ответ меняется только с новым сообщением администратора, поэтому отдаем ETag/Last-Modified.
+    """
+    limit = request.args.get('n', type=int)
+    as_json = limit is not None or request.args.get('format') == 'json'
+    limit = max(1, min(limit or 1, ADMIN_MESSAGES_KEPT))
+
+    admin_messages = room.store.admin_messages(limit)
+    last_admin_msg = admin_messages[-1] if admin_messages else None
+
+    if as_json:
+        response = jsonify(messages=[msg.to_dict() for msg in admin_messages])
+    elif last_admin_msg:
+        response = app.make_response(last_admin_msg.message)
+    else:
+        response = app.make_response("Нет сообщений администратора")
+
+    # Браузер и прокси каждый раз переспрашивают, но пока админ молчит, получают пустой 304
+    last_admin_id = last_admin_msg.id if last_admin_msg else 0
+    response.set_etag(f"admin-{last_admin_id}-{limit if as_json else 'text'}")
+    if last_admin_msg and last_admin_msg.ts:
+        response.last_modified = datetime.fromtimestamp(last_admin_msg.ts, timezone.utc)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Кэш обратного DNS: ip -> (имя или None, когда запись устареет). Порядок — LRU
+dns_cache = OrderedDict()
+dns_lock = threading.Lock()
+# Кто ждет имя хоста: ip -> [функция(hostname), ...]
+dns_pending = {}
+dns_executor = ThreadPoolExecutor(max_workers=DNS_WORKERS, thread_name_prefix='dns')
+dns_stats = {
+    'hits': 0,
+    'misses': 0,
+    'lookups': 0,
+    'failures': 0,
+    'lookup_time_total': 0.0,
+    'lookup_time_max': 0.0,
+}
+
+
+def lookup_hostname(ip, on_resolved):
+    """Возвращает имя хоста из кэша; при промахе ставит запрос в пул и вернет None.
+
+    Если запрос найдет имя, будет вызвана on_resolved(hostname).
+    """
+    with dns_lock:
+        entry = dns_cache.get(ip)
+        if entry is not None and entry[1] > time.monotonic():
+            dns_cache.move_to_end(ip)
+            dns_stats['hits'] += 1
+            return entry[0]
+
+        dns_stats['misses'] += 1
+        waiting = dns_pending.get(ip)
+        if waiting is not None:
+            # Запрос для этого IP уже в работе — просто ждем его результата
+            waiting.append(on_resolved)
+            return None
+        dns_pending[ip] = [on_resolved]
+
+    dns_executor.submit(resolve_hostname, ip)
+    return None
+
+
+def resolve_hostname(ip):
+    """Выполняет обратный DNS-запрос в пуле и сообщает имя всем, кто его ждет"""
+    start = time.perf_counter()
     try:
         hostname = socket.gethostbyaddr(ip)[0]
-        ip_display = f"{ip} ({hostname})"
-    except:
-        ip_display = ip
-
+    except (OSError, UnicodeError):
+        hostname = None
+    elapsed = time.perf_counter() - start
+    dns_lookup_seconds.observe(elapsed)
+
+    with dns_lock:
+        dns_stats['lookups'] += 1
+        dns_stats['lookup_time_total'] += elapsed
+        dns_stats['lookup_time_max'] = max(dns_stats['lookup_time_max'], elapsed)
+        if hostname is None:
+            dns_stats['failures'] += 1
+        # Отрицательный результат тоже кэшируем, но на меньший срок
+        ttl = DNS_CACHE_TTL if hostname else DNS_NEGATIVE_TTL
+        dns_cache[ip] = (hostname, time.monotonic() + ttl)
+        dns_cache.move_to_end(ip)
+        while len(dns_cache) > DNS_CACHE_SIZE:
+            dns_cache.popitem(last=False)
+        waiting = dns_pending.pop(ip, [])
+
+    if hostname:
+        for on_resolved in waiting:
+            try:
+                on_resolved(hostname)
+            except Exception as e:
+                print(f"Ошибка обновления имени хоста: {e}")
+
+
+@app.route('/stats')
+def stats():
+    """Счетчики кэша DNS (для проверки эффекта кэширования)"""
+    with dns_lock:
+        dns = dict(dns_stats)
+        dns['cache_size'] = len(dns_cache)
+    requests_total = dns['hits'] + dns['misses']
+    dns['hit_rate'] = dns['hits'] / requests_total if requests_total else 0.0
+    dns['lookup_time_avg'] = dns['lookup_time_total'] / dns['lookups'] if dns['lookups'] else 0.0
+    return jsonify(dns=dns)
+
+
+def collect_rooms(value):
+    """[((комната,), value(комната)), ...] по открытым комнатам — для метрик, считаемых при выдаче"""
+    with rooms.lock:
+        open_rooms = list(rooms.rooms.values())
+    return [((room.name,), value(room)) for room in open_rooms]
+
+
+history_messages = Gauge('messenger_history_messages', 'Сообщений в памяти по комнатам', ('room',),
+                         collect=lambda: collect_rooms(lambda room: room.store.size()))
+last_message_id = Gauge('messenger_last_message_id', 'id последнего сообщения по комнатам', ('room',),
+                        collect=lambda: collect_rooms(lambda room: room.store.last_id()))
+room_clients = Gauge('messenger_room_clients', 'Запросы и подключения, которые сейчас держат комнату', ('room',),
+                     collect=lambda: collect_rooms(lambda room: room.clients))
+history_load_seconds = Gauge('messenger_history_load_seconds', 'Сколько заняла загрузка истории комнаты', ('room',),
+                             collect=lambda: collect_rooms(lambda room: room.store.load_seconds))
+persist_queue_size = Gauge('messenger_persist_queue_size', 'Сообщений ждут записи на диск',
+                           collect=lambda: [((), persist_queue.qsize())])
+dns_cache_requests = Counter('messenger_dns_cache_requests_total', 'Обращения к кэшу DNS', ('result',),
+                             collect=lambda: [(('hit',), dns_stats['hits']), (('miss',), dns_stats['misses'])])
+dns_cache_size = Gauge('messenger_dns_cache_size', 'Записей в кэше DNS', collect=lambda: [((), len(dns_cache))])
+
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    if not METRICS_ENABLED:
+        abort(404)
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def log_message(store, method, message, ip, is_admin=False):
+    """Логирует сообщение в историю (добавляет в конец)"""
     now = datetime.now()
-    # Формат даты и времени: "дд.мм.гггг чч:мм"
-    datetime_str = now.strftime("%d.%m.%Y %H:%M")
+    datetime_str = now.strftime(DATETIME_FORMAT)
 
+    # Пока имя хоста неизвестно, показываем голый IP
     message_data = {
         'datetime': datetime_str,
         'method': method,
         'message': message,
-        'ip': ip_display,
-        'admin': is_admin
+        'ip': ip,
+        'admin': is_admin,
+        'ts': int(now.timestamp())
     }
 
-    with history_lock:
-        # Добавляем в конец (новые сообщения будут внизу)
-        message_history.append(message_data)
+    # Получаем имя хоста по IP: из кэша сразу или позже, из пула (не блокируя запрос)
+    if RESOLVE_HOSTNAMES:
+        hostname = lookup_hostname(ip, lambda hostname: store.update_ip(message_data, f"{ip} ({hostname})"))
+        if hostname:
+            message_data['ip'] = f"{ip} ({hostname})"
 
-    # Сохраняем историю в файл
-    save_history()
+    # Хранилище само выдаст id, разбудит ждущих клиентов и сохранит сообщение
+    store.append(message_data)
 
 
 @app.route('/secret-file')
@@ -675,5 +3246,663 @@ def download_file():
     )
 
 
+# ---------------------------------------------------------------------------
+# ASGI: боевой режим на asyncio (uvicorn). /get-messages, /message, /stream и /ws
+# обслуживаются прямо в событийном цикле, остальные страницы — приложением Flask в пуле потоков.
+# ---------------------------------------------------------------------------
+
+class AsyncHistory:
+    """Копия хвоста истории для событийного цикла.
+
+    Поток-наблюдатель ждет новых сообщений в хранилище и передает их в цикл через
+    call_soon_threadsafe. Меняется копия только из цикла, поэтому обработчики читают ее без блокировок.
+    Имя хоста, найденное после доставки сообщения, в копию не попадает — как и в /stream.
+    """
+
+    def __init__(self, store, loop):
+        self.store = store
+        self.loop = loop
+        # id, готовый JSON и компактные строки последних сообщений, id идут по возрастанию
+        self.ids = deque(maxlen=ASGI_MIRROR_SIZE)
+        self.frames = deque(maxlen=ASGI_MIRROR_SIZE)
+        self.rows = deque(maxlen=ASGI_MIRROR_SIZE)
+        self.last_id = store.last_id()
+        self.version = 0
+        self.changed = asyncio.Event()
+        # Очереди WebSocket-клиентов -> нужен ли клиенту компактный формат
+        self.subscribers = {}
+        self.closed = False
+        self.thread = threading.Thread(target=self._watch, name='asgi-history', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Поток заметит это после очередного ожидания
+        self.closed = True
+
+    def _read(self, since):
+        """(id, JSON, компактная строка) новее since и последний id — из хранилища, в потоке-наблюдателе"""
+        history, last_id = self.store.messages_since(since)
+        rows = dict(self.store.messages_since(since, True)[0])
+        # Строки берем вторым чтением: если сообщение успело уйти из окна, строим строку из JSON
+        return [(message_id, encoded, rows.get(message_id) or row_from_json(encoded))
+                for message_id, encoded in history], last_id
+
+    def _watch(self):
+        cursor = self.store.last_id()
+        history, cursor = self._read(max(0, cursor - ASGI_MIRROR_SIZE))
+        self.loop.call_soon_threadsafe(self._apply, history, cursor)
+        while not self.closed:
+            self.store.wait(cursor, STREAM_HEARTBEAT)
+            history, last_id = self._read(cursor)
+            if history or last_id != cursor:
+                self.loop.call_soon_threadsafe(self._apply, history, last_id)
+            cursor = last_id
+
+    def _apply(self, history, last_id):
+        if last_id < self.last_id:
+            # История на сервере была сброшена
+            self.ids.clear()
+            self.frames.clear()
+            self.rows.clear()
+        for message_id, encoded, row in history:
+            if not self.ids or message_id > self.ids[-1]:
+                self.ids.append(message_id)
+                self.frames.append(encoded)
+                self.rows.append(row)
+        reset = last_id < self.last_id
+        self.last_id = last_id
+        self.version += 1
+
+        # Будим всех ждущих: событие одноразовое, следующие ждут уже новое
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+        for subscriber, compact in list(self.subscribers.items()):
+            if reset:
+                self._publish(subscriber, last_id, _RESYNC)
+            for message_id, encoded, row in history:
+                self._publish(subscriber, message_id, row if compact else encoded)
+
+    @staticmethod
+    def _publish(subscriber, message_id, frame):
+        try:
+            subscriber.put_nowait((message_id, frame))
+        except asyncio.QueueFull:
+            # Клиент не успевает читать — выбрасываем его очередь и просим догнать историю
+            stopped = False
+            while not subscriber.empty():
+                stopped = subscriber.get_nowait()[1] is None or stopped
+            subscriber.put_nowait((message_id, None if stopped else _RESYNC))
+
+    def etag(self, compact=False):
+        return f"a{self.last_id}-{self.version}{'-c' if compact else ''}"
+
+    async def wait(self, since, timeout):
+        """Ждет, пока последний id не станет отличаться от since. True, если дождались"""
+        if self.last_id != since:
+            return True
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def messages_since(self, since, compact=False):
+        """([(id, JSON или строка), ...], последний id) из копии или None, если since старше копии"""
+        if since is None or since > self.last_id:
+            return None
+        if since == self.last_id:
+            return [], self.last_id
+        if not self.ids or since < self.ids[0] - 1:
+            return None
+        start = bisect_right(self.ids, since)
+        frames = self.rows if compact else self.frames
+        return list(zip(islice(self.ids, start, None), islice(frames, start, None))), self.last_id
+
+    async def read_since(self, since, compact=False):
+        """Сообщения новее since: из копии, а если клиент отстал сильнее — из хранилища в пуле потоков"""
+        result = self.messages_since(since, compact)
+        if result is None:
+            result = await self.loop.run_in_executor(None, self.store.messages_since, since, compact)
+        return result
+
+
+asgi_loop = None
+
+
+def get_async_history(room):
+    """Копия истории комнаты для текущего событийного цикла (создается при первом запросе)"""
+    global asgi_loop
+    loop = asyncio.get_running_loop()
+    if asgi_loop is not loop:
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi'))
+        asgi_loop = loop
+    if room.async_history is None or room.async_history.loop is not loop:
+        room.async_history = AsyncHistory(room.store, loop)
+    return room.async_history
+
+
+async def asgi_acquire_room(name, create=False):
+    """Комната для запроса ASGI (None, если ее нет). Всегда в пуле потоков: acquire() может читать диск
+    и ждать, пока комнату загрузит другой запрос, — цикл событий при этом не стоит"""
+    return await asyncio.get_running_loop().run_in_executor(None, rooms.acquire, name, create)
+
+
+class AsgiRequest:
+    """Разобранный HTTP-запрос ASGI: адрес, параметры и заголовки в виде структур Werkzeug"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.path = scope['path']
+        self.method = scope.get('method', 'GET')
+        self.query_string = scope.get('query_string', b'')
+        self.args = MultiDict(parse_qsl(self.query_string.decode('latin-1'), keep_blank_values=True))
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                for name, value in scope.get('headers', ())])
+
+    @property
+    def client_ip(self):
+        client = self.scope.get('client')
+        return client_address(client[0] if client else '', self.headers.get('X-Forwarded-For'))
+
+    @property
+    def full_path(self):
+        return f"{self.path}?{self.query_string.decode('latin-1')}"
+
+    def not_modified(self, etag):
+        return parse_etags(self.headers.get('If-None-Match')).contains_weak(etag)
+
+
+async def asgi_body(receive):
+    """Читает тело запроса целиком"""
+    chunks = []
+    while True:
+        event = await receive()
+        if event['type'] == 'http.disconnect':
+            break
+        chunks.append(event.get('body', b''))
+        if not event.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def asgi_send(send, status, body=b'', content_type='application/json', headers=()):
+    headers = [(b'content-length', str(len(body)).encode()), *headers]
+    if body or status == 200:
+        headers.append((b'content-type', content_type.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def asgi_too_many_requests(send, retry_after, message="Слишком много запросов, попробуйте позже"):
+    body = json.dumps({"status": "error", "message": message, "retry_after": math.ceil(retry_after)},
+                      ensure_ascii=False).encode()
+    await asgi_send(send, 429, body, headers=[(b'retry-after', str(math.ceil(retry_after)).encode())])
+
+
+async def asgi_send_history(req, send, body, etag, compact=False):
+    """Отдает JSON истории с ETag, сжатием и кэшем сжатых тел, как compress_response() во Flask"""
+    headers = [(b'etag', f'W/"{etag}"'.encode()), (b'cache-control', b'no-cache'), (b'vary', b'Accept-Encoding, Accept')]
+    encoding = choose_encoding(parse_accept_header(req.headers.get('Accept-Encoding')))
+    if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+        key = (req.full_path, etag, encoding)
+        body = await asyncio.get_running_loop().run_in_executor(None, compress_cached, body, encoding, key)
+        headers.append((b'content-encoding', encoding.encode()))
+    await asgi_send(send, 200, body, COMPACT_MIMETYPE if compact else 'application/json', headers)
+
+
+async def asgi_send_chunks(send, chunks, headers=()):
+    """Отдает NDJSON потоком; куски берутся из обычного итератора в пуле потоков (он читает диск)"""
+    loop = asyncio.get_running_loop()
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/x-ndjson'), *headers]})
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def asgi_archive(req, room, receive, send):
+    low = req.args.get('from', 0, type=int)
+    high = req.args.get('to', sys.maxsize, type=int)
+    chunks = await asyncio.get_running_loop().run_in_executor(
+        None, room.store.archived, low, high, req.args.get('by') == 'time')
+    await asgi_send_chunks(send, chunks)
+
+
+async def asgi_export(req, room, receive, send):
+    chunks = await asyncio.get_running_loop().run_in_executor(None, room.store.export)
+    await asgi_send_chunks(send, chunks, [(b'content-disposition', f'attachment; filename="{room.name}.ndjson"'.encode())])
+
+
+async def asgi_import(req, room, receive, send):
+    """/import в событийном цикле: тело читается по кускам, пачки пишутся в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    importer = Importer(room.store)
+    partial = b''
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'http.disconnect':
+                return
+            lines = (partial + event.get('body', b'')).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                if importer.add(line):
+                    await loop.run_in_executor(None, importer.flush)
+            if not event.get('more_body'):
+                break
+        importer.add(partial)
+        await loop.run_in_executor(None, importer.flush)
+    except ImportRejected as e:
+        body = json.dumps({"status": "error", "message": str(e), **importer.summary()}, ensure_ascii=False).encode()
+        await asgi_send(send, 400, body)
+        return
+    await asgi_send(send, 200, json.dumps({"status": "success", **importer.summary()}).encode())
+
+
+async def asgi_get_messages(req, room, receive, send):
+    store = room.store
+    history_copy = get_async_history(room)
+    retry_after = poll_limiter.take(req.client_ip)
+    if retry_after:
+        await asgi_too_many_requests(send, retry_after)
+        return
+    compact = wants_compact(req.args, parse_accept_header(req.headers.get('Accept'), MIMEAccept))
+
+    # Постраничная загрузка старой истории — из хранилища, в пуле потоков
+    before = req.args.get('before', type=int)
+    if before is not None:
+        etag = history_etag(store, compact)
+        if req.not_modified(etag):
+            await asgi_send(send, 304, headers=[(b'etag', f'W/"{etag}"'.encode())])
+            return
+        limit = max(1, min(req.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        history, has_more = await asyncio.get_running_loop().run_in_executor(
+            None, store.messages_before, before, limit, compact)
+        await asgi_send_history(req, send, history_body(history, store.last_id(), has_more, compact), etag, compact)
+        return
+
+    since = req.args.get('since', type=int)
+    wait = min(req.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    if since is not None and wait > 0:
+        # Ожидание — это просто приостановленная корутина, поток не занят
+        with active_clients.track('long_poll'):
+            await history_copy.wait(since, wait)
+
+    # Версия копии, а не хранилища: копия может немного отставать, и ETag должен описывать то, что отдаем
+    etag = history_copy.etag(compact) if since is not None else history_etag(store, compact)
+    if req.not_modified(etag):
+        await asgi_send(send, 304, headers=[(b'etag', f'W/"{etag}"'.encode())])
+        return
+    if since is None:
+        history, last_id = await asyncio.get_running_loop().run_in_executor(None, store.messages_since, None, compact)
+    else:
+        history, last_id = await history_copy.read_since(since, compact)
+
+    has_more = None
+    if 'limit' in req.args:
+        limit = max(1, min(req.args.get('limit', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+        has_more = len(history) > limit
+        if has_more:
+            history = history[:limit]
+            last_id = history[-1][0]
+    await asgi_send_history(req, send, history_body(history, last_id, has_more, compact), etag, compact)
+
+
+async def asgi_empty_history(req, name, send):
+    """/get-messages комнаты, которой еще нет (см. empty_history): ожидание — корутина, поток не занят"""
+    retry_after = poll_limiter.take(req.client_ip)
+    if retry_after:
+        await asgi_too_many_requests(send, retry_after)
+        return
+    compact = wants_compact(req.args, parse_accept_header(req.headers.get('Accept'), MIMEAccept))
+    wait = min(req.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    if req.args.get('since', type=int) is not None and wait > 0:
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + wait
+        with active_clients.track('long_poll'):
+            while time.monotonic() < deadline:
+                # exists() может заглянуть на диск — в пуле потоков
+                if await loop.run_in_executor(None, rooms.exists, name):
+                    break
+                await asyncio.sleep(min(ROOM_WAIT_INTERVAL, max(0, deadline - time.monotonic())))
+    has_more = False if 'before' in req.args or 'limit' in req.args else None
+    await asgi_send(send, 200, history_body([], 0, has_more, compact),
+                    content_type=COMPACT_MIMETYPE if compact else 'application/json')
+
+
+async def asgi_message(req, room, receive, send):
+    try:
+        message = json.loads(await asgi_body(receive))['message']
+    except (ValueError, KeyError, TypeError):
+        message = None
+    if not isinstance(message, str):
+        body = json.dumps({"status": "error", "message": "Нет текста сообщения"}, ensure_ascii=False).encode()
+        await asgi_send(send, 400, body)
+        return
+
+    clean_ip = req.client_ip
+    # Запись (хранилище, журнал) — в пуле потоков, цикл не ждет диска
+    try:
+        message = await asyncio.get_running_loop().run_in_executor(
+            None, submit_message, room.store, 'POST', message, clean_ip)
+    except RateLimited as e:
+        await asgi_too_many_requests(send, e.retry_after, str(e))
+        return
+    except MessageRejected as e:
+        await asgi_send(send, 400, json.dumps({"status": "error", "message": str(e)}, ensure_ascii=False).encode())
+        return
+    body = json.dumps({
+        "status": "success",
+        "message": "Сообщение получено",
+        "your_message": message,
+        "ip": clean_ip
+    }, ensure_ascii=False).encode()
+    await asgi_send(send, 200, body)
+
+
+async def asgi_stream(req, room, receive, send):
+    """Server-Sent Events в событийном цикле: соединение стоит одну корутину, а не поток"""
+    history_copy = get_async_history(room)
+    retry_after = poll_limiter.take(req.client_ip)
+    if retry_after:
+        await asgi_too_many_requests(send, retry_after)
+        return
+    since = req.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = req.args.get('since', type=int)
+    if since is None:
+        since = history_copy.last_id
+    compact = wants_compact(req.args, parse_accept_header(req.headers.get('Accept'), MIMEAccept))
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+
+    async def events():
+        cursor = since
+        if compact:
+            yield b'event: columns\ndata: ' + COMPACT_COLUMNS_JSON + b'\n\n'
+        while True:
+            await history_copy.wait(cursor, STREAM_HEARTBEAT)
+            history, last_id = await history_copy.read_since(cursor, compact)
+            if last_id == cursor:
+                yield b": ping\n\n"
+                continue
+            if last_id < cursor:
+                yield f"event: reset\ndata: {json.dumps({'last_id': last_id})}\n\n".encode()
+            yield b''.join(b''.join((b'id: ', str(message_id).encode(), b'\ndata: ', encoded, b'\n\n'))
+                           for message_id, encoded in history)
+            cursor = last_id
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def pump():
+        async for chunk in events():
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    # Поток событий живет, пока клиент не отключится
+    watcher = asyncio.ensure_future(disconnected())
+    sender = asyncio.ensure_future(pump())
+    try:
+        with active_clients.track('stream'):
+            await asyncio.wait((watcher, sender), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        sender.cancel()
+
+
+async def asgi_websocket(req, room, receive, send):
+    """WebSocket в событийном цикле; протокол тот же, что у /ws во Flask"""
+    history_copy = get_async_history(room)
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+
+    clean_ip = req.client_ip
+    compact = req.args.get('format') == 'compact'
+    subscriber = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+    if compact:
+        subscriber.put_nowait((None, columns_frame().decode()))
+    history_copy.subscribers[subscriber] = compact
+    sent_id = req.args.get('since', type=int)
+    if sent_id is None:
+        sent_id = history_copy.last_id
+    else:
+        subscriber.put_nowait((sent_id, _RESYNC))
+
+    async def send_frames():
+        nonlocal sent_id
+        resyncs = 0
+        while True:
+            message_id, frame = await subscriber.get()
+            if frame is None:
+                return
+            if frame is _RESYNC:
+                if message_id != sent_id:
+                    resyncs += 1
+                if resyncs > WS_MAX_RESYNCS:
+                    await send({'type': 'websocket.close', 'code': 1008, 'reason': 'Too slow'})
+                    return
+                history, last_id = await history_copy.read_since(sent_id, compact)
+                if last_id < sent_id:
+                    await send({'type': 'websocket.send', 'text': json.dumps({'type': 'reset', 'last_id': last_id})})
+                for message_id, encoded in history:
+                    await send({'type': 'websocket.send', 'text': message_frame(encoded, compact).decode()})
+                sent_id = last_id
+            elif message_id is None:
+                await send({'type': 'websocket.send', 'text': frame})
+            elif message_id > sent_id:
+                resyncs = 0
+                await send({'type': 'websocket.send', 'text': message_frame(frame, compact).decode()})
+                sent_id = message_id
+
+    async def receive_messages():
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                return
+            try:
+                message = json.loads(event.get('text') or event.get('bytes') or b'')['message']
+            except (ValueError, KeyError, TypeError):
+                ack = {'type': 'ack', 'status': 'error', 'message': 'Некорректный кадр'}
+            else:
+                if not isinstance(message, str) or not message.strip():
+                    continue
+                try:
+                    message = await loop.run_in_executor(None, submit_message, room.store, 'WS', message, clean_ip)
+                    ack = {'type': 'ack', 'status': 'success', 'your_message': message}
+                except RateLimited as e:
+                    ack = {'type': 'ack', 'status': 'error', 'message': str(e),
+                           'retry_after': math.ceil(e.retry_after)}
+                except MessageRejected as e:
+                    ack = {'type': 'ack', 'status': 'error', 'message': str(e)}
+            try:
+                subscriber.put_nowait((None, json.dumps(ack, ensure_ascii=False)))
+            except asyncio.QueueFull:
+                pass  # Подтверждение не обязательно: само сообщение клиент получит рассылкой
+
+    sender = asyncio.ensure_future(send_frames())
+    receiver = asyncio.ensure_future(receive_messages())
+    try:
+        with active_clients.track('websocket'):
+            await asyncio.wait((sender, receiver), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        history_copy.subscribers.pop(subscriber, None)
+        sender.cancel()
+        receiver.cancel()
+
+
+def wsgi_environ(req, body):
+    """Окружение WSGI для передачи запроса приложению Flask"""
+    server = req.scope.get('server') or ('localhost', 80)
+    client = req.scope.get('client')
+    environ = {
+        'REQUEST_METHOD': req.method,
+        'SCRIPT_NAME': req.scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': req.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': req.query_string.decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{req.scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': req.scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in req.headers.items():
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            key = f'HTTP_{key}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    """Выполняет запрос приложением Flask (в пуле потоков) и собирает ответ целиком"""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    status, headers = started
+    return int(status.split(' ', 1)[0]), headers, body
+
+
+def asgi_timed_send(req, send):
+    """send(), который при начале ответа записывает время и код в метрики, как record_request_metrics()"""
+    started = time.perf_counter()
+
+    async def timed_send(event):
+        if event['type'] == 'http.response.start':
+            http_latency.observe(time.perf_counter() - started, req.path, req.method)
+            http_requests.inc(req.path, req.method, str(event['status']))
+        await send(event)
+    return timed_send
+
+
+async def asgi_wsgi(req, receive, send):
+    body = await asgi_body(receive)
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(
+        None, call_wsgi, wsgi_environ(req, body))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+ASGI_ROUTES = {
+    ('GET', '/get-messages'): asgi_get_messages,
+    ('POST', '/message'): asgi_message,
+    ('GET', '/stream'): asgi_stream,
+    ('GET', '/archive'): asgi_archive,
+    ('GET', '/export'): asgi_export,
+    ('POST', '/import'): asgi_import,
+}
+# Маршруты записи: только они создают комнату, которой еще нет
+ASGI_CREATE_ROUTES = {('POST', '/message'), ('POST', '/import')}
+# Только для администратора (проверяется до того, как комната будет создана)
+ASGI_ADMIN_ROUTES = {('GET', '/export'), ('POST', '/import')}
+
+
+async def asgi_app(scope, receive, send):
+    """ASGI-приложение (например, uvicorn wapp:asgi_app)"""
+    if scope['type'] == 'lifespan':
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                get_async_history(rooms.default)
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    req = AsgiRequest(scope)
+    if scope['type'] == 'websocket':
+        handler = asgi_websocket if req.path == '/ws' else None
+    else:
+        handler = ASGI_ROUTES.get((req.method, req.path))
+        if handler is None:
+            # Остальное (страница, поиск, статика) — приложение Flask, комнату оно выберет само
+            await asgi_wsgi(req, receive, send)
+            return
+
+    if scope['type'] == 'http' and METRICS_ENABLED:
+        send = asgi_timed_send(req, send)
+    room_name = req.args.get('room', DEFAULT_ROOM)
+    if handler is None or not ROOM_NAME_RE.match(room_name):
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1008})
+        else:
+            await asgi_send(send, 404)
+        return
+    route = (req.method, req.path)
+    if route in ASGI_ADMIN_ROUTES and req.client_ip != ADMIN_IP:
+        await asgi_send(send, 403)
+        return
+    try:
+        room = await asgi_acquire_room(room_name, route in ASGI_CREATE_ROUTES)
+    except RoomLimitReached as e:
+        await asgi_send(send, 503, json.dumps({"status": "error", "message": str(e)}, ensure_ascii=False).encode())
+        return
+    if room is None:
+        if handler is asgi_get_messages:
+            await asgi_empty_history(req, room_name, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1008})
+        else:
+            await asgi_send(send, 404)
+        return
+    try:
+        await handler(req, room, receive, send)
+    finally:
+        rooms.release(room)
+
+
+def serve(host, port, workers):
+    """Боевой запуск: uvicorn с asgi_app"""
+    if workers > 1 and STORAGE_BACKEND == 'memory':
+        print("Ошибка: несколько воркеров требуют общего хранилища (MESSENGER_STORAGE=sqlite), запускаю один")
+        workers = 1
+    if workers == 1:
+        uvicorn.run(asgi_app, host=host, port=port)
+    else:
+        # Каждый воркер импортирует модуль заново
+        uvicorn.run('wapp:asgi_app', host=host, port=port, workers=workers)
+
+
 if __name__ == '__main__':
-    app.run(debug=True, port=80, host='0.0.0.0')
+    parser = argparse.ArgumentParser(description='Local Messenger')
+    parser.add_argument('--host', default=os.environ.get('MESSENGER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MESSENGER_PORT', 80)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('MESSENGER_WORKERS', 1)),
+                        help='число процессов (больше одного — только с MESSENGER_STORAGE=sqlite)')
+    parser.add_argument('--dev', action='store_true', help='отладочный сервер Flask вместо uvicorn')
+    args = parser.parse_args()
+
+    if args.dev or uvicorn is None:
+        if not args.dev:
+            print("uvicorn не установлен — запускаю встроенный сервер Flask (pip install uvicorn)")
+        app.run(debug=args.dev, port=args.port, host=args.host, threaded=True)
+    else:
+        serve(args.host, args.port, args.workers)